@@ -0,0 +1,222 @@
+#!/bin/env python3
+
+'''
+Time annie_sam_wrap.sh and submit_annie_jobs.py against the stand-ins from annie_fake_grid.py,
+so that changes to the file loop can be measured without the grid. Every mode of the wrapper
+gets a fresh fake project and runs over all of its files, and the stage records it writes are
+used to work out where the time went.
+'''
+
+from __future__ import print_function
+from __future__ import division
+import os, sys, glob
+import argparse
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+import annie_fake_grid
+import annie_sam_status
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# wrapper options for each of the modes that are run by default
+default_modes = [
+    ('serial',          []),
+    ('quick_copy',      ['--quick_copy']),
+    ('copy_streams',    ['--quick_copy', '--copy_streams', '4']),
+    ('prefetch',        ['--prefetch', '2']),
+    ('persistent',      ['--persistent_container']),
+    ('workers',         ['--workers', '2']),
+    ('everything',      ['--quick_copy', '--copy_streams', '4', '--prefetch', '2', '--persistent_container']),
+]
+
+def run_mode(name, wrapper_args, config, work_dir):
+    '''
+    Run the wrapper over a fresh fake project. Returns the wall time, the exit code and the records.
+    '''
+    mode_dir = os.path.join(work_dir, name)
+    grid = os.path.join(mode_dir, 'grid')
+    tarball = annie_fake_grid.setup(grid, config)
+    for sub_dir in ['input', 'iwd', 'dest']:
+        os.makedirs(os.path.join(mode_dir, sub_dir))
+    shutil.copy(tarball, os.path.join(mode_dir, 'input'))
+
+    env = dict(os.environ)
+    env.update({'ANNIE_FAKE_GRID' : grid, 'CONDOR_DIR_INPUT' : os.path.join(mode_dir, 'input'),
+                '_CONDOR_JOB_IWD' : os.path.join(mode_dir, 'iwd'), 'DEST' : os.path.join(mode_dir, 'dest'),
+                'SAM_PROJECT_NAME' : 'fake_project', 'IFDH_BASE_URI' : 'http://fake-sam/sam/annie/api',
+                'GRID_USER' : os.getenv('USER', 'annie'), 'EXPERIMENT' : 'annie'})
+    for key in ['JOBSUBJOBID', 'CLUSTER', 'PROCESS', 'FIFE_GLIDEIN_ToDie', '_CONDOR_MACHINE_AD']:
+        env.pop(key, None)
+
+    command = ['bash', os.path.join(here, 'annie_sam_wrap.sh'), '--tarball', os.path.basename(tarball),
+               '--config', 'Bench', '--input_file_config', 'my_files.txt', '--rename_outputs', '--stage_records'] + wrapper_args
+    start = time.time()
+    with open(os.path.join(mode_dir, 'log'), 'w') as log:
+        res = subprocess.call(command, cwd=os.path.join(mode_dir, 'iwd'), env=env, stdout=log, stderr=subprocess.STDOUT)
+    wall = time.time() - start
+
+    records = []
+    for record_file in glob.glob(os.path.join(mode_dir, 'dest', '**', 'stage_records*.jsonl'), recursive=True):
+        with open(record_file) as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    return wall, res, records
+
+def summarize(wall, records):
+    '''
+    Throughput and where the time went. The fractions are of the time that every consumer was
+    there for, so with two workers a job that runs Analyse all the time is 0% idle.
+      idle       not running Analyse
+      input      waiting on getNextFile and fetchInput, ie. not counting prefetches
+      copy_out   waiting on copies, ie. not counting copies in the background
+    '''
+    consumers = [record for record in records if record['stage'] == 'consumer']
+    slot_time = wall * max(1, len(consumers))
+
+    def foreground(stage, flag):
+        return sum(record['duration'] for record in records if record['stage'] == stage and not record.get(flag))
+
+    consumed = sum(record.get('consumed', 0) for record in consumers)
+    analyse = sum(record['duration'] for record in records if record['stage'] == 'Analyse')
+    return {'consumed' : consumed,
+            'skipped'  : sum(record.get('skipped', 0) for record in consumers),
+            'wall'     : wall,
+            'files_per_hour' : consumed / (wall / 3600.) if wall > 0 else 0.,
+            'idle'     : max(0., 1 - analyse / slot_time),
+            'input'    : (foreground('getNextFile', 'prefetched') + foreground('fetchInput', 'prefetched')) / slot_time,
+            'copy_out' : foreground('copy_out', 'background') / slot_time}
+
+def time_submission(config, work_dir):
+    '''
+    Seconds for submit_annie_jobs.py --test to plan a submission of the whole fake project
+    '''
+    grid = os.path.join(work_dir, 'submit', 'grid')
+    tarball = annie_fake_grid.setup(grid, config)
+    env = dict(os.environ)
+    env.update({'ANNIE_FAKE_GRID' : grid, 'ANNIEGRIDUTILSDIR' : here})
+    command = [sys.executable, os.path.join(here, 'submit_annie_jobs.py'), '--test', '--jobname', 'benchmark',
+               '--dest', '/pnfs/annie/scratch/users/%s/benchmark' % os.getenv('USER', 'annie'), '--config', 'Bench',
+               '--input_file_config', 'my_files.txt', '--defname', 'fake_definition', '--tarball', tarball,
+               '--tarball_index', os.path.join(work_dir, 'submit', 'tarballs.json'), '--files_per_job', '10']
+    start = time.time()
+    with open(os.path.join(work_dir, 'submit', 'log'), 'w') as log:
+        res = subprocess.call(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return time.time() - start, res
+
+def time_status(config, work_dir, nprojects, threads):
+    '''
+    Seconds for the status view to get the summaries of nprojects projects from a local stand-in
+    for the SAM web API, asking threads at a time, and then again from the cache. Also returns
+    the projects whose summaries didn't come back, or didn't match the fake project.
+    '''
+    grid = os.path.join(work_dir, 'status', 'grid')
+    annie_fake_grid.setup(grid, config)
+    server, base_uri = annie_fake_grid.serve_sam(grid)
+    projects = ['fake_project_%d' % i for i in range(nprojects)]
+    cache = {}
+    try:
+        start = time.time()
+        summaries = annie_sam_status.get_summaries(projects, base_uri, cache, threads=threads)
+        fetch_time = time.time() - start
+        start = time.time()
+        annie_sam_status.get_summaries(projects, base_uri, cache, min_interval=3600, threads=threads)
+        cache_time = time.time() - start
+    finally:
+        server.shutdown()
+
+    bad = []
+    for project in projects:
+        entry, error = summaries[project]
+        if entry is None:
+            bad.append("%s: %s" % (project, error))
+        elif entry['summary']['project_name'] != project or annie_sam_status.file_counts(entry['summary'])[3] != config['nfiles']:
+            bad.append("%s: the summary doesn't match the fake project, %s" % (project, json.dumps(entry['summary'])))
+    return fetch_time, cache_time, bad
+
+def print_results(results):
+    header = "%-16s %6s %8s %9s %9s %7s %7s %9s" % ('mode', 'files', 'skipped', 'wall s', 'files/h', 'idle', 'input', 'copy out')
+    print(header)
+    print("-" * len(header))
+    for name, result in results:
+        print("%-16s %6d %8d %9.1f %9.1f %6.1f%% %6.1f%% %8.1f%%" %
+              (name, result['consumed'], result['skipped'], result['wall'], result['files_per_hour'],
+               100. * result['idle'], 100. * result['input'], 100. * result['copy_out']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark annie_sam_wrap.sh against a fake grid. Each mode runs the wrapper over '\
+                                     'all of the files of its own fake SAM project and reports files per hour, the fraction of the '\
+                                     'time Analyse was idle, and how much of it was spent waiting on input and on copying out.')
+    parser.add_argument('--modes', default=','.join(name for name, args in default_modes),
+                        help='Comma separated list of the modes to run, which can be empty (default %(default)s)')
+    parser.add_argument('--mode', action='append', metavar='NAME=OPTIONS',
+                        help='Add a mode running the wrapper with OPTIONS, eg. --mode "big_batch=--files_per_invocation 5". '\
+                             'You can use this multiple times.')
+    parser.add_argument('--submit',   action='store_true', help='Also time how long submit_annie_jobs.py --test takes')
+    parser.add_argument('--status',   type=int, metavar='N', help='Also check and time the status view getting the summaries of N projects '\
+                                                                  'from a local stand-in for the SAM web API, with the --sam latency')
+    parser.add_argument('--status_threads', type=int, default=8, help='Projects the status view asks about at once with --status (default %(default)s)')
+    parser.add_argument('--work_dir', help='Where to run everything (default is a new temporary directory)')
+    parser.add_argument('--keep',     action='store_true', help='Keep the work directory with the logs and outputs of each mode')
+    parser.add_argument('--json',     metavar='FILE', help='Also write the results to FILE')
+    annie_fake_grid.add_config_args(parser)
+    args = parser.parse_args()
+
+    config = annie_fake_grid.config_from_args(args)
+    known_modes = dict(default_modes)
+    modes = []
+    for name in filter(None, args.modes.split(',')):
+        if name not in known_modes:
+            print("Error: unknown mode %s, the modes are %s" % (name, ', '.join(known_modes)), file=sys.stderr)
+            sys.exit(1)
+        modes.append((name, known_modes[name]))
+    for mode in args.mode or []:
+        name, options = mode.split('=', 1)
+        modes.append((name, options.split()))
+
+    work_dir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix='annie_benchmark_')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    print("Running %d files of %.0f MB, with Analyse taking %.1f s per file, in %s" %
+          (config['nfiles'], config['size_mb'], config['analyse_sec'], work_dir))
+
+    results = []
+    for name, wrapper_args in modes:
+        print("Running %s: %s" % (name, ' '.join(wrapper_args)))
+        sys.stdout.flush()
+        wall, res, records = run_mode(name, wrapper_args, config, work_dir)
+        if res != 0 or not records:
+            print("Warning: %s exited with %d and left %d records, see %s" % (name, res, len(records), os.path.join(work_dir, name, 'log')),
+                  file=sys.stderr)
+        results.append((name, summarize(wall, records)))
+
+    if results:
+        print("")
+        print_results(results)
+
+    output = {'config' : config, 'modes' : dict(modes), 'results' : dict(results)}
+    if args.submit:
+        os.makedirs(os.path.join(work_dir, 'submit'))
+        submit_time, res = time_submission(config, work_dir)
+        output['submit_seconds'] = submit_time
+        print("\nsubmit_annie_jobs.py --test took %.1f s%s" % (submit_time, '' if res == 0 else ' and failed, see %s' % os.path.join(work_dir, 'submit', 'log')))
+
+    status_ok = True
+    if args.status:
+        os.makedirs(os.path.join(work_dir, 'status'))
+        fetch_time, cache_time, bad = time_status(config, work_dir, args.status, args.status_threads)
+        output['status_seconds'] = {'fetch' : fetch_time, 'cached' : cache_time}
+        print("\nThe status of %d projects took %.2f s, %d at a time, and %.3f s from the cache" %
+              (args.status, fetch_time, args.status_threads, cache_time))
+        for problem in bad:
+            print("Error: %s" % problem, file=sys.stderr)
+        status_ok = not bad
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if not args.keep and not args.work_dir:
+        shutil.rmtree(work_dir)
+    sys.exit(0 if status_ok else 1)
@@ -0,0 +1,167 @@
+#!/bin/env python3
+
+'''
+List and extract the outputs in the bundles that annie_sam_wrap.sh --bundle_outputs copies
+back. The manifest that comes with them, bundle_manifest.<job>.jsonl, has the block every
+output starts at in its bundle, so a single output is read without going through the rest of
+the bundle. Bundles with no manifest, eg. from a job that didn't finish, are read from the start.
+'''
+
+from __future__ import print_function
+from __future__ import division
+import os, sys, glob
+import argparse
+import fnmatch
+import json
+import shutil
+import tarfile
+from collections import OrderedDict
+
+def find_files(paths):
+    '''
+    Expand the given files and directories into the lists of manifests and bundles
+    '''
+    manifests = []
+    bundles = []
+    for path in paths:
+        if os.path.isdir(path):
+            manifests += sorted(glob.glob(os.path.join(path, '**', 'bundle_manifest*.jsonl'), recursive=True))
+            bundles += sorted(glob.glob(os.path.join(path, '**', 'bundle.*.tar'), recursive=True))
+        elif not os.path.isfile(path):
+            print("Warning: %s does not exist, skipping it" % path, file=sys.stderr)
+        elif path.endswith('.jsonl'):
+            manifests.append(path)
+        else:
+            bundles.append(path)
+    return manifests, bundles
+
+def scan_bundle(bundle):
+    '''
+    Entries like the ones in the manifest for everything in a bundle, going through all of it
+    '''
+    entries = []
+    with tarfile.open(bundle, 'r:') as tar:
+        for member in tar:
+            if member.isfile():
+                entries.append({'name' : member.name, 'original' : member.name, 'size' : member.size,
+                                'inputs' : [], 'bundle' : bundle, 'offset' : member.offset})
+    return entries
+
+def load_entries(paths):
+    '''
+    Every output in the manifests and bundles under paths, with the bundle as a path.
+    Bundles that aren't in any of the manifests are scanned instead.
+    '''
+    manifests, bundles = find_files(paths)
+    entries = []
+    for manifest in manifests:
+        with open(manifest) as f:
+            for iline, line in enumerate(f):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError as e:
+                    print("Warning: could not read line %d of %s: %s" % (iline + 1, manifest, e), file=sys.stderr)
+                    continue
+                # the bundles get copied back next to the manifest
+                entry['bundle'] = os.path.join(os.path.dirname(manifest), entry['bundle'])
+                entries.append(entry)
+
+    known = set(os.path.abspath(entry['bundle']) for entry in entries)
+    for bundle in bundles:
+        if os.path.abspath(bundle) not in known:
+            print("Warning: %s is not in any manifest, reading all of it" % bundle, file=sys.stderr)
+            entries += scan_bundle(bundle)
+    return entries
+
+def select_entries(entries, names=None, inputs=None):
+    '''
+    The entries whose name or original name match one of the names, which can be wildcards,
+    and that came from one of the inputs. No names or inputs keeps everything.
+    '''
+    selected = []
+    for entry in entries:
+        if names and not any(fnmatch.fnmatch(entry['name'], name) or fnmatch.fnmatch(entry['original'], name) for name in names):
+            continue
+        if inputs and not set(os.path.basename(i) for i in inputs) & set(entry['inputs']):
+            continue
+        selected.append(entry)
+    return selected
+
+def read_member(f, entry):
+    '''
+    The member of the open bundle f that entry is for, starting at its offset
+    '''
+    f.seek(entry['offset'])
+    # tarfile starts reading wherever the file is
+    tar = tarfile.open(fileobj=f, mode='r:')
+    member = tar.next()
+    if member is None or member.name != entry['name']:
+        raise ValueError("%s is not at %d in %s, the manifest doesn't match the bundle" % (entry['name'], entry['offset'], entry['bundle']))
+    return tar, member
+
+def extract(entries, to_dir):
+    '''
+    Copy the selected outputs out of their bundles into to_dir. Returns the number that failed.
+    '''
+    if not os.path.isdir(to_dir):
+        os.makedirs(to_dir)
+    by_bundle = OrderedDict()
+    for entry in entries:
+        by_bundle.setdefault(entry['bundle'], []).append(entry)
+
+    nfailed = 0
+    for bundle, bundle_entries in by_bundle.items():
+        with open(bundle, 'rb') as f:
+            for entry in sorted(bundle_entries, key=lambda entry: entry['offset']):
+                output = os.path.join(to_dir, os.path.basename(entry['name']))
+                try:
+                    tar, member = read_member(f, entry)
+                    with open(output + '.part', 'wb') as out:
+                        shutil.copyfileobj(tar.extractfile(member), out)
+                    os.rename(output + '.part', output)
+                except (ValueError, tarfile.TarError, OSError) as e:
+                    print("Error: could not extract %s: %s" % (entry['name'], e), file=sys.stderr)
+                    if os.path.exists(output + '.part'):
+                        os.remove(output + '.part')
+                    nfailed += 1
+                    continue
+                print("%s -> %s" % (entry['name'], output))
+    return nfailed
+
+def print_entries(entries):
+    header = "%-50s %10s  %-30s %s" % ('name', 'MB', 'bundle', 'inputs')
+    print(header)
+    print("-" * len(header))
+    for entry in entries:
+        print("%-50s %10.2f  %-30s %s" % (entry['name'], entry['size'] / 1e6, os.path.basename(entry['bundle']), ' '.join(entry['inputs'])))
+    print("")
+    print("%d outputs, %.1f MB, in %d bundles" % (len(entries), sum(entry['size'] for entry in entries) / 1e6,
+                                               len(set(entry['bundle'] for entry in entries))))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List and extract the outputs in the bundles from annie_sam_wrap.sh --bundle_outputs. '\
+                                     'Bundles can be read straight from /pnfs.')
+    parser.add_argument('command', choices=['list', 'extract'], help='list the outputs, or extract them')
+    parser.add_argument('paths', nargs='+', metavar='PATH', help='Bundles, manifests, or directories to look for them in, eg. the --dest of a submission')
+    parser.add_argument('--name',  action='append', help='Only outputs with this name or original name. It can have wildcards. '\
+                                                         'You can use this multiple times.')
+    parser.add_argument('--input', action='append', help='Only outputs from this input file. You can use this multiple times.')
+    parser.add_argument('--to',    default='.',     help='Directory to extract into (default the current directory)')
+    parser.add_argument('--json',  action='store_true', help='List the manifest entries as JSON lines')
+    args = parser.parse_args()
+
+    entries = select_entries(load_entries(args.paths), args.name, args.input)
+    if not entries:
+        print("Nothing matched", file=sys.stderr)
+        sys.exit(1)
+
+    if args.command == 'list':
+        if args.json:
+            for entry in entries:
+                print(json.dumps(entry))
+        else:
+            print_entries(entries)
+    else:
+        sys.exit(1 if extract(entries, args.to) else 0)
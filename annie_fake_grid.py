@@ -0,0 +1,494 @@
+#!/bin/env python3
+
+'''
+Local stand-ins for the grid, so that annie_sam_wrap.sh and submit_annie_jobs.py can be run
+and timed without it.
+
+    annie_fake_grid.py setup DIR [options]
+
+makes a SAM project of synthetic files in DIR, a stub ToolAnalysis tarball whose Analyse
+just sleeps and writes outputs, and DIR/bin with ifdh, curl, singularity, jobsub_submit and
+jobsub_q all linked to this script. With ANNIE_FAKE_GRID=DIR set, annie_sam_wrap.sh uses the
+commands in DIR/bin and submit_annie_jobs.py uses the SAMWebClient here instead of samweb_client.
+
+    annie_fake_grid.py serve DIR [--port PORT]
+
+answers the SAM web API over HTTP on localhost for the project in DIR, so that anything that
+talks to it directly, like submit_annie_jobs.py status --base_uri, can be run against it too.
+
+The latencies and transfer rates in DIR/config.json are slept through and the big files are
+sparse, so large files and slow links can be simulated without the disk or the network.
+'''
+
+from __future__ import print_function
+from __future__ import division
+import os, sys, re
+import argparse
+import collections
+import fcntl
+import json
+import random
+import shutil
+import tarfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+default_config = {
+    'nfiles'          : 100,
+    'size_mb'         : 200.,
+    'size_spread'     : 0.5,   # sizes are spread uniformly by this fraction either side of size_mb
+    'events'          : 1000,
+    'fetch_mbps'      : 100.,
+    'copy_mbps'       : 50.,
+    'latency'         : {'sam' : 0.2, 'establishProcess' : 1., 'getNextFile' : 0.5, 'fetchInput' : 2., 'cp' : 1.},
+    'fetch_fail_rate' : 0.,
+    'sam_fail_rate'   : 0.,
+    'copy_fail_rate'  : 0.,
+    'analyse_sec'     : 10.,
+    'output_mb'       : 20.,
+    'seed'            : 1,
+}
+
+commands = ['ifdh', 'curl', 'singularity', 'jobsub_submit', 'jobsub_q']
+
+# files smaller than this are really copied, bigger ones are made sparse at the destination
+max_real_copy = 1024 * 1024
+
+FileInfo = collections.namedtuple('FileInfo', 'file_name file_id file_size event_count')
+
+def grid_dir():
+    path = os.getenv('ANNIE_FAKE_GRID')
+    if not path or not os.path.isfile(os.path.join(path, 'config.json')):
+        print("ANNIE_FAKE_GRID has to point at a directory made by annie_fake_grid.py setup", file=sys.stderr)
+        sys.exit(2)
+    return path
+
+def load_config(path):
+    with open(os.path.join(path, 'config.json')) as f:
+        return json.load(f)
+
+@contextmanager
+def locked(path):
+    '''
+    Several consumers share the project, so changes to it are made one at a time
+    '''
+    with open(os.path.join(path, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def read_lines(path):
+    if not os.path.isfile(path):
+        return []
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+def append_line(path, line):
+    with open(path, 'a') as f:
+        f.write(line + '\n')
+
+def make_sparse(path, size):
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+def transfer_time(config, operation, nbytes, mbps):
+    return config['latency'].get(operation, 0.) + nbytes / 1e6 / mbps
+
+#--------------------------------------------------------------------------------
+# Setting up
+#--------------------------------------------------------------------------------
+stub_analyse = '''#!/bin/bash
+# stand-in for ToolAnalysis: sleeps for every input file and writes an output for it
+conf_dir=`dirname $1`
+for f in `cat ${conf_dir}/my_files.txt`; do
+    sleep %(analyse_sec)s
+    name=`basename ${f}`
+    truncate -s %(output_bytes)d ana_${name%%.*}.root
+done
+'''
+
+def make_stub_tarball(path, config):
+    '''
+    A ToolAnalysis tarball with the Bench tool chain, which reads its inputs from my_files.txt
+    '''
+    stub_dir = os.path.join(path, 'ToolAnalysis')
+    conf_dir = os.path.join(stub_dir, 'configfiles', 'Bench')
+    os.makedirs(conf_dir)
+    os.makedirs(os.path.join(stub_dir, 'lib'))
+    with open(os.path.join(stub_dir, 'Analyse'), 'w') as f:
+        f.write(stub_analyse % {'analyse_sec' : config['analyse_sec'], 'output_bytes' : int(config['output_mb'] * 1e6)})
+    os.chmod(os.path.join(stub_dir, 'Analyse'), 0o755)
+    open(os.path.join(stub_dir, 'Setup.sh'), 'w').close()
+    with open(os.path.join(conf_dir, 'ToolChainConfig'), 'w') as f:
+        f.write('Inline -1\n')
+    open(os.path.join(conf_dir, 'my_files.txt'), 'w').close()
+
+    tarball = os.path.join(path, 'ToolAnalysis.tar.gz')
+    with tarfile.open(tarball, 'w:gz') as tar:
+        for name in sorted(os.listdir(stub_dir)):
+            tar.add(os.path.join(stub_dir, name), name)
+    shutil.rmtree(stub_dir)
+    return tarball
+
+def setup(path, config):
+    '''
+    Make a fresh fake grid in path
+    '''
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(os.path.join(path, 'bin'))
+    os.makedirs(os.path.join(path, 'files'))
+    with open(os.path.join(path, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=2)
+
+    me = os.path.abspath(__file__)
+    for command in commands:
+        os.symlink(me, os.path.join(path, 'bin', command))
+
+    rng = random.Random(config['seed'])
+    for ifile in range(config['nfiles']):
+        size = config['size_mb'] * (1 + config['size_spread'] * rng.uniform(-1, 1))
+        make_sparse(os.path.join(path, 'files', 'bench_%05d.dat' % ifile), int(size * 1e6))
+
+    start_project(path, 'fake_project')
+    return make_stub_tarball(path, config)
+
+def start_project(path, project):
+    with locked(path):
+        project_dir = os.path.join(path, 'project')
+        if os.path.exists(project_dir):
+            shutil.rmtree(project_dir)
+        os.makedirs(project_dir)
+        with open(os.path.join(project_dir, 'queue'), 'w') as f:
+            for name in sorted(os.listdir(os.path.join(path, 'files'))):
+                f.write(name + '\n')
+        with open(os.path.join(project_dir, 'name'), 'w') as f:
+            f.write(project)
+
+#--------------------------------------------------------------------------------
+# ifdh
+#--------------------------------------------------------------------------------
+def ifdh(argv):
+    path = grid_dir()
+    config = load_config(path)
+    project_dir = os.path.join(path, 'project')
+    command = argv[0] if argv else ''
+    args = argv[1:]
+
+    if command in ['establishProcess', 'getNextFile'] and random.random() < config['sam_fail_rate']:
+        time.sleep(config['latency'].get(command, 0.))
+        print("fake %s failure" % command, file=sys.stderr)
+        return 1
+
+    if command == 'establishProcess':
+        time.sleep(config['latency'].get('establishProcess', 0.))
+        with locked(path):
+            consumers = read_lines(os.path.join(project_dir, 'consumers'))
+            append_line(os.path.join(project_dir, 'consumers'), str(len(consumers) + 1))
+        print(len(consumers) + 1)
+
+    elif command == 'getNextFile':
+        time.sleep(config['latency'].get('getNextFile', 0.))
+        with locked(path):
+            queue = read_lines(os.path.join(project_dir, 'queue'))
+            if not queue:
+                return 0
+            with open(os.path.join(project_dir, 'queue'), 'w') as f:
+                f.write(''.join(name + '\n' for name in queue[1:]))
+            append_line(os.path.join(project_dir, 'status'), '%s %s delivered' % (args[1], queue[0]))
+        print('file://%s/files/%s' % (path, queue[0]))
+
+    elif command == 'fetchInput':
+        source = re.sub('^file://', '', args[0])
+        size = os.path.getsize(source)
+        time.sleep(transfer_time(config, 'fetchInput', size, config['fetch_mbps']))
+        if random.random() < config['fetch_fail_rate']:
+            print("fake fetchInput failure for %s" % source, file=sys.stderr)
+            return 1
+        local_dir = os.path.join(os.getenv('_CONDOR_JOB_IWD') or os.getenv('TMPDIR', '/tmp'), 'ifdh_fake')
+        if not os.path.isdir(local_dir):
+            os.makedirs(local_dir, exist_ok=True)
+        local = os.path.join(local_dir, os.path.basename(source))
+        make_sparse(local, size)
+        print(local)
+
+    elif command == 'updateFileStatus':
+        with locked(path):
+            append_line(os.path.join(project_dir, 'status'), '%s %s %s' % (args[1], os.path.basename(args[2]), args[3]))
+
+    elif command == 'cp':
+        pairs = []
+        if args[0] == '-f':
+            for line in read_lines(args[1]):
+                pairs.append(line.split()[:2])
+        else:
+            pairs.append([arg for arg in args if not arg.startswith('-')][:2])
+        size = sum(os.path.getsize(source) for source, dest in pairs if os.path.isfile(source))
+        time.sleep(transfer_time(config, 'cp', size, config['copy_mbps']))
+        if random.random() < config['copy_fail_rate']:
+            print("fake cp failure", file=sys.stderr)
+            return 1
+        for source, dest in pairs:
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if os.path.getsize(source) > max_real_copy:
+                make_sparse(dest, os.path.getsize(source))
+            else:
+                shutil.copyfile(source, dest)
+
+    elif command == 'mkdir_p':
+        os.makedirs(args[0], exist_ok=True)
+
+    elif command == 'rm':
+        if os.path.isfile(args[0]):
+            os.remove(args[0])
+
+    elif command not in ['endProcess', 'endProject', 'cleanup']:
+        print("fake ifdh does not know %s, ignoring it" % command, file=sys.stderr)
+    return 0
+
+#--------------------------------------------------------------------------------
+# curl, for the SAM web API
+#--------------------------------------------------------------------------------
+def project_summary(path, project=None):
+    '''
+    The summary SAM gives for the project. Any other project name gets the same counts.
+    '''
+    project_dir = os.path.join(path, 'project')
+    with locked(path):
+        statuses = {}
+        for line in read_lines(os.path.join(project_dir, 'status')):
+            consumer, name, status = line.split()
+            statuses[name] = status
+        remaining = len(read_lines(os.path.join(project_dir, 'queue')))
+        nconsumers = len(read_lines(os.path.join(project_dir, 'consumers')))
+
+    counts = collections.Counter(statuses.values())
+    in_flight = len([status for status in statuses.values() if status not in ['consumed', 'skipped']])
+    return {'project_name' : project or read_lines(os.path.join(project_dir, 'name'))[0],
+            'project_status' : 'running' if remaining or in_flight else 'ended complete',
+            'files_in_snapshot' : len(os.listdir(os.path.join(path, 'files'))),
+            'file_counts' : dict(counts),
+            'process_counts' : {'active' : nconsumers if in_flight or remaining else 0}}
+
+def sam_api(path, url):
+    '''
+    What the SAM web API answers to url
+    '''
+    config = load_config(path)
+    time.sleep(config['latency'].get('sam', 0.))
+    if 'findProject' in url:
+        return 'http://fake-sam/sam/annie/api/projects/annie/%s' % re.search('name=([^&]*)', url).group(1)
+    elif url.split('?')[0].endswith('/summary'):
+        project = re.search('/projects/name/([^/]*)/summary', url)
+        return json.dumps(project_summary(path, unquote(project.group(1)) if project else None))
+    elif url.split('?')[0].endswith('/metadata'):
+        name = url.split('/files/name/')[1].split('/')[0]
+        return json.dumps({'file_name' : name, 'file_size' : os.path.getsize(os.path.join(path, 'files', name)),
+                           'event_count' : config['events']})
+    return '{}'
+
+def curl(argv):
+    url = [arg for arg in argv if not arg.startswith('-')][-1]
+    print(sam_api(grid_dir(), url))
+    return 0
+
+class SAMHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = sam_api(self.server.grid, self.path).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_sam(path, port=0):
+    '''
+    Answer the SAM web API for the grid in path on localhost, from a background thread.
+    Returns the server and the base URI to give in place of IFDH_BASE_URI.
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', port), SAMHandler)
+    server.daemon_threads = True
+    server.grid = path
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d/sam/annie/api' % server.server_address[1]
+
+#--------------------------------------------------------------------------------
+# singularity
+#--------------------------------------------------------------------------------
+def singularity(argv):
+    '''
+    Run the command without a container. The bind mounts are faked by rewriting the paths
+    inside the container to the paths outside in the command, and in any script it's given.
+    '''
+    binds = {}
+    args = argv[1:]
+    while args and args[0].startswith('-'):
+        option = args.pop(0)
+        value = option[2:] if option.startswith('-B') and len(option) > 2 else None
+        if option in ['-B', '--bind']:
+            value = args.pop(0)
+        for bind in (value or '').split(','):
+            if ':' in bind:
+                # binds to the same path are kept so that paths under them are left alone
+                source, dest = bind.split(':')[:2]
+                binds[dest.rstrip('/')] = source
+    args = args[1:]  # the image
+
+    if any(source != dest for dest, source in binds.items()):
+        inside = re.compile('(?<![\\w.-])(%s)(?![\\w.-])' % '|'.join(re.escape(dest) for dest in sorted(binds, key=len, reverse=True)))
+        def outside(text):
+            return inside.sub(lambda match: binds[match.group(1)], text)
+
+        for iarg, arg in enumerate(args):
+            if arg.endswith('.sh') and os.path.isfile(arg):
+                with open(arg) as f:
+                    script = outside(f.read())
+                args[iarg] = arg + '.fake'
+                with open(args[iarg], 'w') as f:
+                    f.write(script)
+            else:
+                args[iarg] = outside(arg)
+
+    os.execvp(args[0], args)
+
+#--------------------------------------------------------------------------------
+# jobsub
+#--------------------------------------------------------------------------------
+def jobsub_submit(argv):
+    path = grid_dir()
+    with locked(path):
+        njobs = len(read_lines(os.path.join(path, 'jobsub.log')))
+        append_line(os.path.join(path, 'jobsub.log'), json.dumps(argv))
+    print("Use job id %d.0@fake-jobsub to retrieve output" % (njobs + 1))
+    return 0
+
+def jobsub_q(argv):
+    print("0 jobs; 0 completed, 0 removed, 0 idle, 0 running, 0 held, 0 suspended")
+    return 0
+
+#--------------------------------------------------------------------------------
+# samweb_client
+#--------------------------------------------------------------------------------
+class SAMWebClient(object):
+    '''
+    The parts of samweb_client.SAMWebClient that submit_annie_jobs.py uses, backed by the fake project
+    '''
+    def __init__(self, experiment=None):
+        self.path = grid_dir()
+        self.config = load_config(self.path)
+
+    def _wait(self):
+        time.sleep(self.config['latency'].get('sam', 0.))
+
+    def listFiles(self, dimensions=None, defname=None, fileinfo=False):
+        self._wait()
+        files_dir = os.path.join(self.path, 'files')
+        names = sorted(os.listdir(files_dir))
+        if dimensions and ' minus ' in dimensions:
+            consumed = set(line.split()[1] for line in read_lines(os.path.join(self.path, 'project', 'status'))
+                           if line.split()[2] == 'consumed')
+            names = [name for name in names if name not in consumed]
+        if not fileinfo:
+            return names
+        return [FileInfo(name, ifile, os.path.getsize(os.path.join(files_dir, name)), self.config['events'])
+                for ifile, name in enumerate(names)]
+
+    def countFiles(self, dimensions=None, defname=None):
+        return len(self.listFiles(dimensions=dimensions, defname=defname))
+
+    def startProject(self, project, defname=None, station=None, group=None, user=None):
+        self._wait()
+        start_project(self.path, project)
+        return {'project' : project, 'projectURL' : 'http://fake-sam/sam/annie/api/projects/annie/%s' % project}
+
+    def projectRecoveryDimension(self, project, useFileStatus=None, useProcessStatus=None):
+        return "snapshot_for_project_name %s minus (project_name %s and consumed_status consumed)" % (project, project)
+
+    def createDefinition(self, defname, dims, user=None, group=None, description=None):
+        self._wait()
+
+#--------------------------------------------------------------------------------
+def add_config_args(parser):
+    '''
+    The options that set what the fake grid is like, shared with annie_benchmark.py
+    '''
+    parser.add_argument('--nfiles',          type=int,   default=default_config['nfiles'],      help='Number of files in the SAM project (default %(default)s)')
+    parser.add_argument('--size_mb',         type=float, default=default_config['size_mb'],     help='Typical input file size in MB (default %(default)s)')
+    parser.add_argument('--size_spread',     type=float, default=default_config['size_spread'], help='Spread of the input sizes, as a fraction of --size_mb (default %(default)s)')
+    parser.add_argument('--fetch_mbps',      type=float, default=default_config['fetch_mbps'],  help='Rate that ifdh fetchInput gets input files at (default %(default)s)')
+    parser.add_argument('--copy_mbps',       type=float, default=default_config['copy_mbps'],   help='Rate that ifdh cp copies outputs at (default %(default)s)')
+    parser.add_argument('--latency',         action='append', metavar='OPERATION=SECONDS',
+                        help='Time taken by an operation on top of any transfer, for sam (curl and samweb), establishProcess, '\
+                             'getNextFile, fetchInput and cp. The defaults are %s' %
+                             ', '.join('%s=%g' % item for item in sorted(default_config['latency'].items())))
+    parser.add_argument('--fetch_fail_rate', type=float, default=0., help='Fraction of fetches that fail')
+    parser.add_argument('--copy_fail_rate',  type=float, default=0., help='Fraction of copies that fail')
+    parser.add_argument('--sam_fail_rate',   type=float, default=0., help='Fraction of establishProcess and getNextFile calls that fail')
+    parser.add_argument('--analyse_sec',     type=float, default=default_config['analyse_sec'], help='Seconds the stub Analyse takes per file (default %(default)s)')
+    parser.add_argument('--output_mb',       type=float, default=default_config['output_mb'],   help='Size of the output the stub Analyse writes for each file (default %(default)s)')
+    parser.add_argument('--seed',            type=int,   default=default_config['seed'],        help='Seed for the input sizes')
+
+def config_from_args(args):
+    config = dict(default_config)
+    config['latency'] = dict(default_config['latency'])
+    for key in config:
+        if key != 'latency' and getattr(args, key, None) is not None:
+            config[key] = getattr(args, key)
+    for latency in args.latency or []:
+        operation, seconds = latency.split('=')
+        config['latency'][operation] = float(seconds)
+    return config
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='annie_fake_grid.py setup', description='Make a fake grid to run annie_sam_wrap.sh '\
+                                     'and submit_annie_jobs.py against. Use it by setting ANNIE_FAKE_GRID to DIR.')
+    parser.add_argument('dir', help='Where to make it. Anything already there is removed.')
+    add_config_args(parser)
+    args = parser.parse_args(argv)
+
+    config = config_from_args(args)
+    tarball = setup(os.path.abspath(args.dir), config)
+    print("Made a fake grid with %d files in %s" % (config['nfiles'], args.dir))
+    print("The stub ToolAnalysis tarball is %s, with the tool chain Bench and my_files.txt as its input config" % tarball)
+    print("export ANNIE_FAKE_GRID=%s" % os.path.abspath(args.dir))
+    return 0
+
+def serve(argv):
+    parser = argparse.ArgumentParser(prog='annie_fake_grid.py serve', description='Answer the SAM web API for a fake grid on localhost '\
+                                     'until interrupted')
+    parser.add_argument('dir', help='A fake grid made by annie_fake_grid.py setup')
+    parser.add_argument('--port', type=int, default=0, help='Port to listen on (default any free one)')
+    args = parser.parse_args(argv)
+
+    if not os.path.isfile(os.path.join(args.dir, 'config.json')):
+        print("%s was not made by annie_fake_grid.py setup" % args.dir, file=sys.stderr)
+        return 2
+    server, base_uri = serve_sam(os.path.abspath(args.dir), args.port)
+    print("export IFDH_BASE_URI=%s" % base_uri)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+if __name__ == '__main__':
+    name = os.path.basename(sys.argv[0])
+    if name in commands:
+        sys.exit(globals()[name](sys.argv[1:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'setup':
+        sys.exit(main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        sys.exit(serve(sys.argv[2:]))
+    print("Usage: annie_fake_grid.py setup|serve DIR [options], or run it as one of %s" % ", ".join(commands), file=sys.stderr)
+    sys.exit(2)
@@ -0,0 +1,310 @@
+#!/bin/env python3
+
+'''
+A local store of the stage records that annie_sam_wrap.sh --stage_records copies
+back with the outputs, so that past jobs can be used to pick sites and resources.
+Record files are found in the destinations that submit_annie_jobs.py has sent
+jobs to, or can be added by hand with annie_job_stats.py --save.
+'''
+
+from __future__ import print_function
+from __future__ import division
+import os, sys, glob
+import fnmatch
+import json
+import sqlite3
+import time
+
+default_history = os.path.join(os.path.expanduser('~'), '.cache', 'annie_grid', 'job_history.sqlite')
+
+# jobs copy their records back well within this long of their directory being made,
+# so a directory that hasn't changed for this long won't get any more
+settle_days = 3
+
+schema = '''
+CREATE TABLE IF NOT EXISTS dests (
+    dest      TEXT PRIMARY KEY,
+    added     REAL
+);
+CREATE TABLE IF NOT EXISTS ingested (
+    path      TEXT PRIMARY KEY,
+    mtime     REAL
+);
+CREATE TABLE IF NOT EXISTS scanned (
+    dir       TEXT PRIMARY KEY,
+    mtime     REAL
+);
+CREATE TABLE IF NOT EXISTS records (
+    job       TEXT,
+    worker    INTEGER,
+    site      TEXT,
+    glidein   TEXT,
+    config    TEXT,
+    project   TEXT,
+    stage     TEXT,
+    start     REAL,
+    duration  REAL,
+    bytes     INTEGER,
+    exit_code INTEGER,
+    record    TEXT
+);
+CREATE INDEX IF NOT EXISTS records_stage ON records (stage, start);
+'''
+
+def open_history(path=default_history):
+    '''
+    Open the history, creating it if it's not there yet
+    '''
+    history_dir = os.path.dirname(path)
+    if history_dir and not os.path.isdir(history_dir):
+        os.makedirs(history_dir)
+    db = sqlite3.connect(path, timeout=60)
+    db.executescript(schema)
+    return db
+
+def add_dest(db, dest):
+    '''
+    Remember a destination so the records of the jobs sent there are picked up later
+    '''
+    with db:
+        db.execute('INSERT OR IGNORE INTO dests VALUES (?, ?)', (dest, time.time()))
+
+def ingest_file(db, path):
+    '''
+    Add the records in one stage record file, unless it's already in. Returns the number added.
+    '''
+    path = os.path.abspath(path)
+    mtime = os.path.getmtime(path)
+    row = db.execute('SELECT mtime FROM ingested WHERE path = ?', (path,)).fetchone()
+    if row and row[0] >= mtime:
+        return 0
+
+    rows = []
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            rows.append((record.get('job'), record.get('worker', 0), record.get('site') or 'unknown', record.get('glidein'),
+                         record.get('config'), record.get('project'), record.get('stage'), record.get('start'),
+                         record.get('duration'), record.get('bytes'), record.get('exit_code'), line.strip()))
+
+    with db:
+        # the file changed since last time, so replace what came from it
+        if row and rows:
+            db.execute('DELETE FROM records WHERE job = ? AND worker = ? AND project = ?', rows[0][0:2] + rows[0][5:6])
+        db.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        db.execute('INSERT OR REPLACE INTO ingested VALUES (?, ?)', (path, mtime))
+    return len(rows)
+
+def ingest(db, paths):
+    '''
+    Add all of the record files in the given files and directories
+    '''
+    nrecords = 0
+    for path in paths:
+        if os.path.isdir(path):
+            record_files = glob.glob(os.path.join(path, '**', 'stage_records*.jsonl'), recursive=True)
+        else:
+            record_files = [path]
+        for record_file in record_files:
+            try:
+                nrecords += ingest_file(db, record_file)
+            except (IOError, OSError) as e:
+                print("Warning: could not read %s: %s" % (record_file, e), file=sys.stderr)
+    return nrecords
+
+def new_record_files(db, dest):
+    '''
+    The record files in dest that could have changed since it was last looked at. Going
+    through every job directory in every destination on each submission would mean walking
+    /pnfs, so the directories in dest that have settled are remembered with their mtime and
+    only looked in again if that changes.
+    '''
+    now = time.time()
+    record_files = []
+    settled = []
+    for entry in os.scandir(dest):
+        if entry.is_file() and fnmatch.fnmatch(entry.name, 'stage_records*.jsonl'):
+            record_files.append(entry.path)
+        elif entry.is_dir():
+            path = os.path.abspath(entry.path)
+            mtime = entry.stat().st_mtime
+            row = db.execute('SELECT mtime FROM scanned WHERE dir = ?', (path,)).fetchone()
+            if row and row[0] == mtime:
+                continue
+            record_files += glob.glob(os.path.join(path, '**', 'stage_records*.jsonl'), recursive=True)
+            if now - mtime > settle_days * 86400:
+                settled.append((path, mtime))
+    return record_files, settled
+
+def update_history(db, max_age_days=90):
+    '''
+    Pick up any new records in the destinations that jobs were sent to recently
+    '''
+    since = time.time() - max_age_days * 86400
+    dests = [row[0] for row in db.execute('SELECT dest FROM dests WHERE added > ?', (since,))]
+    nrecords = 0
+    for dest in dests:
+        if not os.path.isdir(dest):
+            continue
+        try:
+            record_files, settled = new_record_files(db, dest)
+        except OSError as e:
+            print("Warning: could not look in %s: %s" % (dest, e), file=sys.stderr)
+            continue
+        nrecords += ingest(db, record_files)
+        # only once what was in them is in the history
+        with db:
+            db.executemany('INSERT OR REPLACE INTO scanned VALUES (?, ?)', settled)
+    return nrecords
+
+def percentile(values, pct):
+    '''
+    The pct percentile of a list, interpolating between the closest two values
+    '''
+    values = sorted(values)
+    if not values:
+        return None
+    pos = (len(values) - 1) * pct / 100.
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+def median(values):
+    return percentile(values, 50)
+
+def site_stats(db, config=None, days=30):
+    '''
+    Per site numbers from the last `days` days of jobs:
+      jobs         consumers that finished
+      files_per_h  median files per hour of those consumers
+      fetch_mbps   MB/s over all of the input fetches
+      skip_rate    fraction of files that were skipped
+      fail_rate    fraction of consumers that exited with an error
+    Only jobs that ran config are used if it's given.
+    '''
+    since = time.time() - days * 86400
+    selection = 'start > ?' + (' AND config = ?' if config else '')
+    params = (since, config) if config else (since,)
+
+    stats = {}
+    for site, duration, exit_code, record in db.execute('SELECT site, duration, exit_code, record FROM records '\
+                                                        "WHERE stage = 'consumer' AND " + selection, params):
+        record = json.loads(record)
+        site_stat = stats.setdefault(site, {'jobs' : 0, 'rates' : [], 'consumed' : 0, 'skipped' : 0, 'failed' : 0,
+                                            'fetch_bytes' : 0, 'fetch_time' : 0.})
+        site_stat['jobs'] += 1
+        site_stat['consumed'] += record.get('consumed', 0)
+        site_stat['skipped'] += record.get('skipped', 0)
+        if exit_code:
+            site_stat['failed'] += 1
+        if duration > 0:
+            site_stat['rates'].append(record.get('consumed', 0) / (duration / 3600.))
+
+    for site, nbytes, fetch_time in db.execute('SELECT site, SUM(bytes), SUM(duration) FROM records '\
+                                               "WHERE stage = 'fetchInput' AND exit_code = 0 AND " + selection + " GROUP BY site", params):
+        if site in stats:
+            stats[site]['fetch_bytes'] = nbytes or 0
+            stats[site]['fetch_time'] = fetch_time or 0.
+
+    for site_stat in stats.values():
+        nfiles = site_stat['consumed'] + site_stat['skipped']
+        site_stat['files_per_h'] = median(site_stat['rates'])
+        site_stat['fetch_mbps'] = site_stat['fetch_bytes'] / 1e6 / site_stat['fetch_time'] if site_stat['fetch_time'] > 0 else None
+        site_stat['skip_rate'] = site_stat['skipped'] / nfiles if nfiles else 0.
+        site_stat['fail_rate'] = site_stat['failed'] / site_stat['jobs']
+    return stats
+
+def rank_sites(stats, min_jobs=5, max_fail_rate=0.2, min_speed=0.25):
+    '''
+    Sort the sites with enough jobs into ones to use, best first, and ones to stay away from.
+    A site is avoided if too many of its jobs fail or files get skipped, or if it gets through
+    files at less than min_speed of the median rate over all of the sites.
+    Returns (good sites, bad sites with the reason, sites without enough jobs to tell).
+    '''
+    known = dict((site, stat) for site, stat in stats.items() if stat['jobs'] >= min_jobs and site != 'unknown')
+    unsure = sorted(site for site in stats if site not in known and site != 'unknown')
+    typical = median([stat['files_per_h'] for stat in known.values() if stat['files_per_h'] is not None])
+
+    good = []
+    bad = []
+    for site, stat in known.items():
+        if stat['fail_rate'] > max_fail_rate:
+            bad.append((site, '%.0f%% of jobs failed' % (100. * stat['fail_rate'])))
+        elif stat['skip_rate'] > max_fail_rate:
+            bad.append((site, '%.0f%% of files were skipped' % (100. * stat['skip_rate'])))
+        elif typical and stat['files_per_h'] is not None and stat['files_per_h'] < min_speed * typical:
+            bad.append((site, '%.1f files/h against %.1f typically' % (stat['files_per_h'], typical)))
+        else:
+            good.append(site)
+
+    # the best sites get through the most files, discounted by how often they lose them
+    good.sort(key=lambda site: -(known[site]['files_per_h'] or 0) * (1 - known[site]['skip_rate']) * (1 - known[site]['fail_rate']))
+    return good, sorted(bad), unsure
+
+def print_site_stats(stats, good=None, bad=None):
+    verdicts = dict((site, 'use') for site in good or [])
+    verdicts.update(dict((site, 'avoid: ' + reason) for site, reason in bad or []))
+
+    header = "%-28s %6s %10s %10s %8s %8s  %s" % ('site', 'jobs', 'files/h', 'fetch MB/s', 'skipped', 'failed', '')
+    print(header)
+    print("-" * len(header))
+    order = (good or []) + [site for site in sorted(stats) if site not in (good or [])]
+    for site in order:
+        stat = stats[site]
+        print("%-28s %6d %10s %10s %7.1f%% %7.1f%%  %s" %
+              (site, stat['jobs'], '' if stat['files_per_h'] is None else '%.1f' % stat['files_per_h'],
+               '' if stat['fetch_mbps'] is None else '%.1f' % stat['fetch_mbps'],
+               100. * stat['skip_rate'], 100. * stat['fail_rate'], verdicts.get(site, '')))
+
+def resource_samples(db, config, days=90):
+    '''
+    What each consumer that ran config and finished cleanly used, for sizing new jobs:
+      rss_mb           peak memory of the job, split between its workers
+      base_scratch_mb  scratch used before the first file, ie. ToolAnalysis and the rest
+      scratch_per_file scratch used on top of that for each file run over
+      sec_per_file     wall time per file
+      setup_sec        time from the start of the job until the consumer started
+    '''
+    since = time.time() - days * 86400
+    samples = {'rss_mb' : [], 'base_scratch_mb' : [], 'scratch_per_file' : [], 'sec_per_file' : [], 'setup_sec' : []}
+    for duration, record in db.execute("SELECT duration, record FROM records WHERE stage = 'consumer' AND exit_code = 0 "\
+                                       "AND config = ? AND start > ?", (config, since)):
+        record = json.loads(record)
+        nfiles = record.get('consumed', 0) + record.get('skipped', 0)
+        if nfiles == 0:
+            continue
+
+        if record.get('peak_rss_mb'):
+            samples['rss_mb'].append(record['peak_rss_mb'] / max(1, record.get('workers', 1)))
+        if record.get('peak_scratch_mb'):
+            samples['base_scratch_mb'].append(record.get('base_scratch_mb', 0))
+            # scratch is for the whole job, so it's shared between the workers
+            scratch = max(0, record['peak_scratch_mb'] - record.get('base_scratch_mb', 0))
+            samples['scratch_per_file'].append(scratch / (nfiles * max(1, record.get('workers', 1))))
+        samples['sec_per_file'].append(duration / nfiles)
+        samples['setup_sec'].append(record.get('setup_sec', 0))
+    return samples
+
+def suggest_resources(samples, files_per_consumer, workers=1, pct=95, min_jobs=5):
+    '''
+    Memory and disk in MB and lifetime in seconds that pct percent of past jobs would have fit
+    in, scaled to files_per_consumer files for each of the workers. Each one is None if there
+    aren't at least min_jobs jobs to go by. Memory and disk get 10% extra, the lifetime 20%.
+    '''
+    def enough(key):
+        return len(samples[key]) >= min_jobs
+
+    suggestion = {'memory' : None, 'disk' : None, 'lifetime' : None, 'jobs' : len(samples['sec_per_file'])}
+    if enough('rss_mb'):
+        suggestion['memory'] = int(-(-percentile(samples['rss_mb'], pct) * workers * 1.1 // 100) * 100)
+    if enough('scratch_per_file'):
+        # every worker has its own files on top of the same base
+        disk = percentile(samples['base_scratch_mb'], pct) + percentile(samples['scratch_per_file'], pct) * files_per_consumer * workers
+        suggestion['disk'] = int(-(-disk * 1.1 // 100) * 100)
+    if enough('sec_per_file') and files_per_consumer > 0:
+        lifetime = percentile(samples['setup_sec'], pct) + percentile(samples['sec_per_file'], pct) * files_per_consumer
+        suggestion['lifetime'] = int(-(-lifetime * 1.2 // 600) * 600)
+    return suggestion
@@ -0,0 +1,231 @@
+#!/bin/env python3
+
+from __future__ import print_function
+from __future__ import division
+import os, sys, glob
+import argparse
+import json
+from collections import defaultdict
+import annie_job_history
+
+# The order the stages happen in for each file
+stage_order = ['establishProcess', 'getNextFile', 'fetchInput', 'container_start', 'Analyse', 'rename', 'bundle', 'copy_out', 'consumer']
+
+def find_record_files(paths, pattern='stage_records*.jsonl'):
+    '''
+    Expand the given files and directories into the list of stage record files,
+    or of the files matching pattern
+    '''
+    record_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            record_files += sorted(glob.glob(os.path.join(path, '**', pattern), recursive=True))
+        elif os.path.isfile(path):
+            record_files.append(path)
+        else:
+            print("Warning: %s does not exist, skipping it" % path, file=sys.stderr)
+    return record_files
+
+def load_records(record_files, args):
+    '''
+    Read all of the records, keeping the ones that pass the --config, --project and --stage selections
+    '''
+    records = []
+    for record_file in record_files:
+        with open(record_file) as f:
+            for iline, line in enumerate(f):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a job that was killed part way through a write can leave half a line behind
+                    print("Warning: skipping bad record on line %d of %s" % (iline + 1, record_file), file=sys.stderr)
+                    continue
+
+                if args.config and record.get('config') != args.config:
+                    continue
+                if args.project and record.get('project') != args.project:
+                    continue
+                if args.stage and record.get('stage') not in args.stage:
+                    continue
+                records.append(record)
+    return records
+
+def percentile(values, pct):
+    '''
+    The pct percentile of a sorted list, interpolating between the closest two values
+    '''
+    if not values:
+        return float('nan')
+    pos = (len(values) - 1) * pct / 100.
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+def sorted_stages(stages):
+    '''
+    Known stages in the order they happen, then anything else alphabetically
+    '''
+    return sorted(stages, key=lambda stage: (stage_order.index(stage) if stage in stage_order else len(stage_order), stage))
+
+def group_durations(records, key):
+    '''
+    Durations grouped by (value of key, stage), along with the bytes moved and the
+    number of failures in each group. With no key everything is grouped by stage only.
+    '''
+    durations = defaultdict(list)
+    nbytes = defaultdict(int)
+    failures = defaultdict(int)
+    for record in records:
+        group = ((record.get(key) or 'unknown') if key else 'all', record['stage'])
+        durations[group].append(record['duration'])
+        nbytes[group] += record.get('bytes', 0)
+        if record.get('exit_code', 0) != 0:
+            failures[group] += 1
+
+    for group in durations:
+        durations[group].sort()
+    return durations, nbytes, failures
+
+def print_stage_table(records, percentiles):
+    '''
+    One line per stage with the percentiles of how long it took, over all jobs
+    '''
+    durations, nbytes, failures = group_durations(records, None)
+
+    # the consumer records cover everything else, so leave them out of the share of time
+    total_time = sum(sum(values) for (group, stage), values in durations.items() if stage != 'consumer')
+
+    header = "%-16s %8s" % ('stage', 'count')
+    header += "".join(" %9s" % ('p%g' % pct) for pct in percentiles)
+    header += " %9s %9s %6s %7s %8s" % ('max', 'total h', 'share', 'failed', 'MB/s')
+    print(header)
+    print("-" * len(header))
+    for stage in sorted_stages(stage for group, stage in durations):
+        values = durations[('all', stage)]
+        line = "%-16s %8d" % (stage, len(values))
+        line += "".join(" %9.2f" % percentile(values, pct) for pct in percentiles)
+        share = '' if stage == 'consumer' or not total_time else '%5.1f%%' % (100. * sum(values) / total_time)
+        rate = '' if not nbytes[('all', stage)] or not sum(values) else '%8.1f' % (nbytes[('all', stage)] / 1e6 / sum(values))
+        line += " %9.2f %9.2f %6s %7d %8s" % (values[-1], sum(values) / 3600., share, failures[('all', stage)], rate)
+        print(line)
+
+def print_site_tables(records, percentiles):
+    '''
+    For each stage, one line per site with the percentiles of how long it took there
+    '''
+    durations, nbytes, failures = group_durations(records, 'site')
+    sites = sorted(set(site for site, stage in durations))
+    stages = sorted_stages(set(stage for site, stage in durations))
+
+    for stage in stages:
+        print("")
+        header = "%-24s %8s" % (stage, 'count')
+        header += "".join(" %9s" % ('p%g' % pct) for pct in percentiles)
+        header += " %9s %7s %8s" % ('max', 'failed', 'MB/s')
+        print(header)
+        print("-" * len(header))
+        for site in sites:
+            values = durations.get((site, stage))
+            if not values:
+                continue
+            line = "%-24s %8d" % (site, len(values))
+            line += "".join(" %9.2f" % percentile(values, pct) for pct in percentiles)
+            rate = '' if not nbytes[(site, stage)] or not sum(values) else '%8.1f' % (nbytes[(site, stage)] / 1e6 / sum(values))
+            line += " %9.2f %7d %8s" % (values[-1], failures[(site, stage)], rate)
+            print(line)
+
+def print_peak_memory(sample_files, nshow):
+    '''
+    The runs of Analyse that used the most memory, from the samples the watchdog takes
+    '''
+    runs = []
+    for sample_file in sample_files:
+        with open(sample_file) as f:
+            for line in f:
+                if line.strip():
+                    run = json.loads(line)
+                    if 'peak_rss_mb' in run:
+                        runs.append(run)
+    runs.sort(key=lambda run: -run['peak_rss_mb'])
+
+    header = "%9s %8s %8s %-14s %-30s %s" % ('peak MB', 'at s', 'max CPU%', 'stopped', 'job', 'file')
+    print(header)
+    print("-" * len(header))
+    for run in runs[:nshow]:
+        at = run['t'][run['rss_mb'].index(run['peak_rss_mb'])] if run['peak_rss_mb'] in run['rss_mb'] else 0
+        print("%9d %8d %8d %-14s %-30s %s" % (run['peak_rss_mb'], at, max(run['cpu_pct'] or [0]), run.get('stopped') or '',
+                                             '%s/%s' % (run['job'], run['worker']), run['file']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the stage records written by annie_sam_wrap.sh --stage_records. '\
+                                     'Prints how long each stage took over all jobs and then broken down by site, '\
+                                     'with all times in seconds.')
+    parser.add_argument('paths', nargs='*', default=['.'],
+                        help='Record files, or directories to search for stage_records*.jsonl (default is the current directory). '\
+                             'This is usually the --dest of the jobs.')
+    parser.add_argument('--percentiles', default='50,90,99', help='Comma separated list of percentiles to show (default 50,90,99)')
+    parser.add_argument('--stage',   action='append',         help='Only show this stage. You can use this multiple times.')
+    parser.add_argument('--config',                           help='Only use records from jobs that ran this tool chain config')
+    parser.add_argument('--project',                          help='Only use records from this SAM project')
+    parser.add_argument('--by', choices=['stage', 'site', 'both'], default='both',
+                        help='Which tables to print (default both)')
+    parser.add_argument('--save',          action='store_true', help='Add the records to the history that submit_annie_jobs.py --auto_sites uses')
+    parser.add_argument('--site_ranking',  action='store_true', help='Show how submit_annie_jobs.py --auto_sites would rank the sites, '\
+                                                                     'using the history rather than the given records')
+    parser.add_argument('--history',       default=annie_job_history.default_history,
+                        help='History file to use with --save and --site_ranking (default %s)' % annie_job_history.default_history)
+    parser.add_argument('--peak_memory',   type=int, metavar='N', help='Instead of the stage tables, show the N runs of Analyse that used the most '\
+                                                                     'memory, from the resource_samples*.jsonl the watchdog writes')
+    args = parser.parse_args()
+
+    if args.peak_memory:
+        sample_files = find_record_files(args.paths, 'resource_samples*.jsonl')
+        if not sample_files:
+            print("Error: no resource samples found in %s" % " ".join(args.paths), file=sys.stderr)
+            sys.exit(1)
+        print_peak_memory(sample_files, args.peak_memory)
+        sys.exit(0)
+
+    if args.site_ranking:
+        history = annie_job_history.open_history(args.history)
+        annie_job_history.update_history(history)
+        stats = annie_job_history.site_stats(history, config=args.config)
+        if not stats:
+            print("Error: there are no jobs in %s" % args.history, file=sys.stderr)
+            sys.exit(1)
+        good_sites, bad_sites, unsure_sites = annie_job_history.rank_sites(stats)
+        annie_job_history.print_site_stats(stats, good_sites, bad_sites)
+        sys.exit(0)
+
+    try:
+        percentiles = [float(pct) for pct in args.percentiles.split(',')]
+    except ValueError:
+        print("Error: --percentiles should be a comma separated list of numbers", file=sys.stderr)
+        sys.exit(1)
+
+    record_files = find_record_files(args.paths)
+    if not record_files:
+        print("Error: no stage records found in %s" % " ".join(args.paths), file=sys.stderr)
+        sys.exit(1)
+
+    if args.save:
+        nnew = annie_job_history.ingest(annie_job_history.open_history(args.history), record_files)
+        print("Added %d new records to %s" % (nnew, args.history))
+
+    records = load_records(record_files, args)
+    if not records:
+        print("Error: no records passed the selection", file=sys.stderr)
+        sys.exit(1)
+
+    njobs = len(set((record.get('job'), record.get('worker')) for record in records))
+    nsites = len(set(record.get('site') for record in records))
+    print("%d records from %d consumers at %d sites in %d files" % (len(records), njobs, nsites, len(record_files)))
+
+    if args.by in ['stage', 'both']:
+        print("")
+        print_stage_table(records, percentiles)
+    if args.by in ['site', 'both']:
+        print_site_tables(records, percentiles)
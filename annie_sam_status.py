@@ -0,0 +1,221 @@
+#!/bin/env python3
+
+from __future__ import print_function
+from __future__ import division
+import os, sys, ssl
+import argparse
+import datetime
+import json
+import time
+from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+from urllib.parse import quote
+
+default_base_uri = "https://samannie.fnal.gov:8483/sam/annie/api"
+default_cache = os.path.join(os.path.expanduser('~'), '.cache', 'annie_grid', 'sam_status.json')
+
+# Projects in these states won't change any more so there's no need to ask again
+finished_states = ['completed', 'ended', 'ended complete', 'ended incomplete']
+
+def ssl_context():
+    '''
+    SAM uses the grid CAs, which aren't in the usual system bundle
+    '''
+    if os.path.isdir('/etc/grid-security/certificates'):
+        return ssl.create_default_context(capath='/etc/grid-security/certificates')
+    return ssl.create_default_context()
+
+def fetch_summary(base_uri, project, timeout=30):
+    '''
+    Get the summary of a SAM project, the same one that the wrapper looks at when it's cleaning up
+    '''
+    url = "%s/projects/name/%s/summary?format=json" % (base_uri.rstrip('/'), quote(project))
+    context = ssl_context() if url.startswith('https') else None
+    response = urlopen(url, timeout=timeout, context=context)
+    try:
+        return json.loads(response.read().decode('utf-8'))
+    finally:
+        response.close()
+
+def load_cache(cache_file):
+    if not os.path.isfile(cache_file):
+        return {}
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except ValueError:
+        print("Warning: ignoring the corrupt cache in %s" % cache_file, file=sys.stderr)
+        return {}
+
+def save_cache(cache, cache_file):
+    cache_dir = os.path.dirname(cache_file)
+    if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_file, cache_file)
+
+def is_fresh(entry, min_interval, now):
+    '''
+    Whether a cached summary is recent enough that SAM shouldn't be asked again
+    '''
+    if entry['summary'].get('project_status') in finished_states:
+        return True
+    return now - entry['fetched'] < min_interval
+
+def get_summaries(projects, base_uri, cache, min_interval=60, threads=8, force=False):
+    '''
+    Get the summaries of all of the projects, asking SAM for up to `threads` of them at
+    once. Projects that were asked about less than min_interval seconds ago come from the
+    cache instead. Returns {project : (cache entry or None, error)}, where the cache entry
+    has the summary, when it was fetched, and the entry from the poll before that.
+    '''
+    now = time.time()
+    to_fetch = [project for project in projects
+                if force or project not in cache or not is_fresh(cache[project], min_interval, now)]
+
+    def fetch(project):
+        try:
+            return fetch_summary(base_uri, project), None
+        except Exception as e:
+            return None, str(e)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(threads, len(to_fetch)))) as pool:
+        for project, (summary, error) in zip(to_fetch, pool.map(fetch, to_fetch)):
+            results[project] = (summary, error)
+
+    summaries = {}
+    for project in projects:
+        previous = cache.get(project)
+        if project not in results:
+            summaries[project] = (previous, None)
+            continue
+
+        summary, error = results[project]
+        if summary is None:
+            # fall back on whatever we had before
+            summaries[project] = (previous, error)
+            continue
+
+        # the previous poll is kept so the recent rate can be worked out
+        last = {'fetched' : previous['fetched'], 'summary' : previous['summary']} if previous else None
+        cache[project] = {'fetched' : now, 'summary' : summary, 'previous' : last}
+        summaries[project] = (cache[project], None)
+
+    return summaries
+
+def parse_time(value):
+    '''
+    SAM gives times like 2024-01-31T12:34:56+00:00
+    '''
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+def file_counts(summary):
+    '''
+    Consumed, skipped and remaining files in a project, along with the total
+    '''
+    counts = summary.get('file_counts') or {}
+    total = summary.get('files_in_snapshot') or 0
+    consumed = counts.get('consumed', 0)
+    skipped = counts.get('skipped', 0) + counts.get('failed', 0)
+    return consumed, skipped, max(0, total - consumed - skipped), total
+
+def files_per_hour(entry):
+    '''
+    Files consumed per hour over the whole project, and between the last two polls if there were two
+    '''
+    summary = entry['summary']
+    consumed = file_counts(summary)[0]
+    start = parse_time(summary.get('start_time'))
+    end = parse_time(summary.get('end_time')) or entry['fetched']
+    overall = consumed / ((end - start) / 3600.) if start and end > start else None
+
+    recent = None
+    previous = entry.get('previous')
+    if previous and summary.get('start_time') == previous['summary'].get('start_time') and entry['fetched'] > previous['fetched']:
+        recent = (consumed - file_counts(previous['summary'])[0]) / ((entry['fetched'] - previous['fetched']) / 3600.)
+
+    return overall, recent
+
+def print_status(projects, summaries):
+    header = "%-45s %-18s %7s %9s %8s %10s %7s %10s %10s" % ('project', 'status', 'active', 'consumed', 'skipped',
+                                                             'remaining', 'done', 'files/h', 'recent/h')
+    print(header)
+    print("-" * len(header))
+    for project in projects:
+        entry, error = summaries[project]
+        if entry is None:
+            print("%-45s could not get the summary: %s" % (project, error))
+            continue
+
+        summary = entry['summary']
+        consumed, skipped, remaining, total = file_counts(summary)
+        overall, recent = files_per_hour(entry)
+        active = (summary.get('process_counts') or {}).get('active', 0)
+        done = "%6.1f%%" % (100. * (consumed + skipped) / total) if total else ''
+        print("%-45s %-18s %7s %9d %8d %10d %7s %10s %10s" %
+              (project, summary.get('project_status', 'unknown'), active, consumed, skipped, remaining, done,
+               '' if overall is None else '%.1f' % overall, '' if recent is None else '%.1f' % recent))
+        if error:
+            print("    (cached, the last query failed: %s)" % error)
+
+def project_names(names):
+    '''
+    Project names can be given directly or as the campaign state files from submit_annie_jobs.py
+    '''
+    projects = []
+    for name in names:
+        if name.endswith('.campaign.json') and os.path.isfile(name):
+            with open(name) as f:
+                name = json.load(f)['project_name']
+        if name not in projects:
+            projects.append(name)
+    return projects
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='submit_annie_jobs.py status',
+                                     description='Show how far along SAM projects are. Projects are queried in parallel '\
+                                     'and the answers are cached so that SAM is not asked about the same project more than '\
+                                     'once every --min_interval seconds.')
+    parser.add_argument('projects', nargs='+', metavar='PROJECT', help='SAM project names, or <project>.campaign.json files from --campaign')
+    parser.add_argument('--base_uri',     default=os.getenv('IFDH_BASE_URI', default_base_uri),
+                        help='SAM web API to ask (default $IFDH_BASE_URI or %s)' % default_base_uri)
+    parser.add_argument('--threads',      type=int, default=8,   help='Number of projects to ask about at once (default 8)')
+    parser.add_argument('--min_interval', type=int, default=60,  help='Use the cached summary if it is younger than this many seconds (default 60)')
+    parser.add_argument('--cache',        default=default_cache, help='Where to keep the cached summaries (default %s)' % default_cache)
+    parser.add_argument('--force',        action='store_true',   help='Ask SAM about every project, even if the cached summary is recent')
+    parser.add_argument('--watch',        type=int, metavar='SECONDS', help='Keep printing the status every SECONDS seconds until all projects are finished')
+    args = parser.parse_args(argv)
+
+    if args.watch is not None and args.watch < args.min_interval:
+        print("Warning: --watch is shorter than --min_interval, so the cached summaries will be shown in between", file=sys.stderr)
+
+    projects = project_names(args.projects)
+    while True:
+        cache = load_cache(args.cache)
+        summaries = get_summaries(projects, args.base_uri, cache, args.min_interval, args.threads, args.force)
+        save_cache(cache, args.cache)
+
+        print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        print_status(projects, summaries)
+
+        if args.watch is None:
+            break
+        if all(entry and entry['summary'].get('project_status') in finished_states for entry, error in summaries.values()):
+            print("All projects are finished")
+            break
+        print("")
+        sleep(args.watch)
+
+    return 0 if all(error is None for entry, error in summaries.values()) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,9 +14,14 @@ fi
 hostname
 uname -a
 ls /lib*/libc-*.so
+job_start=`date +%s`
+
+toolanalysis_image="/cvmfs/singularity.opensciencegrid.org/anniesoft/toolanalysis:latest/"
 
 # initialize options with blank
 tarball=""
+tarball_hash=""
+tarball_cache=""
 conf=""
 limit=""
 nevts=""
@@ -27,14 +32,40 @@ topDir=""
 rename_outputs=false
 job_dirs=false
 quick_copy=false
+persistent_container=false
 self_destruct_timeout=""
+self_destruct_grace=600
+watchdog_interval=0
+file_memory_limit=""
+file_time_limit=""
 earlysources=""
 earlyscripts=""
 sources=""
 prescripts=""
 postscripts=""
+prefetch=0
+disk_budget=""
+files_per_invocation=1
+workers=1
+workTag=""
+copy_streams=0
+copy_retries=3
+bundle_outputs=false
+bundle_max_mb=0
+sam_retries=10
+fetch_retries=3
+retry_base=5
+retry_max=300
+alternate_uri=""
+cost_metric="bytes"
+cost_budget=""
+job_cost=0
+stage_records=false
+dynamic_lifetime=""
+job_lifetime=""
 
 n_max_files_skipped=1
+n_max_fetch_failures=3
 dest_updated=false
 
 #
@@ -56,7 +87,18 @@ Usage:
         Print this message and exit
 
     -t|--tarball ball
-        Your ToolAnalysis tarball
+        Your ToolAnalysis tarball. It can be compressed with gzip or zstd, or not at all.
+
+    --tarball_hash hash
+        sha256 of the tarball, used to find it in --tarball_cache
+
+    --tarball_cache directory
+        a directory local to the node where the tarball is unpacked under its hash.
+        It should be on the same filesystem as the job scratch directory so that
+        jobs can hard link it instead of copying it.
+        Later jobs on the same node with the same tarball use it from there instead
+        of unpacking it again. Needs --tarball_hash. It is only used if it belongs
+        to the user running the job.
 
     -c|--config directory
         toolchain config to use
@@ -65,6 +107,30 @@ Usage:
     -L|--limit NN
         Pass a number of files limit to establishProcess.
 
+    --sam_retries N
+        number of times to try establishProcess and getNextFile before giving up (default 10)
+
+    --fetch_retries N
+        number of times to try fetching each input file. A file that still can't be fetched
+        is marked as skipped, and the job only stops after ${n_max_fetch_failures} of them in a row. (default 3)
+
+    --retry_base seconds
+    --retry_max seconds
+        before the Nth retry of any of these, wait a random time of up to retry_base * 2^(N-1)
+        seconds, but no more than retry_max, so that jobs that start together spread out
+        rather than retrying in step. The consumer also waits up to retry_base seconds before
+        it first asks SAM for anything. (defaults 5 and 300)
+
+    --alternate_uri pattern=replacement
+        on every other retry of a fetch, fetch from the URI with pattern replaced by
+        replacement instead, eg. another door or protocol for the same file
+
+    --cost_budget N
+        stop asking SAM for files once this consumer has run over N bytes or events
+
+    --cost_metric bytes|events
+        what --cost_budget counts. Event counts come from the SAM metadata. (default bytes)
+
     -n|--nevents N
         how many events to run over per file
 
@@ -80,7 +146,9 @@ Usage:
         optional script to copy outputs to the final destination. 
 
     -r|--rename_outputs
-        rename the output files by prepending the input file name or job and file number
+        rename the output files by prepending the input file name or job and file number.
+        With --files_per_invocation the first and last input file names are prepended
+        and the whole batch is listed in <first>_to_<last>.inputs.txt.
 
     -j|--job_dirs
         make destination directories based on the job numbers.
@@ -88,11 +156,79 @@ Usage:
     -q|--quick_copy
         copy out files as soon as they're ready rather than waiting until the end of the job
 
+    --copy_streams N
+        copy outputs out in batches with "ifdh cp -f", running up to N copies at once.
+        With quick copy these run in the background while the next file is processed.
+
+    --copy_retries N
+        number of times to try each batch of outputs before giving up on it (default 3)
+
+    --bundle_outputs
+        pack the outputs into uncompressed tar files, bundle.<job>.<n>.tar, and copy those
+        out instead of every output on its own. A manifest, bundle_manifest.<job>.jsonl, with
+        the original name, input files, bundle, and position of every output is copied out
+        with them at the end. annie_bundle.py lists and extracts files using the manifest.
+
+    --bundle_max_mb MB
+        start a new bundle once the current one would go over MB. With --quick_copy each
+        bundle is copied out once it's full. (default 0, one bundle for the whole job)
+
+    -s|--persistent_container
+        start one container session for the whole job and run Analyse for each file
+        inside of it, rather than starting a new container for every file
+
+    -b|--files_per_invocation N
+        write up to N input files into the input_file_config and run Analyse once over
+        all of them. Only works when there is no input_config_var.
+
+    -w|--workers N
+        run N SAM consumers side by side, each with their own copy of ToolAnalysis.
+        Without --rename_outputs each worker copies out to its own worker_<n> directory.
+
+    -p|--prefetch N
+        fetch up to N input files ahead in the background while the current one is processed
+
+    --disk_budget MB
+        scratch disk requested for the job. Prefetching will not fetch more files
+        than fit in this budget. If not given, the free space on the node is used.
+
+    --stage_records
+        write a JSON line for every stage of every file (establishProcess, getNextFile, fetchInput, container
+        startup, Analyse, renaming, bundling, copy out) with how long it took, and copy them out
+        alongside the outputs as stage_records.<job>.jsonl
+
+    --dynamic_lifetime seconds
+        stop asking SAM for files once the time left in the job is less than the
+        expected time to run over another file and copy everything out, plus this
+        many seconds to spare. The expected times are updated as the job goes.
+
+    --job_lifetime seconds
+        the lifetime requested for the job. If the job would run over this before the
+        glidein goes away (FIFE_GLIDEIN_ToDie) then this is what --dynamic_lifetime uses.
 
     --self_destruct_timer seconds
-        suicide if the executable runs more than seconds seconds;
-        usually only use this if you have jobs that hang and you
-        get no output back
+        once the job has run for this many seconds, stop Analyse, skip the files it was
+        running over, and don't ask for any more. Whatever is done is still copied out.
+        Usually only use this if you have jobs that hang and you get no output back.
+
+    --self_destruct_grace seconds
+        once past the --self_destruct_timer, anything the job runs that has been going for
+        longer than this, eg. a stuck getNextFile, fetch or copy, is killed (default ${self_destruct_grace})
+
+    --watchdog_interval seconds
+        every this many seconds while Analyse runs, sample the memory, CPU and scratch disk
+        it uses. Each run of Analyse gets a line with the samples in
+        resource_samples.<job>.jsonl, which is copied out with the stage records.
+        (default 0, off, or 10 if any of the limits are given)
+
+    --file_memory_limit MB
+        stop Analyse if everything it's running uses more than MB of memory, skip the
+        files it was running over, and carry on with the next ones
+
+    --file_time_limit seconds
+        stop Analyse if it's still running this many seconds per file after it started,
+        skip the files it was running over, and carry on with the next ones.
+        The limits are checked every --watchdog_interval.
 	
     --earlysource file:arg:arg:...
     --earlyscript file:arg:arg:...
@@ -102,12 +238,16 @@ Usage:
         source/execute the file. These are performed in the order above. 
 	prescript and earlier are before ups. postscript is after processing all files, but before copying out.
 
+    If ANNIE_FAKE_GRID is set to a directory made by "annie_fake_grid.py setup", the
+    stand-ins for ifdh, curl and singularity in it are used instead of the real ones and
+    cvmfs isn't needed. This is how annie_benchmark.py runs the wrapper.
+
 
 
 EOF
 }
 
-VALID_ARGS=$(getopt -o hrjqc:t:L:n:i:v:o: --long help,rename_outputs,job_dirs,quick_copy,config:,tarball:,limit:,nevents:,input_file_config:,input_config_var:,copy_out_script:,self_destruct_timer:,earlysource:,earlyscript:,source:,prescript: -- "$@")
+VALID_ARGS=$(getopt -o hrjqsc:t:L:n:i:v:o:p:b:w: --long help,rename_outputs,job_dirs,quick_copy,persistent_container,stage_records,bundle_outputs,prefetch:,files_per_invocation:,workers:,copy_streams:,copy_retries:,bundle_max_mb:,sam_retries:,fetch_retries:,retry_base:,retry_max:,alternate_uri:,cost_budget:,cost_metric:,disk_budget:,dynamic_lifetime:,job_lifetime:,config:,tarball:,tarball_hash:,tarball_cache:,limit:,nevents:,input_file_config:,input_config_var:,copy_out_script:,self_destruct_timer:,self_destruct_grace:,watchdog_interval:,file_memory_limit:,file_time_limit:,earlysource:,earlyscript:,source:,prescript: -- "$@")
 if [[ $? -ne 0 ]]; then
     exit 1;
 fi
@@ -120,14 +260,39 @@ while [ : ]; do
 	-r|--rename_outputs)    rename_outputs=true;  shift; continue;;
 	-j|--job_dirs)          job_dirs=true;        shift; continue;;
 	-q|--quick_copy)        quick_copy=true;      shift; continue;;
+	-s|--persistent_container) persistent_container=true; shift; continue;;
+	--stage_records)        stage_records=true;   shift; continue;;
+	--bundle_outputs)       bundle_outputs=true;  shift; continue;;
 	-c|--config)            conf="$2";    shift;  shift; continue;;
 	-t|--tarball)           tarball="$2"; shift;  shift; continue;;
+	--tarball_hash)         tarball_hash="$2";     shift; shift; continue;;
+	--tarball_cache)        tarball_cache="$2";    shift; shift; continue;;
 	-L|--limit)             limit="$2";   shift;  shift; continue;;
+	--sam_retries)          sam_retries="$2";      shift; shift; continue;;
+	--fetch_retries)        fetch_retries="$2";    shift; shift; continue;;
+	--retry_base)           retry_base="$2";       shift; shift; continue;;
+	--retry_max)            retry_max="$2";        shift; shift; continue;;
+	--alternate_uri)        alternate_uri="$2";    shift; shift; continue;;
 	-n|--nevents)           nevts="$2";   shift;  shift; continue;;
 	-i|--input_file_config) ifconf="$2";  shift;  shift; continue;;
 	-v|--input_config_var)  ivar="$2";    shift;  shift; continue;;
 	-o|--copy_out_script)   cpsc="$2";    shift;  shift; continue;;
+	-p|--prefetch)          prefetch="$2"; shift; shift; continue;;
+	-b|--files_per_invocation) files_per_invocation="$2"; shift; shift; continue;;
+	-w|--workers)           workers="$2";  shift; shift; continue;;
+	--copy_streams)         copy_streams="$2";     shift; shift; continue;;
+	--copy_retries)         copy_retries="$2";     shift; shift; continue;;
+	--bundle_max_mb)        bundle_max_mb="$2";    shift; shift; continue;;
+	--cost_budget)          cost_budget="$2";      shift; shift; continue;;
+	--cost_metric)          cost_metric="$2";      shift; shift; continue;;
+	--disk_budget)          disk_budget="$2";      shift; shift; continue;;
+	--dynamic_lifetime)     dynamic_lifetime="$2"; shift; shift; continue;;
+	--job_lifetime)         job_lifetime="$2";     shift; shift; continue;;
 	--self_destruct_timer) self_destruct_timeout=$2;       shift; shift; continue;;
+	--self_destruct_grace)  self_destruct_grace="$2";  shift; shift; continue;;
+	--watchdog_interval)    watchdog_interval="$2";  shift; shift; continue;;
+	--file_memory_limit)    file_memory_limit="$2";  shift; shift; continue;;
+	--file_time_limit)      file_time_limit="$2";    shift; shift; continue;;
 	--earlysource)   earlysources="$earlysources \"$2\"":; shift; shift; continue;;
 	--earlyscript)   earlyscripts="$earlyscripts \"$2\"":; shift; shift; continue;;
 	--source)        sources="$sources \"$2\"":;           shift; shift; continue;;
@@ -162,12 +327,7 @@ clean_it_up() {
     clean_dir "${CONDOR_DIR_INPUT}"
     clean_dir "${toolAnaDir}"
 
-    if [ -n "${consumer_id}" ]; then
-	echo ""
-	echo "Ending this process"
-	echo "ifdh endProcess ${projurl} ${consumer_id}"
-	ifdh endProcess "${projurl}" "${consumer_id}"
-    fi
+    end_consumer
 
     ifdh cleanup -x
 
@@ -189,34 +349,501 @@ clean_it_up() {
     echo "Done Cleaning"
 }
 
+end_consumer() {
+    if [ -n "${consumer_id}" ]; then
+	echo ""
+	echo "Ending this process"
+	echo "ifdh endProcess ${projurl} ${consumer_id}"
+	ifdh endProcess "${projurl}" "${consumer_id}"
+	consumer_id=""
+    fi
+}
+
+################################################################################
+# Stage timing records
+# Each call appends one JSON line to ${recordsFile}:
+#   record_stage <stage> <start> <end> [key value]...
+# start and end come from `now`. Values that look like numbers are written as
+# numbers, everything else as strings. The job, site, and glidein are added to
+# every record so they can be compared across jobs with annie_job_stats.py.
+################################################################################
+now() {
+    date +%s.%N
+}
+
+machine_ad_value() {
+    [ -f "${_CONDOR_MACHINE_AD}" ] || return 0
+    grep "^${1} = " ${_CONDOR_MACHINE_AD} | head -1 | cut -d'=' -f2- | tr -d ' "'
+}
+
+setup_stage_records() {
+    site=${GLIDEIN_Site:-`machine_ad_value GLIDEIN_Site`}
+    glidein=${GLIDEIN_Name:-`machine_ad_value GLIDEIN_Name`}
+    echo "Writing stage records for ${jobid} at site ${site:-unknown} (glidein ${glidein:-unknown}) to ${recordsDir}"
+}
+
+record_stage() {
+    ${stage_records} || return 0
+
+    stage=$1
+    tstart=$2
+    tend=$3
+    shift 3
+    extra=""
+    while [ $# -gt 1 ]; do
+	if [[ "$2" =~ ^-?[0-9]+(\.[0-9]+)?$ ]]; then
+	    extra+=", \"$1\": $2"
+	else
+	    extra+=", \"$1\": \"${2//\"/\\\"}\""
+	fi
+	shift 2
+    done
+
+    duration=`awk "BEGIN {printf \"%.3f\", ${tend} - ${tstart}}"`
+    # one echo per line so that records from background copies don't get mixed up
+    echo "{\"stage\": \"${stage}\", \"start\": ${tstart}, \"duration\": ${duration}, \"job\": \"${jobid}\", \"worker\": ${worker:-0}, \"site\": \"${site}\", \"glidein\": \"${glidein}\", \"host\": \"${hostname}\", \"config\": \"${conf}\", \"project\": \"${SAM_PROJECT_NAME}\"${extra}}" >> ${recordsFile}
+}
+
+copy_stage_records() {
+    # the watchdog's samples go out with them
+    for records in ${recordsFile} ${resourcesFile}; do
+	[ -f "${records}" ] || continue
+	echo ""
+	echo "ifdh cp ${records} ${DEST}/`basename ${records}`"
+	ifdh cp ${records} ${DEST}/`basename ${records}`
+    done
+}
+
+################################################################################
+# Resource usage for the consumer records, so the submitter can size requests
+################################################################################
+job_peak_rss_mb() {
+    # condor puts the whole job in its own cgroup, which is what --memory is checked against
+    v2=`awk -F: '$1 == "0" {print $3}' /proc/self/cgroup 2> /dev/null`
+    v1=`awk -F: '$2 ~ /(^|,)memory(,|$)/ {print $3}' /proc/self/cgroup 2> /dev/null`
+    for peak in /sys/fs/cgroup${v2}/memory.peak /sys/fs/cgroup/memory${v1}/memory.max_usage_in_bytes; do
+	if [ -n "${v2}${v1}" ] && [ -r ${peak} ]; then
+	    echo $(( `cat ${peak}` / 1048576 ))
+	    return 0
+	fi
+    done
+    echo 0
+}
+
+scratch_used_mb() {
+    du -sm ${topDir} 2> /dev/null | tail -1 | cut -f1
+}
+
+track_scratch() {
+    ${stage_records} || return 0
+    used=`scratch_used_mb`
+    [ ${used} -gt ${peak_scratch_mb} ] && peak_scratch_mb=${used}
+}
+
+################################################################################
+# Retries with backoff
+# When a whole cluster starts at once every job asks SAM for something at the
+# same time, and retrying after a fixed wait keeps them in step. Instead the
+# Nth retry waits anywhere up to retry_base * 2^(N-1) seconds, capped at
+# retry_max. nretries and backoff_ms add up the retries and the waiting for the
+# consumer record.
+################################################################################
+random_sleep() {
+    # /dev/urandom, since RANDOM can start out the same in the workers and the prefetcher
+    wait_ms=$(( `od -An -N4 -tu4 /dev/urandom` % ($1 * 1000 + 1) ))
+    echo "Waiting $((wait_ms / 1000)).`printf %03d $((wait_ms % 1000))` seconds"
+    sleep $((wait_ms / 1000)).`printf %03d $((wait_ms % 1000))`
+    backoff_ms=$((backoff_ms + wait_ms))
+}
+
+backoff() {
+    ceiling=$(( retry_base << ($1 > 16 ? 15 : $1 - 1) ))
+    [ ${ceiling} -gt ${retry_max} ] && ceiling=${retry_max}
+    nretries=$((nretries + 1))
+    random_sleep ${ceiling}
+}
+
+past_self_destruct() {
+    # nothing is retried once the job is meant to be finishing up
+    [ -n "${self_destruct_at}" ] && [ `date +%s` -ge ${self_destruct_at} ]
+}
+
+backoff_sec() {
+    awk "BEGIN {printf \"%.3f\", ${backoff_ms} / 1000}"
+}
+
+################################################################################
+# Ask SAM for the next file, trying up to ${sam_retries} times. Sets uri, which
+# is empty when there are no more files. Any arguments go in the stage records.
+# In the prefetcher the URI is also written to ${uri_file} before anything else.
+################################################################################
+next_uri() {
+    for attempt in `seq 1 ${sam_retries}`; do
+	[ ${attempt} -gt 1 ] && past_self_destruct && break
+	[ ${attempt} -gt 1 ] && backoff $((attempt - 1))
+	if [ -n "${uri_file}" ]; then
+	    # stop_prefetcher waits while this is here, so that a file SAM hands over
+	    # is always written down and can be marked as skipped
+	    touch ${prefetchDir}/asking
+	    if [ -f ${prefetchDir}/stop ]; then
+		rm -f ${prefetchDir}/asking
+		uri=""
+		return 1
+	    fi
+	fi
+	tstart=`now`
+	uri=`IFDH_DEBUG= ifdh getNextFile $projurl $consumer_id`
+	sam_res=$?
+	uri=`echo "${uri}" | tail -1`
+	if [ -n "${uri_file}" ]; then
+	    [ ${sam_res} -eq 0 ] && [ -n "${uri}" ] && echo "${uri}" > ${uri_file}
+	    rm -f ${prefetchDir}/asking
+	fi
+	record_stage getNextFile ${tstart} `now` file "`basename "${uri}"`" exit_code ${sam_res} attempt ${attempt} "$@"
+	[ ${sam_res} -eq 0 ] && return 0
+	echo "getNextFile failed on attempt ${attempt} of ${sam_retries}"
+    done
+    echo "Could not get the next file from SAM, treating it as the end of the project"
+    uri=""
+    return 1
+}
+
+################################################################################
+# Fetch ${uri}, with ifdh's output going to $1, trying up to ${fetch_retries}
+# times. With --alternate_uri every other retry fetches from the rewritten URI.
+# Any other arguments go in the stage records.
+################################################################################
+fetch_input() {
+    fetchLog=$1
+    shift
+    for attempt in `seq 1 ${fetch_retries}`; do
+	[ ${attempt} -gt 1 ] && past_self_destruct && break
+	[ ${attempt} -gt 1 ] && backoff $((attempt - 1))
+	source_uri=${uri}
+	if [ -n "${alternate_uri}" ] && [ $((attempt % 2)) -eq 0 ]; then
+	    source_uri=`echo "${uri}" | sed "s~${alternate_uri%%=*}~${alternate_uri#*=}~"`
+	fi
+	tstart=`now`
+	IFDH_DEBUG= ifdh fetchInput "${source_uri}" > ${fetchLog} 2>&1
+	fetch_res=$?
+	record_stage fetchInput ${tstart} `now` file "`basename ${uri}`" bytes `stat -c %s $(tail -1 ${fetchLog}) 2> /dev/null || echo 0` exit_code ${fetch_res} attempt ${attempt} "$@"
+	[ ${fetch_res} -eq 0 ] && return 0
+	echo "Failed to fetch from ${source_uri} on attempt ${attempt} of ${fetch_retries}"
+	cat ${fetchLog}
+    done
+    return ${fetch_res}
+}
+
 ################################################################################
 # Function to get the next file in the SAM project
+# Returns non-zero if SAM gave us a file that couldn't be fetched
 ################################################################################
 get_next_file() {
-    rm -f ${fname}
-    
     fname=""
-    uri=`IFDH_DEBUG= ifdh getNextFile $projurl $consumer_id | tail -1`
+    next_uri
     echo ""
     echo "Next file URI: ${uri}"
     [ -z "${uri}" ] && return 0
 
-    IFDH_DEBUG= ifdh fetchInput "${uri}" > fetch.log 2>&1
-    res=$?
-    if [ ${res} -ne 0 ]; then
-        echo "Failed to fetch from ${uri}"
-        cat fetch.log
+    if fetch_input fetch.log; then
+        fname=`tail -1 fetch.log`
+	echo "Got file: ${fname}"
+    else
+        echo "Could not fetch ${uri}"
         rm fetch.log
+    fi
+
+    echo ""
+    ls -l ${fname}
+    echo ""
+
+    return ${fetch_res}
+}
+
+################################################################################
+# Prefetch files from the SAM project in the background
+# Each file gets a sequence number. The fetcher writes <seq>.uri as soon as SAM
+# delivers it, <seq>.fname and <seq>.res once it has been fetched, and then
+# touches <seq>.ready. <seq>.end means there are no more files.
+################################################################################
+prefetch_has_space() {
+    # always fetch if the main loop is waiting on us, otherwise we'd never get anywhere
+    [ -f ${prefetchDir}/waiting ] && return 0
+
+    if [ -n "${disk_budget}" ]; then
+	used=`du -sm ${topDir} 2>/dev/null | tail -1 | cut -f1`
+	avail=$(( disk_budget * 9 / 10 - used ))
     else
-        fname=`tail -1 fetch.log`
+	avail=`df -Pm ${topDir} | tail -1 | awk '{print $4}'`
+    fi
+
+    [ ${avail} -gt ${largest_fetch} ]
+}
+
+prefetch_files() {
+    seq=0
+    largest_fetch=0
+    nfailed=0
+    # these are added to the main loop's by stop_prefetcher
+    nretries=0
+    backoff_ms=0
+    while [ ! -f ${prefetchDir}/stop ]; do
+	# wait until there's a free slot and enough room on disk for another file
+	if [ `ls ${prefetchDir} | grep -c '\.ready$'` -ge ${prefetch} ] || ! prefetch_has_space; then
+	    sleep 1
+	    continue
+	fi
+
+	# the main loop will stop at the same file as we do
+	if ! check_budget > /dev/null; then
+	    touch ${prefetchDir}/${seq}.end
+	    return 0
+	fi
+
+	# this file would be run after the ones waiting and the one being run now
+	if ! check_lifetime $((`ls ${prefetchDir} | grep -c '\.ready$'` + 2)) > /dev/null; then
+	    touch ${prefetchDir}/${seq}.end
+	    return 0
+	fi
+
+	uri_file=${prefetchDir}/${seq}.uri
+	next_uri prefetched 1
+	echo "${nretries} ${backoff_ms}" > ${prefetchDir}/backoff
+	if [ -z "${uri}" ]; then
+	    touch ${prefetchDir}/${seq}.end
+	    return 0
+	fi
+
+	fetch_input ${prefetchDir}/${seq}.log prefetched 1
+	echo "${nretries} ${backoff_ms}" > ${prefetchDir}/backoff
+	if [ ${fetch_res} -eq 0 ]; then
+	    fetched=`tail -1 ${prefetchDir}/${seq}.log`
+	    mv ${fetched} ${prefetchDir}/
+	    fetched=${prefetchDir}/`basename ${fetched}`
+	    echo "${fetched}" > ${prefetchDir}/${seq}.fname
+
+	    size=`du -sm ${fetched} | cut -f1`
+	    [ ${size} -gt ${largest_fetch} ] && largest_fetch=${size}
+
+	    if [ -n "${cost_budget}" ]; then
+		fcost=`file_cost ${fetched}`
+		echo ${fcost} > ${fetched}.cost
+		job_cost=$((job_cost + fcost))
+	    fi
+	fi
+	echo ${fetch_res} > ${prefetchDir}/${seq}.res
+	touch ${prefetchDir}/${seq}.ready
+
+	# the main loop gives up after as many failed fetches in a row, so there's no point going on
+	if [ ${fetch_res} -ne 0 ]; then
+	    nfailed=$((nfailed + 1))
+	    [ ${nfailed} -ge ${n_max_fetch_failures} ] && return ${fetch_res}
+	else
+	    nfailed=0
+	fi
+	seq=$((seq + 1))
+    done
+}
+
+start_prefetcher() {
+    prefetchDir="${topDir}/prefetch${workTag}"
+    mkdir -p ${prefetchDir}
+    next_seq=0
+
+    echo "Prefetching up to ${prefetch} files ahead into ${prefetchDir}"
+    prefetch_files &
+    prefetch_pid=$!
+}
+
+stop_prefetcher() {
+    [ -z "${prefetch_pid}" ] && return 0
+
+    echo ""
+    echo "Stopping the prefetcher"
+    touch ${prefetchDir}/stop
+    # let a getNextFile that's under way finish, so the file it gets isn't left delivered
+    while [ -f ${prefetchDir}/asking ] && kill -0 ${prefetch_pid} 2> /dev/null; do
+	sleep 1
+    done
+    pkill -P ${prefetch_pid} 2> /dev/null
+    kill ${prefetch_pid} 2> /dev/null
+    wait ${prefetch_pid} 2> /dev/null
+    prefetch_pid=""
+    if [ -f ${prefetchDir}/backoff ]; then
+	set -- `cat ${prefetchDir}/backoff`
+	nretries=$((nretries + $1))
+	backoff_ms=$((backoff_ms + $2))
+    fi
+
+    # anything SAM delivered that we never got to is marked as skipped
+    for urifile in `ls ${prefetchDir}/*.uri 2> /dev/null`; do
+	seq=`basename ${urifile} .uri`
+	[ ${seq} -lt ${next_seq} ] && continue
+
+	if [ -f ${prefetchDir}/${seq}.fname ]; then
+	    leftover=`cat ${prefetchDir}/${seq}.fname`
+	    rm -f ${leftover} ${leftover}.cost
+	else
+	    leftover=`basename $(cat ${urifile})`
+	fi
+	echo "Never processed ${leftover}, marking it as skipped"
+	ifdh updateFileStatus ${projurl}  ${consumer_id} ${leftover} skipped
+    done
+}
+
+################################################################################
+# Take the next file that the prefetcher has fetched
+################################################################################
+take_prefetched_file() {
+    fname=""
+    uri=""
+    touch ${prefetchDir}/waiting
+    until [ -f ${prefetchDir}/${next_seq}.ready ] || [ -f ${prefetchDir}/${next_seq}.end ]; do
+	if ! kill -0 ${prefetch_pid} 2> /dev/null; then
+	    # check one last time in case it finished between the test and now
+	    [ -f ${prefetchDir}/${next_seq}.ready ] || [ -f ${prefetchDir}/${next_seq}.end ] && continue
+	    echo "The prefetcher exited unexpectedly"
+	    rm -f ${prefetchDir}/waiting
+	    res=1
+	    return ${res}
+	fi
+	sleep 1
+    done
+    rm -f ${prefetchDir}/waiting
+
+    if [ -f ${prefetchDir}/${next_seq}.end ]; then
+	echo ""
+	echo "Next file URI: "
+	return 0
+    fi
+
+    uri=`cat ${prefetchDir}/${next_seq}.uri`
+    fetch_res=`cat ${prefetchDir}/${next_seq}.res`
+    echo ""
+    echo "Next file URI: ${uri}"
+    if [ ${fetch_res} -ne 0 ]; then
+        echo "Could not fetch ${uri}"
+	cat ${prefetchDir}/${next_seq}.log
+    else
+	fname=`cat ${prefetchDir}/${next_seq}.fname`
 	echo "Got file: ${fname}"
     fi
+    rm -f ${prefetchDir}/${next_seq}.ready ${prefetchDir}/${next_seq}.log
+    next_seq=$((next_seq + 1))
 
     echo ""
     ls -l ${fname}
     echo ""
 
-    return ${res}
+    return ${fetch_res}
+}
+
+next_input_file() {
+    if [ ${prefetch} -gt 0 ]; then
+	take_prefetched_file
+    else
+	get_next_file
+    fi
+}
+
+################################################################################
+# Persistent container session
+# Rather than starting a new container for every file, start one shell inside
+# the container, set it up once, and then send it a line over a fifo for every
+# file that should be run. It sends back Analyse's exit code over another fifo.
+################################################################################
+start_container_session() {
+    sessionDir="${topDir}/session${workTag}"
+    mkdir -p ${sessionDir}
+    rm -f ${sessionDir}/cmds ${sessionDir}/exits
+    mkfifo ${sessionDir}/cmds ${sessionDir}/exits
+
+    # topDir is bound to the same path inside the container so the session can see these
+    cat > ${sessionDir}/session.sh <<EOF
+cd /MyToolAnalysis || exit 1
+source Setup.sh || exit 1
+export ROOT_INCLUDE_PATH=\${ROOT_INCLUDE_PATH}/MyToolAnalysis/DataModel
+export ROOT_INCLUDE_PATH=\${ROOT_INCLUDE_PATH}:/MyToolAnalysis/ToolDAQ/boost_1_66_0/boost/serialization/
+export ROOT_INCLUDE_PATH=\${ROOT_INCLUDE_PATH}:/MyToolAnalysis/ToolDAQ/boost_1_66_0/install/include/
+echo && echo "ROOT_INCLUDE_PATH" && echo \${ROOT_INCLUDE_PATH}
+echo && echo "LD_LIBRARY_PATH" && echo \${LD_LIBRARY_PATH}
+while read -r run; do
+    date +%s.%N > /tmp/analyse_start
+    /MyToolAnalysis/Analyse configfiles/${conf}/ToolChainConfig < /dev/null
+    echo "\${run} \$?" > ${sessionDir}/exits
+done
+EOF
+
+    echo "Starting container session: singularity exec ${container_binds} ${container_image} bash ${sessionDir}/session.sh"
+    singularity exec ${container_binds} ${container_image} bash ${sessionDir}/session.sh < ${sessionDir}/cmds &
+    session_pid=$!
+    exec 3> ${sessionDir}/cmds
+    # opened read-write so that this never blocks, even if the session dies
+    exec 4<> ${sessionDir}/exits
+    nrun=0
+}
+
+stop_container_session() {
+    [ -z "${session_pid}" ] && return 0
+
+    echo ""
+    echo "Stopping the container session"
+    exec 3>&- 4>&-
+    wait ${session_pid}
+    session_pid=""
+}
+
+run_in_session() {
+    if [ -n "${session_pid}" ] && ! kill -0 ${session_pid} 2> /dev/null; then
+	echo "The container session has exited, starting a new one"
+	stop_container_session
+    fi
+    if [ -z "${session_pid}" ]; then
+	start_container_session
+    fi
+
+    nrun=$((nrun + 1))
+    echo "Running Analyse in container session ${session_pid} (run ${nrun})"
+    echo ${nrun} >&3
+    start_watchdog ${session_pid}
+
+    while true; do
+	if read -r -t 10 donerun session_res <&4; then
+	    [ "${donerun}" = "${nrun}" ] && return ${session_res}
+	elif ! kill -0 ${session_pid} 2> /dev/null; then
+	    echo "The container session died while running Analyse"
+	    stop_container_session
+	    return 1
+	fi
+    done
+}
+
+run_analyse() {
+    # the container writes /tmp/analyse_start just before Analyse starts
+    rm -f ${tmpDir}/analyse_start
+    tstart=`now`
+    if ${persistent_container}; then
+	run_in_session
+    else
+	echo "Running: ${command}"
+	eval "${command}" &
+	analyse_pid=$!
+	start_watchdog ${analyse_pid}
+	wait ${analyse_pid}
+    fi
+    analyse_res=$?
+    # record_stage sets tend, so this needs its own name
+    tdone=`now`
+    stop_watchdog
+
+    if [ -s ${tmpDir}/analyse_start ]; then
+	tanalyse=`cat ${tmpDir}/analyse_start`
+	record_stage container_start ${tstart} ${tanalyse} persistent `${persistent_container} && echo 1 || echo 0`
+    else
+	tanalyse=${tstart}
+    fi
+    record_stage Analyse ${tanalyse} ${tdone} file "${batch[*]##*/}" nfiles ${#batch[@]} exit_code ${analyse_res} ${stopped:+stopped ${stopped}}
+    return ${analyse_res}
 }
 
 ################################################################################
@@ -236,8 +863,59 @@ check_space() {
 
 ################################################################################
 # Check job lifetime
+# With --dynamic_lifetime we stop asking for files once there isn't enough time
+# left to run over another one and copy everything out before the job is
+# killed. The time per file and the copy out time are moving estimates that
+# update_lifetime_estimates keeps in ${lifetimeFile} so the prefetcher can
+# read them too. check_lifetime N checks that there's time for N more files.
 ################################################################################
+job_deadline() {
+    # whichever comes first, the glidein going away or the job running over its lifetime
+    deadline=${FIFE_GLIDEIN_ToDie:-`machine_ad_value GLIDEIN_ToDie`}
+    if [ -n "${job_lifetime}" ] && [ ${job_lifetime} -gt 0 ]; then
+	job_end=$((job_start + job_lifetime))
+	if [ -z "${deadline}" ] || [ ${job_end} -lt ${deadline} ]; then
+	    deadline=${job_end}
+	fi
+    fi
+    echo ${deadline}
+}
+
+pending_output_kb() {
+    # outputs still in the working directory plus any background copies that haven't finished
+    kb=`ls ${toolAnaDir} | grep -vFf ${toolAnaDir}/initial_files.txt | sed "s~^~${toolAnaDir}/~" | xargs -r du -sk 2> /dev/null | awk '{n += $1} END {print n + 0}'`
+    if [ -d ${topDir}/outbox${workTag} ]; then
+	kb=$((kb + `du -sk ${topDir}/outbox${workTag} | cut -f1`))
+    fi
+    echo ${kb}
+}
+
+update_lifetime_estimates() {
+    nbatch=$1
+    batch_time=$2
+    batch_output_kb=$3
+    # background copies finishing during the batch can make this look negative
+    [ ${batch_output_kb} -lt 0 ] && batch_output_kb=0
+
+    # weight the latest batch by 30% so one odd file doesn't throw everything off
+    per_file=$(( (batch_time + nbatch - 1) / nbatch ))
+    output_per_file=$(( batch_output_kb / nbatch ))
+    if [ ${file_time} -eq 0 ]; then
+	file_time=${per_file}
+	output_kb_per_file=${output_per_file}
+    else
+	file_time=$(( (7 * file_time + 3 * per_file + 9) / 10 ))
+	output_kb_per_file=$(( (7 * output_kb_per_file + 3 * output_per_file) / 10 ))
+    fi
+
+    # everything that's still to be copied, plus the outputs of one more batch
+    copy_kb=$(( `pending_output_kb` + files_per_invocation * output_kb_per_file ))
+    copy_time=$(( copy_kb / copy_rate_kbps + 1 ))
+    echo "${file_time} ${copy_time}" > ${lifetimeFile}
+}
+
 check_lifetime() {
+    nfiles=${1:-1}
     echo "-------------------------------"
     echo "| Checking dynamic lifetime"
     # Is dynamic lifetime in use
@@ -248,13 +926,29 @@ check_lifetime() {
         return 0
     fi
 
+    deadline=`job_deadline`
+    if [ -z "${deadline}" ]; then
+        echo "|  No FIFE_GLIDEIN_ToDie or job lifetime to check against"
+        echo "-------------------------------"
+        return 0
+    fi
+
+    est_file_time=0
+    est_copy_time=0
+    [ -s ${lifetimeFile} ] && read est_file_time est_copy_time < ${lifetimeFile}
+    needed=$(( nfiles * est_file_time + est_copy_time + dynamic_lifetime ))
+
     tnow=`date +%s` # time since Epoch
-    tleft=$(( ${FIFE_GLIDEIN_ToDie} - ${tnow} ))
+    tleft=$(( ${deadline} - ${tnow} ))
     echo "|   tnow = $tnow "
     echo "|   FIFE_GLIDEIN_ToDie = ${FIFE_GLIDEIN_ToDie}"
+    echo "|   deadline = ${deadline}"
     echo "|   tleft = ${tleft}"
+    echo "|   time per file = ${est_file_time}"
+    echo "|   time to copy out = ${est_copy_time}"
     echo "|   dynamic_lifetime = ${dynamic_lifetime}"
-    if [ ${tleft} -le ${dynamic_lifetime} ]; then
+    echo "|   needed for ${nfiles} more file(s) = ${needed}"
+    if [ ${tleft} -le ${needed} ]; then
         # There is not enough time left to process the job,
         # send back the kill command
         echo "|  Killing"
@@ -266,6 +960,37 @@ check_lifetime() {
     return 0
 }
 
+################################################################################
+# Keep track of how much this consumer has run over when jobs are balanced by
+# bytes or events, so that it stops asking for files once it's done its share
+################################################################################
+file_cost() {
+    # the prefetcher leaves the cost next to the file so we don't look it up twice
+    if [ -f ${1}.cost ]; then
+	cost=`cat ${1}.cost`
+    elif [ "${cost_metric}" = "events" ]; then
+	cost=`curl -s ${IFDH_BASE_URI}/files/name/\`basename ${1}\`/metadata?format=json | jq -r '.event_count // 0' 2> /dev/null`
+    else
+	cost=`stat -c %s ${1}`
+    fi
+    # an empty cost would break the sums it goes into
+    if ! [[ "${cost}" =~ ^[0-9]+$ ]]; then
+	echo "Warning: could not get the ${cost_metric} of `basename ${1}`, counting it as 0" >&2
+	cost=0
+    fi
+    echo ${cost}
+}
+
+check_budget() {
+    [ -z "${cost_budget}" ] && return 0
+
+    if [ ${job_cost} -ge ${cost_budget} ]; then
+	echo "Already ran over ${job_cost} ${cost_metric}, which is this job's share of ${cost_budget}. Not asking for any more files."
+	return 1
+    fi
+    return 0
+}
+
 ################################################################################
 # Update the input file for the toolchain
 ################################################################################
@@ -277,7 +1002,7 @@ update_input_file() {
 
     if [ -z "${ivar}" ]; then
 	# no input variable defined, assume that we can just overwrite the ifconf
-	echo "${fname}" > ${ifconf}
+	printf "%s\n" "${batch[@]}" > ${ifconf}
     else
 	echo "we'll have to overwrite the specific line"
 	echo "sed -i 's~^'${ivar}' .*$~'${ivar}' '${fname}'~g' ${ifconf}"
@@ -313,7 +1038,7 @@ rename_output_files() {
 	    jobnum=${PROCESS}
 	fi
 
-	prefix="job${jobnum}_file${filenum}"
+	prefix="job${jobnum}${workTag}_file${filenum}"
 	# just looking for files that have not been renamed
 	for outfile in `ls | grep -vFf dont_rename.txt`; do
 	    echo "mv ${outfile} ${prefix}.${outfile}"
@@ -323,7 +1048,11 @@ rename_output_files() {
 	done
 	
     else
-	prefix=`basename ${fname}`	
+	# outputs of a batch of files are named after the first and last of them
+	prefix=`basename ${batch[0]}`
+	if [ ${#batch[@]} -gt 1 ]; then
+	    prefix="${prefix}_to_`basename ${batch[${#batch[@]}-1]}`"
+	fi
 	# just looking for files that have not been renamed
 	for outfile in `ls | grep -vFf dont_rename.txt`; do
 	    echo "mv ${outfile} ${prefix}.${outfile}"
@@ -331,98 +1060,748 @@ rename_output_files() {
 	    echo ${prefix}.${outfile} >> dont_rename.txt
 	    echo
 	done
+	# the bundle manifest has every input of each output, otherwise the batch is listed alongside them
+	if [ ${#batch[@]} -gt 1 ] && ! ${bundle_outputs}; then
+	    echo "Listing the ${#batch[@]} input files in ${prefix}.inputs.txt"
+	    printf "%s\n" "${batch[@]##*/}" > ${prefix}.inputs.txt
+	    echo ${prefix}.inputs.txt >> dont_rename.txt
+	fi
     fi
 
 }
 
 ################################################################################
-# Self destruct after n seconds
+# Bundle the outputs
+# With --bundle_outputs new outputs are appended to an uncompressed tar in
+# ${bundleDir} instead of being copied out on their own, so that dCache sees a
+# few big files rather than many small ones. Once a bundle is full, or the
+# consumer is done, it's closed: the block every output starts at is written to
+# the manifest and the bundle is left in ${bundleDir}/closed for copy_out.
+# Any arguments are the input files the outputs came from.
 ################################################################################
-kill_proc_kids_after_n() {
-    watchpid=$1
-    after_secs=$2
-    rate=10
-    sofar=0
-
-    start=`date +%s`
-    echo "Starting self-destruct timer of $after_secs at $start"
-
-    while kill -0 $watchpid 2> /dev/null && [ $sofar -lt $after_secs ]
-    do
-        sleep $rate
-        now=`date +%s`
-        sofar=$((now - start))
-        printf "."
+bundle_outputs() {
+    ${bundle_outputs} || return 0
+
+    cd ${toolAnaDir}
+    tstart=`now`
+    inputs="$*"
+    nbundled=0
+    bytes=0
+    files=()
+    for outfile in `ls -rt | grep -vFf initial_files.txt`; do
+	# like the copies, leave directories be
+	[ -f ${outfile} ] || continue
+	size=`stat -c %s ${outfile}`
+	if [ ${bundle_max_mb} -gt 0 ] && [ ${bundle_bytes} -gt 0 ] && \
+	       [ $(( bundle_bytes + size )) -gt $(( bundle_max_mb * 1048576 )) ]; then
+	    add_to_bundle "${files[@]}"
+	    close_bundle
+	    files=()
+	fi
+	files+=(${outfile})
+	# each file has a 512 byte header and is padded out to a whole block
+	bundle_bytes=$(( bundle_bytes + 512 + (size + 511) / 512 * 512 ))
+	nbundled=$((nbundled + 1))
+	bytes=$((bytes + size))
     done
-    printf "\n"
+    add_to_bundle "${files[@]}"
+    record_stage bundle ${tstart} `now` nfiles ${nbundled} bytes ${bytes} bundle ${bundleName}
+}
 
-    if kill -0 $watchpid
-    then
-       pslist=`ps -ef | grep " $watchpid " | grep -v grep`
-       printf "Timed out after $sofar seconds...\n"
-       for signal in 15 9
-       do
-           echo "$pslist" |
-              while read uid pid ppid rest
-              do
-                 if [ $ppid = $watchpid ]
-                 then
-                     echo "killing -$signal $uid $pid $ppid $rest"
-                     kill -$signal $pid
-                 fi
-              done
-           echo "killing -$signal $watchpid"
-           kill -$signal $watchpid
-       done
+add_to_bundle() {
+    [ $# -gt 0 ] || return 0
+    if ! tar -rf ${bundleDir}/${bundleName} "$@"; then
+	# they get copied out as they are instead
+	echo "Could not add $* to ${bundleName}"
+	return 1
+    fi
+    # bundle_outputs is still going through its outfiles
+    for bundled in "$@"; do
+	original=${bundled}
+	${rename_outputs} && original=${bundled#${prefix}.}
+	echo "${bundled} ${original} `stat -c %s ${bundled}` ${inputs}" >> ${bundleDir}/contents
+	rm -f ${bundled}
+    done
+}
+
+close_bundle() {
+    [ -f ${bundleDir}/${bundleName} ] || return 0
+
+    echo "Closing ${bundleName} with `cat ${bundleDir}/contents | wc -l` file(s)"
+    # the same name can be in a bundle more than once, so they're matched up in order
+    tar -tvRf ${bundleDir}/${bundleName} | sed -n 's/^block \([0-9]*\): [^*].* \([^ ]*\)$/\1 \2/p' |
+	awk -v bundle=${bundleName} -v job=${jobid} 'NR == FNR {block[$2, ++nblock[$2]] = $1; next}
+	    {inputs = ""; for (i = 4; i <= NF; i++) inputs = inputs (i > 4 ? ", " : "") "\"" $i "\""
+	     printf "{\"name\": \"%s\", \"original\": \"%s\", \"size\": %s, \"inputs\": [%s], \"bundle\": \"%s\", \"offset\": %d, \"job\": \"%s\"}\n",
+	            $1, $2, $3, inputs, bundle, 512 * block[$1, ++ncontents[$1]], job}' - ${bundleDir}/contents >> ${bundleDir}/manifest
+    mv ${bundleDir}/${bundleName} ${bundleDir}/closed/
+    rm -f ${bundleDir}/contents
+
+    nbundle=$((nbundle + 1))
+    bundleName="bundle.${jobid}${workTag}.${nbundle}.tar"
+    bundle_bytes=0
+}
+
+# bundle whatever is left, eg. from the post scripts, and put the manifest out with the bundles
+finish_bundles() {
+    ${bundle_outputs} || return 0
+
+    bundle_outputs
+    close_bundle
+    if [ -f ${bundleDir}/manifest ]; then
+	mv ${bundleDir}/manifest ${bundleDir}/closed/bundle_manifest.${jobid}${workTag}.jsonl
     fi
 }
 
+################################################################################
+# Watchdog
+# While Analyse runs, the memory, CPU and scratch disk used by everything under
+# it are sampled every ${watchdog_interval} seconds into ${samplesFile}. If it
+# goes over --file_memory_limit or --file_time_limit, or the job gets to the
+# --self_destruct_timer, Analyse is stopped and the reason is left in
+# ${stoppedFile}, so that process_files can skip those files and carry on.
+# stop_watchdog turns the samples into one line per run of Analyse in
+# ${resourcesFile}, which is copied out with the stage records.
+################################################################################
+process_tree() {
+    # "pid ppid rss_kb cputime comm" for $1 and everything under it
+    ps -e -o pid=,ppid=,rss=,time=,comm= | awk -v root=$1 '
+	{pid[NR] = $1; ppid[NR] = $2; line[NR] = $0}
+	END {
+	    keep[root] = 1
+	    # children can be listed before their parents, so go round until nothing is added
+	    do {
+		added = 0
+		for (i = 1; i <= NR; i++)
+		    if ((ppid[i] in keep) && !(pid[i] in keep)) {keep[pid[i]] = 1; added = 1}
+	    } while (added)
+	    for (i = 1; i <= NR; i++)
+		if (pid[i] in keep) print line[i]
+	}'
+}
+
+tree_usage() {
+    # "rss_mb cpu_sec" summed over the tree, cputime is [DD-]HH:MM:SS
+    process_tree $1 | awk '{rss += $3; n = split($4, hms, /[-:]/); cpu += hms[n] + 60 * hms[n-1] + 3600 * hms[n-2] + 86400 * (n > 3 ? hms[1] : 0)}
+	END {printf "%d %d\n", rss / 1024, cpu}'
+}
+
+stop_analyse() {
+    # just Analyse if it can be found, so that a persistent container session carries on
+    targets=`process_tree $1 | awk '$5 == "Analyse" {print $1}'`
+    pids=`for target in ${targets:-$1}; do process_tree ${target} | awk '{print $1}'; done`
+    kill -15 ${pids} 2> /dev/null
+    sleep 10
+    kill -9 ${pids} 2> /dev/null
+}
+
+watch_analyse() {
+    root=$1
+    time_limit=""
+    [ -n "${file_time_limit}" ] && time_limit=$((file_time_limit * $2))
+    wstart=`date +%s`
+    last=${wstart}
+    set -- `tree_usage ${root}`
+    last_cpu=$2
+    while sleep ${watchdog_interval}; do
+	t=`date +%s`
+	set -- `tree_usage ${root}`
+	rss_mb=$1
+	# processes that finish take their CPU time with them, so this can go down
+	cpu_pct=$(( ($2 - last_cpu) * 100 / (t - last > 0 ? t - last : 1) ))
+	[ ${cpu_pct} -lt 0 ] && cpu_pct=0
+	last=${t}
+	last_cpu=$2
+	echo "$((t - wstart)) ${rss_mb} ${cpu_pct} `scratch_used_mb`" >> ${samplesFile}
+
+	reason=""
+	if [ -n "${file_memory_limit}" ] && [ ${rss_mb} -gt ${file_memory_limit} ]; then
+	    reason="memory"
+	elif [ -n "${time_limit}" ] && [ $((t - wstart)) -gt ${time_limit} ]; then
+	    reason="time"
+	elif [ -n "${self_destruct_at}" ] && [ ${t} -ge ${self_destruct_at} ]; then
+	    reason="self_destruct"
+	fi
+	if [ -n "${reason}" ]; then
+	    echo "Watchdog: stopping Analyse after $((t - wstart)) seconds using ${rss_mb} MB (${reason})"
+	    echo ${reason} > ${stoppedFile}
+	    stop_analyse ${root}
+	    return 0
+	fi
+    done
+}
+
+start_watchdog() {
+    rm -f ${samplesFile} ${stoppedFile}
+    [ ${watchdog_interval} -gt 0 ] || return 0
+    watch_analyse $1 ${#batch[@]} &
+    watchdog_pid=$!
+}
+
+stop_watchdog() {
+    stopped=`cat ${stoppedFile} 2> /dev/null`
+    [ -n "${watchdog_pid}" ] || return 0
+    kill ${watchdog_pid} 2> /dev/null
+    wait ${watchdog_pid} 2> /dev/null
+    watchdog_pid=""
+
+    [ -f ${samplesFile} ] || return 0
+    awk -v job=${jobid} -v worker=${worker:-0} -v file="${batch[*]##*/}" -v interval=${watchdog_interval} -v stopped="${stopped}" '
+	{t = t sep $1; rss = rss sep $2; cpu = cpu sep $3; scratch = scratch sep $4; sep = ", "; if ($2 > peak) peak = $2}
+	END {printf "{\"job\": \"%s\", \"worker\": %d, \"file\": \"%s\", \"interval\": %d, \"stopped\": \"%s\", \"peak_rss_mb\": %d, \"t\": [%s], \"rss_mb\": [%s], \"cpu_pct\": [%s], \"scratch_mb\": [%s]}\n",
+		    job, worker, file, interval, stopped, peak, t, rss, cpu, scratch}' ${samplesFile} >> ${resourcesFile}
+}
+
+################################################################################
+# Self destruct backstop
+# The watchdog only stops Analyse. If the job is stuck anywhere else once it's
+# past the --self_destruct_timer, eg. in getNextFile, fetchInput, or copying
+# out, the stuck command is killed so that the job can still finish up. This is
+# run outside of the job's process tree so that the workers' wait doesn't wait
+# for it and it doesn't kill itself.
+################################################################################
+self_destruct_backstop() {
+    watchpid=$1
+    while kill -0 ${watchpid} 2> /dev/null; do
+	sleep 10
+	[ `date +%s` -ge ${self_destruct_at} ] || continue
+
+	# the shells, and the seds labelling the workers' output, run the whole job
+	pids=`process_tree ${watchpid} | awk '{printf "%s%s", sep, $1; sep = ","}'`
+	stuck=`ps -o pid=,etimes=,comm= -p ${pids} 2> /dev/null | \
+	    awk -v grace=${self_destruct_grace} '$3 != "bash" && $3 != "sh" && $3 != "sed" && $2 > grace {print $1}'`
+	[ -n "${stuck}" ] || continue
+
+	echo ""
+	echo "Past the self destruct timer, killing what has been running for more than ${self_destruct_grace} seconds:"
+	ps -o pid=,etimes=,args= -p `echo ${stuck} | tr ' ' ','`
+	kill -15 ${stuck} 2> /dev/null
+	sleep 10
+	kill -9 ${stuck} 2> /dev/null
+    done
+}
+
 ################################################################################
 # Copy files out
 ################################################################################
 copy_out() {
-    if (${job_dirs}) && ! (${dest_updated}); then 
-	if [ -n "${JOBSUBJOBSECTION}" ]; then
-	    newdest=${DEST}/job_${JOBSUBJOBSECTION}
-	else
-	    newdest=${DEST}/job_${PROCESS}
+    if ! (${dest_updated}); then 
+	newdest=${DEST}
+	if (${job_dirs}); then
+	    if [ -n "${JOBSUBJOBSECTION}" ]; then
+		newdest=${DEST}/job_${JOBSUBJOBSECTION}
+	    else
+		newdest=${DEST}/job_${PROCESS}
+	    fi
+	fi
+	if [ ${workers} -gt 1 ] && ! (${rename_outputs}); then
+	    # the outputs of the workers would overwrite each other without renaming
+	    newdest=${newdest}/worker_${worker}
 	fi
-	echo "new destination will be ${newdest}"
 
-	if [ ! -d "${newdest}" ]; then
-	    ifdh mkdir_p ${newdest}
+	if [ "${newdest}" != "${DEST}" ]; then
+	    echo "new destination will be ${newdest}"
+	    if [ ! -d "${newdest}" ]; then
+		ifdh mkdir_p ${newdest}
+	    fi
+	    DEST=${newdest}
 	fi
-	DEST=${newdest}
 	dest_updated=true
     fi
 
     # Make sure we're in the Tool Analysis Directory
     cd ${toolAnaDir}
+    if ${bundle_outputs} && [ -n "`ls ${bundleDir}/closed`" ]; then
+	# the bundles are copied out like any other output
+	mv ${bundleDir}/closed/* .
+    fi
     echo 
     echo "Files in ${toolAnaDir}:"
     ls -lrt
     echo   
     
+    tstart=`now`
     if [ -n "${cpsc}" ]; then
 	# use custom script
 	echo ""
 	echo "Using custom copyout script"
 	echo ${CONDOR_DIR_INPUT}/${cpsc}
 	source ${CONDOR_DIR_INPUT}/${cpsc}
+	record_stage copy_out ${tstart} `now` script "${cpsc}"
     else
 	# otherwise just copy everything
 	echo ""
 	echo "Copying back all new things from ${toolAnaDir} to ${DEST}"
         
-	for outfile in `ls | grep -vFf initial_files.txt`; do
-	    echo "ifdh cp ${outfile} ${DEST}/${file}"
-	    ifdh cp ${outfile} ${DEST}/${outfile}
-	    rm -f ${outfile}
+	if [ ${copy_streams} -gt 0 ]; then
+	    # the uploads record themselves when they finish
+	    queue_uploads
+	else
+	    ncopied=0
+	    bytes=0
+	    for outfile in `ls | grep -vFf initial_files.txt`; do
+		echo "ifdh cp ${outfile} ${DEST}/${file}"
+		bytes=$((bytes + `stat -c %s ${outfile}`))
+		ifdh cp ${outfile} ${DEST}/${outfile}
+		rm -f ${outfile}
+		ncopied=$((ncopied + 1))
+	    done
+	    tend=`now`
+	    record_stage copy_out ${tstart} ${tend} nfiles ${ncopied} bytes ${bytes}
+	    # only trust the rate when there was enough to copy for it to mean something
+	    if [ ${bytes} -gt 10000000 ]; then
+		copy_rate_kbps=`awk "BEGIN {r = ${bytes} / 1024 / (${tend} - ${tstart}); print (r < 1) ? 1 : int(r)}"`
+	    fi
+	fi
+    fi
+}
+
+################################################################################
+# Batched copy out in the background
+# New outputs are moved out of the way into an outbox and split between
+# ${copy_streams} lists of "source destination" lines. Each list is copied with
+# one "ifdh cp -f" in the background, with no more than ${copy_streams} running
+# at once. wait_for_uploads has to be called before cleaning up.
+################################################################################
+upload_list() {
+    list=$1
+    tstart=`now`
+    bytes=`cut -d' ' -f1 ${list} | xargs stat -c %s | awk '{n += $1} END {print n + 0}'`
+    for attempt in `seq 1 ${copy_retries}`; do
+	if ifdh cp -f ${list} > ${list}.log 2>&1; then
+	    record_stage copy_out ${tstart} `now` nfiles `cat ${list} | wc -l` bytes ${bytes} attempts ${attempt} exit_code 0 background 1
+	    echo "Copied out `cat ${list} | wc -l` file(s) in ${list}"
+	    rm -f `cut -d' ' -f1 ${list}`
+	    return 0
+	fi
+
+	echo "Failed to copy out ${list} on attempt ${attempt} of ${copy_retries}"
+	cat ${list}.log
+	# dCache won't overwrite, so clear out anything that did make it before trying again
+	for dest in `cut -d' ' -f2 ${list}`; do
+	    ifdh rm ${dest} > /dev/null 2>&1
+	done
+	[ ${attempt} -lt ${copy_retries} ] && sleep $((attempt * 30))
+    done
+
+    record_stage copy_out ${tstart} `now` nfiles `cat ${list} | wc -l` bytes ${bytes} attempts ${copy_retries} exit_code 1 background 1
+    touch ${list}.failed
+    return 1
+}
+
+wait_for_stream() {
+    while true; do
+	running=()
+	for pid in "${upload_pids[@]}"; do
+	    kill -0 ${pid} 2> /dev/null && running+=(${pid})
+	done
+	upload_pids=("${running[@]}")
+	[ ${#upload_pids[@]} -lt ${copy_streams} ] && return 0
+	sleep 1
+    done
+}
+
+queue_uploads() {
+    outboxDir="${topDir}/outbox${workTag}"
+    nupload=$((nupload + 1))
+    uploadDir="${outboxDir}/upload${nupload}"
+    mkdir -p ${uploadDir}
+
+    # biggest first, so that round robin spreads them out evenly
+    nqueued=0
+    for outfile in `ls -S | grep -vFf initial_files.txt`; do
+	# ifdh cp can't do directories, leave them be
+	[ -f ${outfile} ] || continue
+	mv ${outfile} ${uploadDir}/
+	echo "${uploadDir}/${outfile} ${DEST}/${outfile}" >> ${uploadDir}.list$((nqueued % copy_streams))
+	nqueued=$((nqueued + 1))
+    done
+
+    for list in `ls ${uploadDir}.list* 2> /dev/null`; do
+	wait_for_stream
+	echo "Starting copy out of `cat ${list} | wc -l` file(s) in ${list}"
+	upload_list ${list} &
+	upload_pids+=($!)
+    done
+}
+
+wait_for_uploads() {
+    [ ${copy_streams} -gt 0 ] || return 0
+
+    echo ""
+    echo "Waiting for ${#upload_pids[@]} copies to finish"
+    for pid in "${upload_pids[@]}"; do
+	wait ${pid}
+    done
+    upload_pids=()
+
+    failed=`ls ${outboxDir}/*.failed 2> /dev/null`
+    if [ -n "${failed}" ]; then
+	echo "Failed to copy out everything in:"
+	for list in ${failed}; do
+	    cat ${list%.failed}
 	done
+	return 1
+    fi
+    return 0
+}
+
+
+
+################################################################################
+# Register a consumer process with the SAM project
+################################################################################
+establish_consumer() {
+    consumer_id=''
+    nretries=0
+    backoff_ms=0
+    # so that the jobs in a cluster don't all ask at once
+    random_sleep ${retry_base}
+    for attempt in `seq 1 ${sam_retries}`; do
+	echo " Attempt ${attempt}"
+	[ ${attempt} -gt 1 ] && past_self_destruct && break
+	[ ${attempt} -gt 1 ] && backoff $((attempt - 1))
+	consumer_id=`IFDH_DEBUG= ifdh establishProcess "$projurl" "$appname" "$appversion" "$hostname" "$GRID_USER" "$appfamily" "$description" "$limit"`
+	[ -n "${consumer_id}" ] && break
+    done
+    if [ -z "${consumer_id}" ]; then
+        echo "Unable to establish consumer id!"
+        echo "Unable to establish consumer id!" >&2
+        return 1
+    fi
+    establish_attempts=${attempt}
+    established=`now`
+
+    echo "Consumer id: ${consumer_id}"
+}
+
+################################################################################
+# Record all of the initial files in the Tool Analysis directory and set up
+# the container command for it
+################################################################################
+setup_work_dir() {
+    cd ${toolAnaDir}
+    touch initial_files.txt
+    touch dont_rename.txt
+    ls >> initial_files.txt
+    ls >> dont_rename.txt
+    tmpDir="${topDir}/tmp${workTag}"
+    mkdir ${tmpDir}
+    lifetimeFile="${topDir}/lifetime${workTag}.est"
+    rm -f ${lifetimeFile}
+    recordsFile="${recordsDir}/stage_records.${jobid}${workTag}.jsonl"
+    resourcesFile="${recordsDir}/resource_samples.${jobid}${workTag}.jsonl"
+    samplesFile="${tmpDir}.samples"
+    stoppedFile="${tmpDir}.stopped"
+    bundleDir="${topDir}/bundles${workTag}"
+    mkdir -p ${bundleDir}/closed
+    nbundle=0
+    bundleName="bundle.${jobid}${workTag}.${nbundle}.tar"
+    bundle_bytes=0
+
+    container_binds="-B${topDir}:${topDir},${toolAnaDir}:/MyToolAnalysis,${tmpDir}:/tmp"
+    container_image=${toolanalysis_image}
+    command="singularity exec ${container_binds} ${container_image} bash -c ${containercmd}"
+}
+
+################################################################################
+# The loop to grab files from SAM and run over them
+################################################################################
+process_files() {
+    if [ ${prefetch} -gt 0 ]; then
+	start_prefetcher
+    fi
+
+    res=0
+    n_skipped_in_a_row=0
+    n_consumed=0
+    n_skipped=0
+    n_fetch_failed_in_a_row=0
+    no_more_files=false
+    # until something has been copied out assume a slow 5MB/s
+    file_time=0
+    output_kb_per_file=0
+    copy_rate_kbps=5000
+    peak_scratch_mb=0
+    ${stage_records} && base_scratch_mb=`scratch_used_mb`
+    while [ "$res" = 0 ]; do
+	batch_start=`date +%s`
+	batch_start_kb=`pending_output_kb`
+
+	# collect the files for this invocation of Analyse. If a fetch fails res is set,
+	# so we run over whatever we already have and then leave the loop
+	batch=()
+	while [ ${#batch[@]} -lt ${files_per_invocation} ]; do
+	    if ! check_budget; then
+		no_more_files=true
+		break
+	    fi
+	    if past_self_destruct; then
+		echo "Past the self destruct timer, not asking for any more files."
+		no_more_files=true
+		break
+	    fi
+	    if ! check_lifetime $(( ${#batch[@]} + 1 )); then
+		echo "Not enough time left to run over another file, not asking for any more."
+		no_more_files=true
+		break
+	    fi
+	    echo ""
+	    echo "Getting the next file!"
+	    if ! next_input_file; then
+		# without a uri the prefetcher has gone, and res is already set
+		[ -z "${uri}" ] && break
+		echo "Marking `basename ${uri}` as skipped."
+		ifdh updateFileStatus ${projurl}  ${consumer_id} `basename ${uri}` skipped
+		n_skipped=$((n_skipped + 1))
+		n_fetch_failed_in_a_row=$((n_fetch_failed_in_a_row + 1))
+		if [ ${n_fetch_failed_in_a_row} -ge ${n_max_fetch_failures} ]; then
+		    echo "Could not fetch ${n_fetch_failed_in_a_row} files in a row, ending the multi-file loop."
+		    res=${fetch_res}
+		    break
+		fi
+		continue
+	    fi
+	    n_fetch_failed_in_a_row=0
+	    if [ -z "${fname}" ]; then
+		echo "No files returned by SAM project.  Most likely all files in the project have already been seen."
+		no_more_files=true
+		break
+	    fi
+	    ifdh updateFileStatus ${projurl}  ${consumer_id} ${fname} transferred
+	    batch+=("${fname}")
+	    if [ -n "${cost_budget}" ]; then
+		job_cost=$((job_cost + `file_cost ${fname}`))
+	    fi
+	done
+	[ ${#batch[@]} -eq 0 ] && break
+
+	update_input_file || break
+
+	echo ""
+	if run_analyse; then
+	    for infile in "${batch[@]}"; do
+		ifdh updateFileStatus ${projurl}  ${consumer_id} ${infile} consumed
+	    done
+	    n_consumed=$((n_consumed + ${#batch[@]}))
+	    n_skipped_in_a_row=0
+	else
+	    command_exit_code=$?
+	    if [ -n "${stopped}" ]; then
+		# the watchdog did this on purpose, so it doesn't count towards giving up on the job
+		echo "The watchdog stopped Analyse (${stopped}), marking ${#batch[@]} file(s) as skipped and carrying on."
+		[ "${stopped}" = "self_destruct" ] && no_more_files=true
+	    else
+		((n_skipped_in_a_row++))
+		if [[ ${n_skipped_in_a_row} -ge ${n_max_files_skipped} ]]; then
+		    echo "Reached limit of ${n_skipped_in_a_row} failed jobs in a row. Returning error code of ${command_exit_code} and ending the multi-file loop."
+		    res=${command_exit_code}
+		else
+		    echo "Command returned an error code of ${command_exit_code}, marking ${#batch[@]} file(s) as skipped. This is skip ${n_skipped_in_a_row out} of a maximum of ${n_max_files_skipped}."
+		fi
+	    fi
+	    # we can't tell which file Analyse choked on, so the whole batch is skipped
+	    for infile in "${batch[@]}"; do
+		ifdh updateFileStatus ${projurl}  ${consumer_id} ${infile} skipped
+	    done
+	    n_skipped=$((n_skipped + ${#batch[@]}))
+	fi
+
+	if ${rename_outputs}; then
+	    tstart=`now`
+	    rename_output_files
+	    record_stage rename ${tstart} `now` file "${batch[*]##*/}"
+	fi
+	batch_output_kb=$(( `pending_output_kb` - batch_start_kb ))
+	# the inputs and the outputs are all here at this point
+	track_scratch
+	bundle_outputs "${batch[@]##*/}"
+
+	if ${quick_copy}; then
+	    copy_out
+	fi
+
+	if [ -n "${dynamic_lifetime}" ]; then
+	    update_lifetime_estimates ${#batch[@]} $(( `date +%s` - batch_start )) ${batch_output_kb}
+	fi
+
+	for infile in "${batch[@]}"; do
+	    rm -f ${infile} ${infile}.cost
+	done
+	${no_more_files} && break
+    done
+
+    stop_prefetcher
+    stop_container_session
+}
+
+################################################################################
+# Run one SAM consumer from start to finish in ${toolAnaDir}:
+# process the files, run the post scripts, and copy everything out
+################################################################################
+run_consumer() {
+    consumer_start=`now`
+    establish_consumer || return 1
+    setup_work_dir
+    record_stage establishProcess ${consumer_start} ${established} attempts ${establish_attempts} backoff_sec `backoff_sec`
+    process_files
+
+    # Kick out if the loop failed, but copy back for debugging
+    if [ "${res}" != "0" ]; then
+	echo "ls /var/lib/systemd/coredump/"
+	ls /var/lib/systemd/coredump/
+
+	finish_bundles
+	copy_out
+	wait_for_uploads
+	finish_consumer_records
+	return ${res}
+    fi
+
+    # the post execution scripts
+    for blat in $postscripts; do
+	blat=${CONDOR_DIR_INPUT}/${blat}
+	blat=`echo $blat | sed -e 's/:/ /g'`
+	eval blat=$blat
+	echo "doing: $blat"
+	eval "$blat"
+	postres=$?
+	if [ "$res" = "0" -a "$postres" != "0" ]; then
+	    res=$postres
+	fi
+    done
+
+    finish_bundles
+    copy_out
+    if ! wait_for_uploads && [ "${res}" = "0" ]; then
+	res=1
     fi
+    finish_consumer_records
+    return ${res}
+}
+
+finish_consumer_records() {
+    record_stage consumer ${consumer_start} `now` consumed ${n_consumed} skipped ${n_skipped} exit_code ${res} \
+	workers ${workers} setup_sec $(( ${consumer_start%.*} - job_start )) retries ${nretries} backoff_sec `backoff_sec` \
+	peak_rss_mb `job_peak_rss_mb` base_scratch_mb ${base_scratch_mb:-0} peak_scratch_mb ${peak_scratch_mb:-0}
+    copy_stage_records
 }
 
+################################################################################
+# Run one of several consumers side by side. Each worker gets its own working
+# copy of ToolAnalysis so that the configs, outputs, and the bookkeeping used
+# for renaming and copying out don't get mixed up between workers.
+# This is run in a subshell so nothing here leaks back into the main script.
+################################################################################
+run_worker() {
+    worker=$1
+    workTag="_w${worker}"
+    toolAnaDir="${topDir}/MyToolAnalysis${workTag}"
+
+    echo "Making a working copy of ToolAnalysis in ${toolAnaDir}"
+    # hard links are enough for everything but the configs, which get rewritten for every file
+    if ! cp -al ${topDir}/MyToolAnalysis ${toolAnaDir} 2> /dev/null; then
+	rm -rf ${toolAnaDir}
+	cp -a ${topDir}/MyToolAnalysis ${toolAnaDir}
+    fi
+    rm -rf ${toolAnaDir}/configfiles
+    cp -a ${topDir}/MyToolAnalysis/configfiles ${toolAnaDir}/
 
+    run_consumer
+    res=$?
+    echo ${res} > ${topDir}/worker${workTag}.res
+
+    end_consumer
+    clean_dir "${toolAnaDir}"
+}
+
+################################################################################
+# Unpack ToolAnalysis
+# With --tarball_cache the tarball is unpacked once per node into a directory
+# named after its hash, and each job hard links it into its own toolAnaDir.
+# The lock keeps jobs starting at the same time from unpacking it twice, and
+# from clearing out a cached copy while another job is linking it.
+################################################################################
+tarball_format() {
+    case `head -c 4 $1 | od -An -tx1 | tr -d ' \n'` in
+	28b52ffd) echo zstd;;
+	1f8b*)    echo gzip;;
+	*)        echo tar;;
+    esac
+}
+
+unpack_tarball() {
+    format=`tarball_format $1`
+    echo "Unpacking $1 (${format})"
+    case ${format} in
+	zstd)
+	    # zstd isn't installed everywhere, but it is in the ToolAnalysis container
+	    if command -v zstd > /dev/null; then
+		zstd -dc $1 | tar -xf - -C $2
+	    else
+		singularity exec -B$1:/tarball ${toolanalysis_image} zstd -dc /tarball | tar -xf - -C $2
+	    fi
+	    return $((PIPESTATUS[0] + PIPESTATUS[1]));;
+	gzip) tar -zxf $1 -C $2;;
+	*)    tar -xf $1 -C $2;;
+    esac
+}
+
+unpack_from_cache() {
+    cacheDir="${tarball_cache}/annie_toolanalysis_${tarball_hash}"
+    command -v flock > /dev/null || return 1
+    [ -d ${tarball_cache} ] || mkdir -p -m 700 ${tarball_cache} 2> /dev/null || return 1
+    # anyone else on the node could have put a different ToolAnalysis in there
+    if [ ! -O ${tarball_cache} ]; then
+	echo "The node cache ${tarball_cache} doesn't belong to `id -un`, not using it"
+	return 1
+    fi
+
+    (
+	flock -w 1800 9 || exit 1
+
+	if [ -e ${cacheDir} ] && [ ! -O ${cacheDir} ]; then
+	    echo "${cacheDir} doesn't belong to `id -un`, not using it"
+	    exit 1
+	fi
+
+	if [ -f ${cacheDir}/.unpacked ]; then
+	    echo "Using ${tarball} already unpacked in ${cacheDir}"
+	else
+	    echo "Unpacking ${CONDOR_DIR_INPUT}/${tarball} into the node cache ${cacheDir}"
+	    rm -rf ${cacheDir}
+	    mkdir -m 700 ${cacheDir} || exit 1
+	    if ! unpack_tarball ${CONDOR_DIR_INPUT}/${tarball} ${cacheDir}; then
+		rm -rf ${cacheDir}
+		exit 1
+	    fi
+	fi
+	touch ${cacheDir}/.unpacked
+
+	# the configs get rewritten for every file so they have to be real copies
+	if ! cp -al ${cacheDir}/. ${toolAnaDir}/ 2> /dev/null; then
+	    echo "Could not hard link ${cacheDir} into ${toolAnaDir}, copying it instead."
+	    echo "Put --tarball_cache on the same filesystem as ${toolAnaDir} (the job scratch directory) to avoid the copy."
+	    rm -rf ${toolAnaDir}/* ${toolAnaDir}/.[!.]*
+	    cp -a ${cacheDir}/. ${toolAnaDir}/ || exit 1
+	fi
+	rm -rf ${toolAnaDir}/.unpacked ${toolAnaDir}/configfiles
+	cp -a ${cacheDir}/configfiles ${toolAnaDir}/ 2> /dev/null
+
+	# clear out tarballs that no job on this node has used for two days
+	for oldDir in `find ${tarball_cache} -mindepth 2 -maxdepth 2 -path '*/annie_toolanalysis_*' -name .unpacked -mtime +1 | xargs -r -n1 dirname`; do
+	    echo "Removing ${oldDir} from the node cache"
+	    rm -rf ${oldDir}
+	done
+    ) 9> ${tarball_cache}/.lock
+    res=$?
+
+    if [ ${res} -ne 0 ]; then
+	echo "Could not use the node cache in ${tarball_cache}"
+	rm -rf ${toolAnaDir}/* ${toolAnaDir}/.[!.]*
+    fi
+    return ${res}
+}
 
 ################################################################################
 # The meat and potatoes
@@ -464,13 +1843,28 @@ fi
 
 if [ -n "${ivar}" ]; then
     echo "Input file config variable is ${ivar}"
+    if [ ${files_per_invocation} -gt 1 ]; then
+	echo "Can only run over one file at a time when using an input config variable. Setting files per invocation to 1"
+	files_per_invocation=1
+    fi
 fi
 
+if [ ${files_per_invocation} -gt 1 ]; then
+    echo "Running over up to ${files_per_invocation} files per invocation of Analyse"
+fi
 
-# Set the self destruct
-if [ x"$self_destruct_timeout" != x ]
-then
-   kill_proc_kids_after_n $$ $self_destruct_timeout &
+
+# The self destruct and the limits are up to the watchdog
+if [ -n "${self_destruct_timeout}" ]; then
+    self_destruct_at=$((job_start + self_destruct_timeout))
+    echo "Stopping at `date -d @${self_destruct_at}`, ${self_destruct_timeout} seconds after the job started"
+    ( self_destruct_backstop $$ & )
+fi
+if [ -n "${self_destruct_timeout}${file_memory_limit}${file_time_limit}" ] && [ ${watchdog_interval} -eq 0 ]; then
+    watchdog_interval=10
+fi
+if [ ${watchdog_interval} -gt 0 ]; then
+    echo "Watching Analyse every ${watchdog_interval} seconds, with a memory limit of ${file_memory_limit:-none} MB and a time limit of ${file_time_limit:-none} seconds per file"
 fi
 
 
@@ -497,24 +1891,29 @@ done
 # ls'ing the dirs should be enough to force the auto mount I think
 echo ""
 echo "Checking for cvmfs directories"
-ls /cvmfs/singularity.opensciencegrid.org > /dev/null 2>&1
-if [[ $? != 0 ]]; then
-    echo ""
-    echo "/cvmfs/singularity.opensciencegrid.org was not found. Exiting."
-    clean_it_up 
-    exit $?
+if [ -n "${ANNIE_FAKE_GRID}" ]; then
+    echo "Using the stand-in grid tools in ${ANNIE_FAKE_GRID}, cvmfs isn't needed"
+    export PATH=${ANNIE_FAKE_GRID}/bin:${PATH}
 else
-    echo "/cvmfs/singularity.opensciencegrid.org was found."
-fi
+    ls /cvmfs/singularity.opensciencegrid.org > /dev/null 2>&1
+    if [[ $? != 0 ]]; then
+        echo ""
+        echo "/cvmfs/singularity.opensciencegrid.org was not found. Exiting."
+        clean_it_up 
+        exit $?
+    else
+        echo "/cvmfs/singularity.opensciencegrid.org was found."
+    fi
 
-ls /cvmfs/fermilab.opensciencegrid.org > /dev/null 2>&1
-if [[ $? != 0 ]]; then
-    echo ""
-    echo "/cvmfs/fermilab.opensciencegrid.org was not found. Exiting."
-    clean_it_up 
-    exit $?
-else
-    echo "/cvmfs/fermilab.opensciencegrid.org was found."
+    ls /cvmfs/fermilab.opensciencegrid.org > /dev/null 2>&1
+    if [[ $? != 0 ]]; then
+        echo ""
+        echo "/cvmfs/fermilab.opensciencegrid.org was not found. Exiting."
+        clean_it_up 
+        exit $?
+    else
+        echo "/cvmfs/fermilab.opensciencegrid.org was found."
+    fi
 fi
 
 #-------------------------------------------------------------------------------
@@ -558,9 +1957,13 @@ done
 #source /cvmfs/fermilab.opensciencegrid.org/products/common/etc/setup
 #setup ifdhc
 # new spack'ified methods
-source /cvmfs/fermilab.opensciencegrid.org/packages/common/spack/current/NULL/share/spack/setup-env.sh
-#spack load fife-utils@3.7.2
-spack load --first ifdhc@2.7.1%gcc@11.3.1
+if [ -n "${ANNIE_FAKE_GRID}" ]; then
+    spack() { :; }
+else
+    source /cvmfs/fermilab.opensciencegrid.org/packages/common/spack/current/NULL/share/spack/setup-env.sh
+    #spack load fife-utils@3.7.2
+    spack load --first ifdhc@2.7.1%gcc@11.3.1
+fi
 
 
 #-------------------------------------------------------------------------------
@@ -601,8 +2004,12 @@ if [ ! -f "${CONDOR_DIR_INPUT}/${tarball}" ]; then
     exit $?
 fi
 
-echo "Untarring ${CONDOR_DIR_INPUT}/${tarball} to ${topDir}/MyToolAnalysis"
-tar -zxf ${CONDOR_DIR_INPUT}/${tarball} -C ${toolAnaDir}
+if [ -n "${tarball_cache}" ] && [ -n "${tarball_hash}" ] && unpack_from_cache; then
+    echo "Linked ToolAnalysis from ${cacheDir} to ${toolAnaDir}"
+else
+    echo "Untarring ${CONDOR_DIR_INPUT}/${tarball} to ${topDir}/MyToolAnalysis"
+    unpack_tarball ${CONDOR_DIR_INPUT}/${tarball} ${toolAnaDir}
+fi
 ls -l
 echo ""
 
@@ -643,35 +2050,17 @@ else
    description=""
 fi
 
-consumer_id=''
-count=0
-while [ "$consumer_id" = "" ]
-do
-    echo " Attempt $((count+1))"
-    sleep 5
-    consumer_id=`IFDH_DEBUG= ifdh establishProcess "$projurl" "$appname" "$appversion" "$hostname" "$GRID_USER" "$appfamily" "$description" "$limit"`
-    count=$((count + 1))
-    if [ $count -gt 10 ]; then
-        echo "Unable to establish consumer id!"
-        echo "Unable to establish consumer id!" >&2
-	clean_it_up
-        exit 1	
-    fi
-done
-
-echo "Consumer id: ${consumer_id}"
+jobid=${JOBSUBJOBID:-${CLUSTER:-local}.${PROCESS:-0}}
+recordsDir="${topDir}/records"
+mkdir -p ${recordsDir}
+if ${stage_records}; then
+    setup_stage_records
+fi
 
 #-------------------------------------------------------------------------------
-# Record all of the initial files in the Tool Analysis directory and set nevts
+# Set the number of events to run over
 #-------------------------------------------------------------------------------
-cd ${toolAnaDir}
-touch initial_files.txt
-touch dont_rename.txt
-ls >> initial_files.txt
-ls >> dont_rename.txt
 sed -i 's/^Inline .*$/Inline '${nevts}'/g' ${toolAnaDir}/configfiles/${conf}/ToolChainConfig
-tmpDir="${topDir}/tmp" 
-mkdir ${tmpDir}
 
 #-------------------------------------------------------------------------------
 # This is what we'll run inside of the container
@@ -687,85 +2076,29 @@ containercmd+="echo && echo \"ROOT_INCLUDE_PATH\" "
 containercmd+="echo \"'"'${ROOT_INCLUDE_PATH}'"'\" && "
 containercmd+="echo && echo \"LD_LIBRARY_PATH\""
 containercmd+="echo \"'"'${LD_LIBRARY_PATH}'"'\" && "
+containercmd+="date +%s.%N > /tmp/analyse_start && "
 containercmd+="/MyToolAnalysis/Analyse configfiles/${conf}/ToolChainConfig\""
 
-command="singularity exec -B${topDir}:${topDir},${toolAnaDir}:/MyToolAnalysis,${tmpDir}:/tmp /cvmfs/singularity.opensciencegrid.org/anniesoft/toolanalysis\:latest/ bash -c ${containercmd}"
-
 #-------------------------------------------------------------------------------
-# the loop to grab files from SAM and run over them
+# Run the consumers, and then clean it all up
 #-------------------------------------------------------------------------------
-res=0
-n_skipped_in_a_row=0
-while [ "$res" = 0 ]; do
-    check_lifetime || break
-    echo ""
-    echo "Getting the next file!"
-    get_next_file || break
-    if [ -z "${fname}" ]; then
-        echo "No files returned by SAM project.  Most likely all files in the project have already been seen."
-        break
-    fi
-    ifdh updateFileStatus ${projurl}  ${consumer_id} ${fname} transferred
-
-    update_input_file || break
-
-    echo ""
-    echo "Running: ${command}"    
-    if eval "${command}"; then
-        ifdh updateFileStatus ${projurl}  ${consumer_id} ${fname} consumed
-        n_skipped_in_a_row=0
-    else
-        command_exit_code=$?
-	((n_skipped_in_a_row++))
-        if [[ ${n_skipped_in_a_row} -ge ${n_max_files_skipped} ]]; then
-	    echo "Reached limit of ${n_skipped_in_a_row} failed jobs in a row. Returning error code of ${command_exit_code} and ending the multi-file loop."
-            res=${command_exit_code}
-	else
-	    echo "Command returned an error code of ${command_exit_code}, marking file as skipped. This is skip ${n_skipped_in_a_row out} of a maximum of ${n_max_files_skipped}."
-	fi
-        ifdh updateFileStatus ${projurl}  ${consumer_id} ${fname} skipped
-    fi
-
-    if ${rename_outputs}; then
-	rename_output_files
-    fi
-
-    if ${quick_copy}; then
-	copy_out
-    fi
-done
-
-
-#-------------------------------------------------------------------------------
-# Kick out if the while loop failed, but copy back for debugging
-#-------------------------------------------------------------------------------
-if [ "${res}" != "0" ]; then
-    echo "ls /var/lib/systemd/coredump/"
-    ls /var/lib/systemd/coredump/
+if [ ${workers} -gt 1 ]; then
+    echo "Running ${workers} workers"
+    for worker in `seq 1 ${workers}`; do
+	run_worker ${worker} 2>&1 | sed -u "s/^/[worker ${worker}] /" &
+    done
+    wait
 
-    copy_out
-    clean_it_up
-    exit ${res}
+    res=0
+    for worker in `seq 1 ${workers}`; do
+	wres=`cat ${topDir}/worker_w${worker}.res 2> /dev/null || echo 1`
+	echo "Worker ${worker} returned ${wres}"
+	[ "${res}" = "0" ] && res=${wres}
+    done
+else
+    run_consumer
+    res=$?
 fi
 
-#-------------------------------------------------------------------------------
-# the post execution scripts
-#-------------------------------------------------------------------------------
-for blat in $postscripts; do
-    blat=${CONDOR_DIR_INPUT}/${blat}
-    blat=`echo $blat | sed -e 's/:/ /g'`
-    eval blat=$blat
-    echo "doing: $blat"
-    eval "$blat"
-    postres=$?
-    if [ "$res" = "0" -a "$postres" != "0" ]; then
-	res=$postres
-    fi
-done
-
-#-------------------------------------------------------------------------------
-# Now, to copy things out and clean it all up
-#-------------------------------------------------------------------------------
-copy_out
 clean_it_up
 exit ${res}
@@ -0,0 +1,327 @@
+#!/bin/env python3
+
+'''
+Build slim ToolAnalysis tarballs for grid jobs, and keep track of the ones that have
+already been staged, by the hash of their contents, so the same build only has to be
+copied over once.
+'''
+
+from __future__ import print_function
+from __future__ import division
+import os, re
+import fnmatch
+import hashlib
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+
+default_index = os.path.join(os.path.expanduser('~'), '.cache', 'annie_grid', 'tarballs.json')
+
+def load_index(index_file):
+    '''
+    The index has the hash of every tarball we've looked at, keyed by path, size and mtime,
+    and where each hash has been staged
+    '''
+    if not os.path.isfile(index_file):
+        return {'files' : {}, 'staged' : {}}
+    with open(index_file) as f:
+        return json.load(f)
+
+def save_index(index, index_file):
+    index_dir = os.path.dirname(index_file)
+    if index_dir and not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    tmp_file = "%s.%d.tmp" % (index_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_file, index_file)
+
+def tarball_hash(tarball, index):
+    '''
+    sha256 of the tarball. It's only read again if it has changed since the last time.
+    '''
+    path = os.path.abspath(tarball)
+    st = os.stat(path)
+    known = index['files'].get(path)
+    if known and known['size'] == st.st_size and known['mtime'] == st.st_mtime:
+        return known['hash']
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b''):
+            sha.update(block)
+    index['files'][path] = {'size' : st.st_size, 'mtime' : st.st_mtime, 'hash' : sha.hexdigest()}
+    return sha.hexdigest()
+
+def can_stage(stage_dir):
+    '''
+    Whether tarballs can be staged in stage_dir, which is made if it doesn't exist yet
+    '''
+    path = os.path.abspath(stage_dir)
+    while not os.path.isdir(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return os.access(path, os.W_OK | os.X_OK)
+
+def stage_tarball(tarball, stage_dir, index_file=default_index, dry_run=False):
+    '''
+    Copy the tarball to stage_dir/<hash>/<name>, unless a tarball with the same hash is
+    already staged somewhere. Returns (staged location, hash, whether it was reused).
+    '''
+    index = load_index(index_file)
+    known = index['files'].get(os.path.abspath(tarball))
+    digest = tarball_hash(tarball, index)
+    size = os.path.getsize(tarball)
+    if dry_run and index['files'][os.path.abspath(tarball)] is not known:
+        # nothing is staged, but the hash saves reading the tarball again next time
+        save_index(index, index_file)
+
+    staged = index['staged'].get(digest)
+    if staged and os.path.isfile(staged['location']) and os.path.getsize(staged['location']) == size:
+        staged['used'] = time.time()
+        if not dry_run:
+            save_index(index, index_file)
+        return staged['location'], digest, True
+
+    location = os.path.join(stage_dir, digest, os.path.basename(tarball))
+    if not dry_run:
+        if not os.path.isdir(os.path.dirname(location)):
+            os.makedirs(os.path.dirname(location))
+        # copy to a temporary name first so a half copied tarball is never picked up
+        shutil.copyfile(tarball, location + '.part')
+        os.rename(location + '.part', location)
+        index['staged'][digest] = {'location' : location, 'size' : size, 'staged' : time.time(), 'used' : time.time()}
+        save_index(index, index_file)
+    return location, digest, False
+
+#--------------------------------------------------------------------------------
+# Building a slim tarball
+#--------------------------------------------------------------------------------
+header_exts = ('.h', '.hh', '.hpp', '.hxx', '.icc', '.ipp', '.inl', '.tcc', '.pcm')
+
+# the files at the top of ToolAnalysis that Analyse needs
+top_level_files = ['Analyse', 'Setup.sh']
+
+def is_library(name):
+    return name.endswith('.so') or '.so.' in name
+
+def needed_at_runtime(relpath, config, extra_patterns=[]):
+    '''
+    Whether a file in ToolAnalysis is needed to run Analyse with config on the grid:
+    the executable and Setup.sh, libraries, the headers ROOT needs to find through
+    ROOT_INCLUDE_PATH, and configfiles, which tool chains share files from and is small.
+    Anything matching one of the extra_patterns is kept as well.
+    '''
+    parts = relpath.split('/')
+    name = parts[-1]
+    if '.git' in parts:
+        return False
+    if any(fnmatch.fnmatch(relpath, pattern) for pattern in extra_patterns):
+        return True
+    if len(parts) == 1:
+        return name in top_level_files
+    if parts[0] == 'lib':
+        return not name.endswith(('.o', '.d'))
+    if parts[0] == 'configfiles':
+        return True
+    if parts[0] in ['DataModel', 'ToolDAQ']:
+        return name.endswith(header_exts) or is_library(name)
+    return False
+
+def select_files(tool_dir, config, extra_patterns=[]):
+    '''
+    Split everything in tool_dir into what goes in the tarball and what is left out, as
+    lists of (relative path, size). Symbolic links at the top level are the configs the
+    tool chains are run with, so they're kept.
+    '''
+    keep = []
+    leave = []
+    for dirpath, dirnames, filenames in os.walk(tool_dir):
+        reldir = os.path.relpath(dirpath, tool_dir)
+        if reldir == '.':
+            reldir = ''
+            # the config links point at directories, which os.walk lists as directories
+            for dirname in list(dirnames):
+                if os.path.islink(os.path.join(dirpath, dirname)):
+                    keep.append((dirname, 0))
+                    dirnames.remove(dirname)
+        if '.git' in dirnames:
+            dirnames.remove('.git')
+        dirnames.sort()
+        for filename in sorted(filenames):
+            relpath = os.path.join(reldir, filename) if reldir else filename
+            path = os.path.join(dirpath, filename)
+            size = 0 if os.path.islink(path) else os.path.getsize(path)
+            if (not reldir and os.path.islink(path)) or needed_at_runtime(relpath, config, extra_patterns):
+                keep.append((relpath, size))
+            else:
+                leave.append((relpath, size))
+    return keep, leave
+
+def left_out_references(tool_dir, config, keep):
+    '''
+    Paths in ToolAnalysis that the configs of config refer to, directly or through the other
+    configs they name, but that aren't in keep. Tool chains run from the top of ToolAnalysis,
+    so relative paths are taken from there. Returns a list of (config file, path).
+    '''
+    kept = set(relpath for relpath, size in keep)
+    config_dir = os.path.join('configfiles', config)
+    to_read = [relpath for relpath in sorted(kept) if relpath.startswith(config_dir + '/')]
+    seen = set(to_read)
+    missing = []
+    while to_read:
+        config_file = to_read.pop(0)
+        try:
+            with open(os.path.join(tool_dir, config_file)) as f:
+                lines = f.readlines()
+        except (IOError, UnicodeDecodeError):
+            continue
+        for line in lines:
+            for word in line.split('#')[0].split():
+                path = os.path.normpath(word.strip('"\',;'))
+                if '/' not in word or os.path.isabs(path) or path.startswith('..'):
+                    continue
+                full = os.path.join(tool_dir, path)
+                if (config_file, path) in missing:
+                    continue
+                if os.path.isfile(full):
+                    if path not in kept:
+                        missing.append((config_file, path))
+                    elif path.startswith('configfiles/') and path not in seen:
+                        # configs can name other configs
+                        seen.add(path)
+                        to_read.append(path)
+                elif os.path.isdir(full):
+                    for dirpath, dirnames, filenames in os.walk(full):
+                        if any(os.path.relpath(os.path.join(dirpath, name), tool_dir) not in kept for name in filenames):
+                            missing.append((config_file, path))
+                            break
+    return missing
+
+def compressor(level):
+    '''
+    zstd using every core if it's there, otherwise pigz or gzip. Returns (command, extension).
+    '''
+    if shutil.which('zstd'):
+        return ['zstd', '-T0', '-q', '-%d' % level], '.tar.zst'
+    if shutil.which('pigz'):
+        return ['pigz', '-c', '-%d' % min(level, 9)], '.tar.gz'
+    return ['gzip', '-c', '-%d' % min(level, 9)], '.tar.gz'
+
+def build_tarball(tool_dir, config, output=None, extra_patterns=[], level=10):
+    '''
+    Make a tarball of what's needed from tool_dir to run config. The files are added in a fixed
+    order and owned by root so that building the same ToolAnalysis twice gives the same tarball,
+    which stage_tarball can then reuse. Returns (tarball, files kept, files left out).
+    '''
+    tool_dir = os.path.abspath(tool_dir)
+    if not os.path.isdir(os.path.join(tool_dir, 'configfiles', config)):
+        raise ValueError("%s has no configfiles/%s" % (tool_dir, config))
+
+    keep, leave = select_files(tool_dir, config, extra_patterns)
+    command, extension = compressor(level)
+    if output is None:
+        output = os.path.basename(tool_dir.rstrip('/')) + '_' + config + extension
+
+    file_list = tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False)
+    try:
+        file_list.write('\n'.join(relpath for relpath, size in keep) + '\n')
+        file_list.close()
+        with open(output + '.part', 'wb') as out:
+            tar = subprocess.Popen(['tar', '--sort=name', '--owner=0', '--group=0', '--numeric-owner',
+                                    '--no-recursion', '-C', tool_dir, '-cf', '-', '-T', file_list.name],
+                                   stdout=subprocess.PIPE)
+            compress = subprocess.Popen(command, stdin=tar.stdout, stdout=out)
+            tar.stdout.close()
+            if compress.wait() != 0 or tar.wait() != 0:
+                raise OSError("tar or %s failed while building %s" % (command[0], output))
+        os.rename(output + '.part', output)
+    finally:
+        os.remove(file_list.name)
+        if os.path.exists(output + '.part'):
+            os.remove(output + '.part')
+
+    return output, keep, leave
+
+def print_tarball_report(tarball, keep, leave):
+    '''
+    What went into the tarball, grouped by the top level directory, and what it saved
+    '''
+    def by_top_dir(files):
+        groups = {}
+        for relpath, size in files:
+            top = relpath.split('/')[0] if '/' in relpath else '(top level)'
+            nfiles, nbytes = groups.get(top, (0, 0))
+            groups[top] = (nfiles + 1, nbytes + size)
+        return groups
+
+    kept_bytes = sum(size for relpath, size in keep)
+    left_bytes = sum(size for relpath, size in leave)
+    size = os.path.getsize(tarball)
+
+    print("Built %s: %.1f MB, from %d files and %.1f MB unpacked (%.1fx compression)" %
+          (tarball, size / 1e6, len(keep), kept_bytes / 1e6, kept_bytes / max(1, size)))
+    header = "  %-30s %8s %10s" % ('', 'files', 'MB')
+    print(header)
+    for top, (nfiles, nbytes) in sorted(by_top_dir(keep).items()):
+        print("  %-30s %8d %10.1f" % (top, nfiles, nbytes / 1e6))
+    print("Left out %d files, %.1f MB, that aren't needed to run Analyse:" % (len(leave), left_bytes / 1e6))
+    for top, (nfiles, nbytes) in sorted(by_top_dir(leave).items(), key=lambda item: -item[1][1])[:10]:
+        print("  %-30s %8d %10.1f" % (top, nfiles, nbytes / 1e6))
+
+#--------------------------------------------------------------------------------
+# Checking what's in a tarball
+#--------------------------------------------------------------------------------
+def tarball_members(tarball):
+    '''
+    Names of everything in the tarball without unpacking it, with any leading ./ taken off.
+    tar works out the compression itself.
+    '''
+    listing = subprocess.run(['tar', '-tf', tarball], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    if listing.returncode != 0:
+        raise OSError(listing.stderr.strip() or "tar -tf %s failed" % tarball)
+    members = {}
+    for name in listing.stdout.splitlines():
+        members[re.sub('^(\\./)+', '', name).rstrip('/')] = name
+    return members
+
+def read_member(tarball, member):
+    return subprocess.run(['tar', '-xOf', tarball, member], stdout=subprocess.PIPE, check=True,
+                          universal_newlines=True).stdout
+
+def check_tarball(tarball, config, input_file_config, input_config_var=None):
+    '''
+    Look for the problems that would otherwise only show up once jobs unpack the tarball.
+    Returns a list of them, which is empty if it's all fine.
+    '''
+    try:
+        members = tarball_members(tarball)
+    except OSError as e:
+        return ["Could not list what is in %s: %s" % (tarball, e)]
+
+    def has(path):
+        # tarballs don't always have entries for the directories
+        return path in members or any(name.startswith(path + '/') for name in members)
+
+    if not has('configfiles'):
+        return ["%s has no configfiles at the top. It's best to tar from within your ToolAnalysis directory." % tarball]
+
+    problems = []
+    for path in ['Analyse', 'Setup.sh', 'configfiles/%s/ToolChainConfig' % config]:
+        if not has(path):
+            problems.append("%s has no %s" % (tarball, path))
+
+    ifconf = 'configfiles/%s/%s' % (config, input_file_config)
+    if ifconf not in members:
+        problems.append("%s has no %s" % (tarball, ifconf))
+    elif input_config_var:
+        try:
+            contents = read_member(tarball, members[ifconf])
+        except subprocess.CalledProcessError:
+            return problems + ["Could not read %s from %s" % (ifconf, tarball)]
+        if not re.search('^%s ' % re.escape(input_config_var), contents, re.MULTILINE):
+            problems.append("%s in %s has no line starting with %s, so the input file can't be set" %
+                            (ifconf, tarball, input_config_var))
+    return problems
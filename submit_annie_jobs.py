@@ -8,12 +8,23 @@ from builtins import str
 #from past.utils import old_div
 import os, sys, stat, pwd, re, glob
 import argparse
+import collections
+import copy
 import datetime
-import samweb_client
+import annie_sam_status
+import annie_job_history
+import annie_tarball
 import string
 import tokenize
 import io
 import subprocess
+import heapq
+import json
+import shlex
+import threading
+import time
+from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 
 # "Working" sites for all experiments from https://cdcvs.fnal.gov/redmine/projects/fife/wiki/Information_about_job_submission_to_OSG_sites
 recommended_sites = [
@@ -26,11 +37,9 @@ recommended_sites = [
 # Discovered through testing
 excluded_sites = [ 'Omaha', 'Swan', 'Wisconsin']
 
-jobsub_opts = []
-
-annie_sam_wrap_cmd =os.getenv('ANNIEGRIDUTILSDIR')+'/annie_sam_wrap.sh'
-annie_sam_wrap_opts = []
+annie_sam_wrap_cmd = os.getenv('ANNIEGRIDUTILSDIR', os.path.dirname(os.path.abspath(__file__)))+'/annie_sam_wrap.sh'
 
+# every submission starts from these, see SubmissionPlan
 export_to_annie_sam_wrap = ['GRID_USER', 'EXPERIMENT', 'SAM_EXPERIMENT', 'SAM_STATION', 'SAM_PROJECT_NAME', 'IFDH_BASE_URI']
 
 # setup usage models to use and  sites we're going to use
@@ -43,9 +52,49 @@ sources = []
 pre_scripts = []
 post_scripts = []
 
+# jobsub won't take more than this many jobs in one cluster
+max_jobs_per_cluster = 5000
+
+# the arguments every project was submitted with, for --recover_project
+submissions_dir = os.path.join(os.path.expanduser('~'), '.cache', 'annie_grid', 'submissions')
+
+# what the named --expected_lifetime values mean in seconds
+named_lifetimes = {'short' : 6*3600, 'medium' : 12*3600, 'long' : 24*3600}
+
+# the SAM client, which is only made by sam_client once something needs it
+samweb = None
+sam_lock = threading.Lock()
+
+# answers to SAM queries by (query, defname), so that they can be made ahead of time by prefetch_sam
+sam_answers = {}
+
+# file counts and metadata of the definitions SAM has been asked about, kept for --sam_cache_ttl
+default_sam_cache = os.path.join(os.path.expanduser('~'), '.cache', 'annie_grid', 'sam_definitions.json')
+sam_cache = None
+
+# what listFiles gives for each file, as it's kept in the cache
+FileInfo = collections.namedtuple('FileInfo', 'file_name file_id file_size event_count')
+
+# the --auto_sites ranking for each (history, config), so it's only worked out and printed once
+site_rankings = {}
+
+# checks that have already passed, so that planning several submissions only runs each one once
+passed_checks = set()
+
+# every option build_parser adds, with the name it's stored under, and the ones that don't take a value
+parser_dests = {}
+parser_flags = set()
+
 timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 user=os.getenv("USER")
 
+def fail(msg):
+    print("Error: %s" % msg, file=sys.stderr)
+    sys.exit(1)
+
+def warn(msg):
+    print("Warning: %s" % msg, file=sys.stderr)
+
 def remove_comments(src):
     '''
     This reads tokens using tokenize.generate_tokens and recombines them
@@ -77,88 +126,499 @@ def remove_comments(src):
 
     return tokenize.untokenize(processed_tokens)
 
-def build_jobsub_cmd(jobsub_opts):
-    jobsub_cmd = 'jobsub_submit'
+def file_cost(fileinfo, balance_by):
+    '''
+    The cost of running over a file, either its size in bytes or its number of events
+    '''
+    if balance_by == 'bytes':
+        return fileinfo.file_size
 
-    # Add exported environment variables
-    jobsub_opts += ['-e ' + export for export in export_to_annie_sam_wrap]
-        
-    # Add tarball and SAM wrapper script with its options
-    #jobsub_opts += ['--tar_file_name dropbox://' + args.tarball]
-    jobsub_opts += ['-f dropbox://' + args.tarball]
-    jobsub_opts += ['file://' + annie_sam_wrap_cmd]
-    jobsub_opts += [' ' + ' '.join(annie_sam_wrap_opts)]
+    if fileinfo.event_count is None:
+        fail("%s has no event_count in its metadata, so it can't be balanced by events" % fileinfo.file_name)
+    return fileinfo.event_count
 
-    jobsub_cmd += ' ' + ' '.join([opt for opt in jobsub_opts])
+def simulate_jobs(costs, njobs, job_done):
+    '''
+    Simulate SAM handing out files, in order, to njobs jobs that all start at the same time.
+    A job asks for another file as soon as it finishes the last one, until job_done(cost, nfiles)
+    says it's had enough. Returns the total cost that each job ends up running over.
+    '''
+    job_costs = [0] * njobs
+    job_files = [0] * njobs
+    ready = [(0, ijob) for ijob in range(njobs)] # (time the job wants its next file, job)
+    for cost in costs:
+        if not ready:
+            break
+        when, ijob = heapq.heappop(ready)
+        job_costs[ijob] += cost
+        job_files[ijob] += 1
+        if not job_done(job_costs[ijob], job_files[ijob]):
+            heapq.heappush(ready, (when + cost, ijob))
+
+    return job_costs
+
+def print_projection(label, job_costs, balance_by, rate):
+    '''
+    Print the spread of work between jobs along with the expected runtimes
+    '''
+    job_costs = sorted(job_costs)
+    if balance_by == 'bytes':
+        scale, unit = 1e9, 'GB'
+        rate *= 1e6
+    else:
+        scale, unit = 1., 'events'
 
-    return jobsub_cmd
+    print("  %-24s min %10.2f  median %10.2f  max %10.2f %-6s  longest job ~%.1fh" %
+          (label, job_costs[0]/scale, job_costs[len(job_costs)//2]/scale, job_costs[-1]/scale, unit,
+           job_costs[-1]/rate/3600.))
 
-    
-#######################################################################################
-if __name__=='__main__':
-    prog=os.path.basename(sys.argv[0])
+def sam_client():
+    '''
+    The SAM client, which is imported and made the first time it's needed
+    '''
+    global samweb
+    with sam_lock:
+        if samweb is None:
+            if os.getenv('ANNIE_FAKE_GRID'):
+                import annie_fake_grid as samweb_client
+            else:
+                import samweb_client
+            samweb = samweb_client.SAMWebClient(experiment='annie')
+    return samweb
 
-    while "-f" in sys.argv or "--file" in sys.argv:
-        ### Allow args to be passed in as a plain text file.
-        ### We make a preliminary parser get these arguments out for two reasons:
-        ###    1)  Maintain standard -h, --help functionality
-        ###    2)  Avoid necessity required arguments in initial parsing,
-        ###        allow them to be missing, but find them in the file.
-        preliminary_parser = argparse.ArgumentParser(prog=prog, description='Submit annie grid job')
+def ask_sam(args, query, defname, ask):
+    '''
+    The answer to a query about defname. It comes from the cache if SAM was asked less than
+    --sam_cache_ttl seconds ago, unless --refresh_sam was given, and SAM is only asked once
+    per query while this is running either way.
+    '''
+    global sam_cache
+    if (query, defname) in sam_answers:
+        return sam_answers[(query, defname)]
+
+    with sam_lock:
+        if sam_cache is None:
+            sam_cache = annie_sam_status.load_cache(default_sam_cache)
+        entry = sam_cache.get(defname, {}).get(query)
+    if entry and not args.refresh_sam and time.time() - entry['fetched'] < args.sam_cache_ttl:
+        sam_answers[(query, defname)] = entry['answer']
+        return entry['answer']
+
+    answer = ask()
+    sam_answers[(query, defname)] = answer
+    if args.sam_cache_ttl > 0:
+        with sam_lock:
+            sam_cache.setdefault(defname, {})[query] = {'answer' : answer, 'fetched' : time.time()}
+            annie_sam_status.save_cache(sam_cache, default_sam_cache)
+    return answer
+
+def count_files(args, defname):
+    return ask_sam(args, 'count', defname, lambda: sam_client().countFiles(defname=defname))
+
+def list_files(args, defname):
+    files = ask_sam(args, 'list', defname,
+                    lambda: [list(f[:4]) for f in sam_client().listFiles(defname=defname, fileinfo=True)])
+    return [FileInfo(*f) for f in files]
+
+def prefetch_sam(args, defnames, threads=8):
+    '''
+    Make the SAM queries that planning a submission of each of defnames with args will need,
+    all at once, so that planning them afterwards doesn't have to wait on SAM
+    '''
+    queries = []
+    for defname in defnames:
+        if args.balance_by:
+            queries.append((list_files, defname))
+        if args.autotune or (args.files_per_job > 0 and args.njobs <= 0 and not args.balance_by):
+            queries.append((count_files, defname))
+    if not queries:
+        return
+
+    with ThreadPoolExecutor(max_workers=max(1, min(threads, len(queries)))) as pool:
+        list(pool.map(lambda query: query[0](args, query[1]), queries))
+
+def plan_balanced_jobs(args):
+    '''
+    Pick the number of jobs so that each one runs over about --target_runtime worth of
+    bytes or events, and print how that compares to giving every job the same number of files.
+    With --files_per_job as well, there are enough jobs for the limits to cover every file.
+    Returns the number of jobs and the bytes or events each one should run over.
+    '''
+    print("Getting the file sizes and event counts for %s" % args.defname)
+    files = list_files(args, args.defname)
+    if not files:
+        fail("No files found in %s" % args.defname)
+
+    costs = [file_cost(f, args.balance_by) for f in files]
+    total = sum(costs)
+    if args.balance_by == 'bytes':
+        budget = int(args.process_rate * 1e6 * args.target_runtime)
+    else:
+        budget = int(args.process_rate * args.target_runtime)
+    if budget <= 0:
+        fail("--process_rate and --target_runtime must be positive")
+    njobs = -(-total // budget)
+    limit = args.files_per_job if args.files_per_job > 0 else len(costs)
+    if -(-len(costs) // limit) > njobs:
+        njobs = -(-len(costs) // limit)
+        print("Using %d jobs so that --files_per_job %d covers all %d files" % (njobs, limit, len(costs)))
+
+    # every job keeps asking for files until it's over budget, so between them they will always get through everything
+    balanced = simulate_jobs(costs, njobs, lambda cost, nfiles: cost >= budget or nfiles >= limit)
+    if sum(balanced) < total:
+        warn("Some files may not be run over with --files_per_job %d, raise it or --target_runtime" % limit)
+    files_per_job = -(-len(costs) // njobs)
+    by_count = simulate_jobs(costs, njobs, lambda cost, nfiles: nfiles >= files_per_job)
+
+    print("%d files with a total of %d %s. Each job will run over about %d %s" %
+          (len(costs), total, args.balance_by, budget, args.balance_by))
+    print("Projected work per job for %d jobs:" % njobs)
+    print_projection("balanced by %s" % args.balance_by, balanced, args.balance_by, args.process_rate)
+    print_projection("%d files per job" % files_per_job, by_count, args.balance_by, args.process_rate)
+
+    return njobs, budget
+
+def autotune_resources(args, given, files_per_consumer):
+    '''
+    Suggest --memory, --disk and --expected_lifetime from what past jobs with the same --config
+    used. With --autotune apply, the ones that aren't in given, the options that were on the
+    command line, are replaced.
+    '''
+    history = annie_job_history.open_history(args.history)
+    annie_job_history.update_history(history)
+    samples = annie_job_history.resource_samples(history, args.config)
+    suggestion = annie_job_history.suggest_resources(samples, files_per_consumer, args.workers, args.autotune_percentile)
+
+    print("Resources used by %d past jobs with %s, at the %gth percentile for %d files per consumer and %d worker(s):" %
+          (suggestion['jobs'], args.config, args.autotune_percentile, files_per_consumer, args.workers))
+    for name, unit in [('memory', 'MB'), ('disk', 'MB'), ('lifetime', 's')]:
+        arg = 'expected_lifetime' if name == 'lifetime' else name
+        current = getattr(args, arg)
+        if suggestion[name] is None:
+            print("  --%-18s %8s%-2s  (not enough history)" % (arg, current, unit))
+            continue
+
+        # only replace what wasn't asked for explicitly
+        apply = args.autotune == 'apply' and arg not in given
+        print("  --%-18s %8s%-2s  suggested %d%s%s" % (arg, current, unit, suggestion[name], unit, ', using that' if apply else ''))
+        if apply:
+            setattr(args, arg, suggestion[name] if name != 'lifetime' else str(suggestion[name]))
+
+def save_campaign(state, state_file):
+    '''
+    Write out the campaign state so that it can be picked up again with --resume_campaign
+    '''
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_file, state_file)
 
-        preliminary_parser.add_argument('-f', '--file',
-                        help='''Text file containing any arguments to this utility.  Multiple allowed.
-                        Arguments should look just like they would on the command line,
-                        but the parsing of this file is whitespace insenstive.
-                        Commented lines will be identified with the # character and removed. ''', type=str, action='append')
-        pre_args, unknown = preliminary_parser.parse_known_args()
+def count_outstanding_jobs(jobid):
+    '''
+    Number of jobs from a cluster that are still in the queue, or None if jobsub_q didn't work
+    '''
+    try:
+        out = subprocess.check_output(['jobsub_q', '-G', 'annie', '--jobid=%s' % jobid],
+                                      stderr=subprocess.STDOUT, universal_newlines=True)
+    except (subprocess.CalledProcessError, OSError) as e:
+        warn("jobsub_q failed for %s: %s" % (jobid, e))
+        return None
 
-        # Remove pre_args from sys.argv so they are not processed again
-        sys.argv = [x for x in sys.argv if x not in [ "-f", "--file"]]
+    # condor style summary: "N jobs; X completed, Y removed, Z idle, W running, H held, S suspended"
+    summary = re.search(r'(\d+) jobs?;\s*(\d+) completed,\s*(\d+) removed', out)
+    if summary:
+        return int(summary.group(1)) - int(summary.group(2)) - int(summary.group(3))
 
-        if pre_args.file:
-            for filepath in pre_args.file:
-                index = sys.argv.index(filepath)
-                sys.argv.remove(filepath)
-                if os.path.isfile(filepath):
-                    fullpath = filepath
-                else:
-                    print("%s was not found. Exiting." %filepath)
-                    sys.exit(1)
-                text = open(fullpath, 'r').read()
-                text = remove_comments(text) # Strip out commented lines
-                newargs = []
-                for line in text.splitlines():
-                    # Insert arguments into list in order
-                    # where the -f appeared
-                    newargs += line.split()
-                sys.argv[index:index] = newargs
+    cluster = jobid.split('@')[0].split('.')[0]
+    return len([line for line in out.splitlines() if line.startswith(cluster + '.')])
 
-    
+def wait_for_room(state, spacing):
+    '''
+    Wait until it's been long enough since the last cluster went in, and until there's room
+    under maxConcurrent for the next one. Returns the maxConcurrent to give the next cluster.
+    '''
+    if state['clusters']:
+        wait = state['clusters'][-1]['submitted'] + spacing - time.time()
+        if wait > 0:
+            print("Waiting %d seconds before submitting the next cluster" % wait)
+            sleep(wait)
+
+    max_concurrent = state['max_concurrent']
+    if not max_concurrent:
+        return 0
+
+    remaining = state['njobs'] - sum(cluster['njobs'] for cluster in state['clusters'])
+    # don't bother with clusters that can only run a handful of jobs at a time
+    wanted = max(1, min(max_concurrent // 10, remaining))
+    while True:
+        outstanding = 0
+        for cluster in state['clusters']:
+            count = count_outstanding_jobs(cluster['jobid'])
+            # if we can't tell then assume the worst
+            outstanding += cluster['max_concurrent'] if count is None else min(count, cluster['max_concurrent'])
+
+        allowed = max_concurrent - outstanding
+        if allowed >= wanted:
+            return allowed
+
+        print("%d jobs are still queued or running, waiting for room under maxConcurrent=%d" % (outstanding, max_concurrent))
+        sleep(spacing)
+
+def run_campaign(plan, state, state_file, dry_run=False):
+    '''
+    Submit state['njobs'] jobs as a series of clusters of at most max_jobs_per_cluster,
+    spaced out by state['spacing'] seconds and keeping the total number of running jobs
+    under state['max_concurrent']. Every cluster is recorded in state_file as it goes in.
+    '''
+    submitted = sum(cluster['njobs'] for cluster in state['clusters'])
+    # dry runs don't record their clusters in state, so count them here
+    nclusters = len(state['clusters'])
+    while submitted < state['njobs']:
+        nclusters += 1
+        cluster_size = min(max_jobs_per_cluster, state['njobs'] - submitted)
+        if dry_run:
+            max_concurrent = state['max_concurrent']
+        else:
+            max_concurrent = wait_for_room(state, state['spacing'])
+
+        jobsub_cmd = jobsub_argv(plan, cluster_size, max_concurrent)
+        print("\nSubmitting cluster %d: jobs %d-%d of %d" %
+              (nclusters, submitted + 1, submitted + cluster_size, state['njobs']))
+        print(command_line(jobsub_cmd))
+        sys.stdout.flush()
+
+        proc = subprocess.Popen(jobsub_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+        out = proc.communicate()[0]
+        print(out)
+        if dry_run:
+            submitted += cluster_size
+            continue
+
+        jobid = re.search(r'Use job id (\S+) to retrieve output', out)
+        if proc.returncode != 0 or not jobid:
+            fail("Submitting cluster %d failed. Once the problem is fixed, rerun the same command with "\
+                 "--resume_campaign %s" % (nclusters, state_file))
+
+        state['clusters'].append({'jobid' : jobid.group(1), 'njobs' : cluster_size,
+                                  'max_concurrent' : max_concurrent, 'submitted' : time.time()})
+        save_campaign(state, state_file)
+        submitted += cluster_size
+
+    print("\nAll %d jobs for %s have been submitted in %d clusters" % (state['njobs'], state['project_name'], nclusters))
+
+def save_submission(project_name, argv, defname, njobs):
+    '''
+    Remember what a project was submitted with so that --recover_project can submit it again
+    '''
+    if not os.path.isdir(submissions_dir):
+        os.makedirs(submissions_dir)
+    with open(os.path.join(submissions_dir, project_name + '.json'), 'w') as f:
+        json.dump({'project_name' : project_name, 'argv' : argv, 'defname' : defname, 'njobs' : njobs,
+                   'submitted' : time.time()}, f, indent=2)
+
+def drop_args(argv, names, flags=()):
+    '''
+    argv without the named options and their values. The options in flags don't have a value.
+    '''
+    kept = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in names:
+            skip = arg not in flags
+        elif arg.split('=')[0] not in names:
+            kept.append(arg)
+    return kept
+
+def given_options(argv):
+    '''
+    The long options in argv, without their values
+    '''
+    return set(arg.split('=')[0] for arg in argv if arg.startswith('--'))
+
+def recovery_argv(project, argv):
+    '''
+    The arguments to submit the files of project that were skipped or never delivered. They are
+    the ones project was submitted with, with the defname swapped for a new definition of those
+    files and the number of jobs scaled down to match. Options in argv replace the same ones
+    in the original arguments. With --test in argv the definition isn't made.
+    '''
+    submission_file = os.path.join(submissions_dir, project + '.json')
+    if not os.path.isfile(submission_file):
+        fail("There is no record of how %s was submitted in %s, so it can't be recovered automatically" %
+             (project, submissions_dir))
+    with open(submission_file) as f:
+        submission = json.load(f)
+
+    try:
+        entry = annie_sam_status.get_summaries([project], os.getenv('IFDH_BASE_URI', annie_sam_status.default_base_uri),
+                                               {}, force=True)[project][0]
+    except Exception:
+        entry = None
+    if entry:
+        consumed, skipped, remaining, total = annie_sam_status.file_counts(entry['summary'])
+        print("%s: %d files consumed, %d skipped, %d never delivered" % (project, consumed, skipped, remaining))
+        if entry['summary'].get('project_status') not in annie_sam_status.finished_states:
+            warn("%s is still %s, files that are being run over now will be recovered too" %
+                 (project, entry['summary'].get('project_status')))
+
+    samweb = sam_client()
+    dimensions = samweb.projectRecoveryDimension(project)
+    nrecover = samweb.countFiles(dimensions=dimensions)
+    if nrecover == 0:
+        print("Every file in %s was consumed, there is nothing to recover" % project)
+        sys.exit(0)
+
+    # keep the same number of files per job as the original submission
+    ntotal = samweb.countFiles(dimensions='snapshot_for_project_name %s' % project)
+    njobs = max(1, -(-nrecover * submission['njobs'] // ntotal)) if submission['njobs'] > 0 and ntotal > 0 else 0
+
+    defname = "%s_recovery_%s" % (project, timestamp)
+    argv = drop_args(argv, ['--recover_project', '--defname', '--continue_project', '--resume_campaign'])
+    build_parser()      # for parser_flags
+    new_argv = drop_args(submission['argv'], given_options(argv) | set(['--defname', '--njobs', '--continue_project', '--resume_campaign']),
+                         parser_flags)
+    new_argv += ['--defname', defname]
+    if njobs > 0 and '--njobs' not in given_options(argv):
+        new_argv += ['--njobs', str(njobs)]
+    new_argv += argv
+
+    if '--test' in argv:
+        print("Would create %s with the %d files to recover: %s" % (defname, nrecover, dimensions))
+        # the definition doesn't exist, so answer for it here
+        sam_answers[('count', defname)] = nrecover
+        if '--balance_by' in given_options(new_argv):
+            sam_answers[('list', defname)] = [list(f[:4]) for f in samweb.listFiles(dimensions=dimensions, fileinfo=True)]
+    else:
+        samweb.createDefinition(defname, dimensions, group='annie', description='Files of %s that were not consumed' % project)
+        print("Created %s with the %d files to recover" % (defname, nrecover))
+    return new_argv
+
+def check_input_file(label, path):
+    '''
+    Problems with one of the files sent with the jobs, which have to be on /pnfs
+    '''
+    if not os.path.expandvars(path).startswith("/pnfs/"):
+        return ["%s %s must be in dCache /pnfs/annie/" % (label, path)]
+    if not os.path.isfile(os.path.expandvars(path)):
+        return ["%s %s does not exist!" % (label, path)]
+    return []
+
+def preflight(checks, threads=16):
+    '''
+    Run all of the checks at once, since each one can wait a while on /pnfs, and fail with
+    every problem they find before anything is started. Each check is (function, args...)
+    and the function returns a list of problems.
+    '''
+    checks = [check for check in checks if check not in passed_checks]
+    if not checks:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(threads, len(checks)))) as pool:
+        results = list(pool.map(lambda check: check[0](*check[1:]), checks))
+
+    problems = [problem for result in results for problem in result]
+    if problems:
+        fail("Found %d problem(s) before submitting:\n    %s" % (len(problems), "\n    ".join(problems)))
+    passed_checks.update(checks)
+
+class SubmissionPlan(object):
+    '''
+    Everything needed to submit one set of jobs, worked out from the arguments by plan_submission.
+    Nothing in it has been started yet: jobsub_argv gives the command it would be submitted with
+    and submit starts the project and submits it.
+    '''
+    def __init__(self, args, argv):
+        self.args = args
+        self.argv = argv                    # the command line arguments, saved for --recover_project
+        self.njobs = args.njobs
+        self.max_concurrent = args.maxConcurrent
+        self.project_name = None
+        self.start_project = True
+        self.campaign_state = None
+        self.jobsub_opts = []
+        self.exports = list(export_to_annie_sam_wrap)
+        self.wrap_opts = []
+        self.tarball_uri = ''
+        self.tarball_hash = None
+
+def add_argument_group(parser, title, description):
+    '''
+    parser.add_argument_group, with the options added to the group recorded in parser_dests and parser_flags
+    '''
+    group = parser.add_argument_group(title, description)
+    add_argument = group.add_argument
+    def add_and_record(*names, **kwargs):
+        action = add_argument(*names, **kwargs)
+        for option in action.option_strings:
+            parser_dests[option] = action.dest
+            if action.nargs == 0:
+                parser_flags.add(option)
+        return action
+    group.add_argument = add_and_record
+    return group
+
+def build_parser():
     parser = argparse.ArgumentParser(description="Submit ANNIE grid job", add_help=False)
 
-    required_args = parser.add_argument_group('Required arguments', 'These arguments must be supplied')
+    required_args = add_argument_group(parser, 'Required arguments', 'These arguments must be supplied')
     required_args.add_argument('--jobname',           required=True, help='Job name');
     required_args.add_argument('--dest',              required=True, help='Destination for outputs')
     required_args.add_argument('--config', '-c',      required=True, help='Tool chain config to use. The config should be a directory in ToolAnalysis/config/')
     required_args.add_argument('--input_file_config', required=True, help='File in the toolchain config directory that defines the input file that is run over. '\
                                                                           'eg. for LoadWCSim this would be \"LoadWCSimConfig\", '\
                                                                           'while for DataDecoder this would be \"my_files.txt\"')
-    required_args.add_argument('--defname',           required=True, help='SAM dataset definition to run over')
-    required_args.add_argument('--tarball',           required=True, help='If you want to use your local ToolAnalysis then pass in a tarball here.'\
-                                                                          'Otherwise the base build from the singularity container will be used.'\
-                                                                          'Note: you DO NOT have to move your tarball to your pnfs scratch area.')
+    required_args.add_argument('--defname',           required=True, action='append', help='SAM dataset definition to run over. With more than one, each is submitted on its own '\
+                                                                          'with --jobname <jobname>_<defname> and --dest <dest>/<defname>, '\
+                                                                          'spaced out by --campaign_spacing')
     
-    optional_args = parser.add_argument_group('Other optional arguments', 'These arguments are optional')
+    optional_args = add_argument_group(parser, 'Other optional arguments', 'These arguments are optional')
+    optional_args.add_argument('--tarball',                        help='If you want to use your local ToolAnalysis then pass in a tarball here. '\
+                                                                        'Note: you DO NOT have to move your tarball to your pnfs scratch area. '\
+                                                                        'Either this or --build_tarball is needed.')
     optional_args.add_argument('--input_config_var',               help='Variable name in the input_file_config that defines what the input is. '\
                                                                         'eg. for LoadWCSim this would be required and set to \"InputFile\", '\
                                                                         'while for DataDecoder this argument is not required.')
     optional_args.add_argument('--no_job_dirs', action='store_true', help='By default directories will be created in DEST for each job number in order to prevent '\
                                                                           'overpopulating pnfs directories. Using this flag will turn off that feature.')
     optional_args.add_argument('--no_rename',   action='store_true', help='By default output file we be renamed by prepending the input file name for uniqueness. '\
-                                                                          'Using this flag will turn off that feature')                                                                        
+                                                                          'Using this flag will turn off that feature. With more than one of --workers, each worker then '\
+                                                                          'copies its outputs to its own worker_<n> directory.')                                                                        
     optional_args.add_argument('--quick_copy',   action='store_true', help='By default output files are copied back at then end of all executions. '\
                                                                           'Using this flag will copy out file right after they are created.')                                                                    
+    optional_args.add_argument('--copy_streams', type=int, default=0, help='Copy outputs out in batches, running up to COPY_STREAMS copies at once. With --quick_copy the copies '\
+                                                                          'run in the background while the next file is processed. By default files are copied one at a time.')
+    optional_args.add_argument('--copy_retries', type=int, default=3, help='Number of times to try copying out each batch of outputs when using --copy_streams (default 3)')
+    optional_args.add_argument('--bundle_outputs', action='store_true', help='Pack the outputs of each job into uncompressed tar files, bundle.<job>.<n>.tar, and copy those '\
+                                                                          'back instead of every output on its own, along with bundle_manifest.<job>.jsonl listing the original '\
+                                                                          'name and input files of every output. Use annie_bundle.py to list and extract them. '\
+                                                                          'A --copy_out_script gets the bundles rather than the outputs.')
+    optional_args.add_argument('--bundle_max_mb', type=int, default=0, help='With --bundle_outputs, start a new bundle once the current one would go over this many MB. '\
+                                                                          'With --quick_copy each bundle is copied back once it is full (default 0, one bundle per job)')
+    optional_args.add_argument('--persistent_container', action='store_true', help='By default a new container is started to run the ToolChain on each input file. '\
+                                                                          'Using this flag will start one container for the whole job and run every file inside of it.')
+    optional_args.add_argument('--stage_records', action='store_true', help='Record how long each stage of each file took and copy the records back to DEST as '\
+                                                                          'stage_records.<job>.jsonl, for annie_job_stats.py, --auto_sites and --autotune. '\
+                                                                          'By default no records are kept.')
+    optional_args.add_argument('--tarball_stage_dir', default='/pnfs/annie/resilient/users/%s/tarballs' % user,
+                                                                     help='Tarballs are copied here once, under the hash of their contents, and jobs get them from here. '\
+                                                                          'Submitting the same tarball again reuses the copy that is already there. If it can\'t be written to, '\
+                                                                          'the tarball is uploaded with the dropbox instead (default %(default)s)')
+    optional_args.add_argument('--tarball_index', default=annie_tarball.default_index,
+                                                                     help='Local record of the tarballs that have been staged (default %(default)s)')
+    optional_args.add_argument('--build_tarball', metavar='TOOLANALYSIS_DIR', help='Build the tarball from this ToolAnalysis directory, keeping only what Analyse needs to run: '\
+                                                                          'Analyse, Setup.sh, lib, the DataModel and ToolDAQ headers and libraries, and configfiles. '\
+                                                                          'There is a warning for anything else the configs of CONFIG refer to. '\
+                                                                          'It is compressed with zstd if that is installed. It is written to --tarball if that is given, '\
+                                                                          'otherwise to <dir>_<config>.tar.zst in the current directory.')
+    optional_args.add_argument('--tarball_include', action='append', metavar='PATTERN', help='Also put files matching PATTERN, relative to TOOLANALYSIS_DIR, in the tarball '\
+                                                                          'made by --build_tarball, eg. "configfiles/LoadWCSim/*". You can use this multiple times.')
+    optional_args.add_argument('--tarball_level', type=int, default=10, help='Compression level for --build_tarball (default %(default)s)')
+    optional_args.add_argument('--dropbox_tarball', action='store_true', help='Upload the tarball with the jobsub dropbox on every submission instead of staging it in --tarball_stage_dir')
+    optional_args.add_argument('--worker_tarball_cache', metavar='DIR', help='Unpack the tarball into DIR on the worker node, under its hash, so that later jobs on '\
+                                                                          'the same node can use it without unpacking it again. DIR has to be local to the node, and on the same filesystem as '\
+                                                                          '$_CONDOR_SCRATCH_DIR so that jobs can hard link it from there, otherwise each job copies it')
     optional_args.add_argument('--copy_out_script',                  help='Use the supplied COPY_OUT_SCRIPT (located on pnfs). Otherwise all files will be copied as is to the DEST.')
     optional_args.add_argument('--input_file',  action='append',     help='Copy an extra file to the grid node. You can use this multiple times.')
     optional_args.add_argument('--export',      action='append',     help='Export environment variable to the grid. It must be already set in your current environment. '\
@@ -174,55 +634,199 @@ if __name__=='__main__':
     optional_args.add_argument('--postscript',  action='append',     help='Execute this script after running the ToolChain on all files but before copying them out. '\
                                                                           'You can use this multiple times. Syntax is colon separated arguments (ie. script:arg:arg...)')
 
-    job_control_args = parser.add_argument_group('Job control args', 'Optional arguments for additional job control')
+    job_control_args = add_argument_group(parser, 'Job control args', 'Optional arguments for additional job control')
     job_control_args.add_argument('--njobs',             type=int, default=0,       help='Number of jobs to submit')
     job_control_args.add_argument('--maxConcurrent',     type=int, default=0,       help='Run a maximum of N jobs simultaneously')
     job_control_args.add_argument('--files_per_job',     type=int, default=0,       help='Number of files per job. If zero, calculate from number of jobs')
+    job_control_args.add_argument('--prefetch',          type=int, default=0,       help='Fetch up to N input files ahead in the background while the current one '\
+                                                                                         'is processed. The files must fit in --disk along with everything else. (default 0, no prefetching)')
+    job_control_args.add_argument('--files_per_invocation', type=int, default=1,    help='Number of input files to run over in each invocation of the ToolChain. '\
+                                                                                         'Only works for toolchains that take a list of files, so it can\'t be used with --input_config_var. '\
+                                                                                         'If the ToolChain fails, every file in that invocation is marked as skipped. Renamed outputs get '\
+                                                                                         'the first and last file names, <first>_to_<last>, and the files are listed in <first>_to_<last>.inputs.txt (default 1)')
+    job_control_args.add_argument('--balance_by',        choices=['bytes', 'events'], help='Balance jobs by the size or the number of events of the files they run over, '\
+                                                                                         'using the SAM metadata, rather than by the number of files. The number of jobs is picked so that '\
+                                                                                         'each one takes about --target_runtime at --process_rate, and each job stops asking for files '\
+                                                                                         'once it has done its share. Overrides --njobs.')
+    job_control_args.add_argument('--target_runtime',    type=int,                  help='Target runtime for each job in seconds when using --balance_by')
+    job_control_args.add_argument('--process_rate',      type=float,                help='How fast the ToolChain gets through files when using --balance_by, '\
+                                                                                         'in MB/s for bytes or events/s for events')
+    job_control_args.add_argument('--sam_cache_ttl',     type=int, default=3600,    help='Reuse the file counts and metadata of a --defname that SAM was asked for less than '\
+                                                                                         'this many seconds ago, from %s. 0 turns the cache off. (default 3600)' % default_sam_cache)
+    job_control_args.add_argument('--refresh_sam',       action='store_true',       help='Ask SAM about --defname again even if the answer is in the cache')
     job_control_args.add_argument('--nevents',           type=int, default=-1,      help='Number of events per file to process')
     job_control_args.add_argument('--disk',              type=int, default=10000,   help='Local disk space requirement for worker node in MB. (default 10000MB (10GB))')
     job_control_args.add_argument('--memory',            type=int, default=1900,    help='Local memory requirement for worker node in MB. (default 1900MB (1.9GB))')
     job_control_args.add_argument('--cpu',               type=int, default=1,       help='Request worker nodes that have at least NUMBER cpus')    
+    job_control_args.add_argument('--workers',           type=int, default=1,       help='Number of SAM consumers to run side by side in each job. Each one gets its own copy of '\
+                                                                                         'ToolAnalysis and --files_per_job is split between them. At least this many cpus are requested. '\
+                                                                                         'Note that --memory and --disk are for the whole job. (default 1)')
     job_control_args.add_argument('--expected_lifetime',           default="10800", help='Expected job lifetime (default is 10800s=3h). '\
                                                                                          'Valid values are an integer number of seconds or one of '\
                                                                                          '\"short\" (6h), \"medium\" (12h) or \"long\" (24h, jobsub default)')
+    job_control_args.add_argument('--autotune',          choices=['suggest', 'apply'], help='Work out --memory, --disk and --expected_lifetime from the jobs with the same --config '\
+                                                                                         'in the history (see --auto_sites), scaled to the number of files per job. "suggest" only prints them, '\
+                                                                                         '"apply" also uses them for any of the three that weren\'t given.')
+    job_control_args.add_argument('--autotune_percentile', type=float, default=95,  help='Size the requests so that this percentage of past jobs would have fit (default 95)')
+    job_control_args.add_argument('--dynamic_lifetime',  type=int, metavar='SECONDS', help='Stop asking SAM for more files once the time left in the job is less than '\
+                                                                                         'the expected time to run over another file and copy everything out, plus SECONDS to spare. '\
+                                                                                         'The time left is from --expected_lifetime or the glidein, whichever ends first, and the '\
+                                                                                         'time per file and copy out time are estimated as the job runs.')
     job_control_args.add_argument('--grace_memory',                default='1024',  help='Auto-releese jobs which become held due to insufficient memory '\
                                                                                          'and resubmit with this additional memory (in MB)')
     job_control_args.add_argument('--grace_lifetime',              default='10800', help='Auto-release jobs which become held due to insufficient lifetime '\
                                                                                          'and resubmit with this additional lifetime (in seconds)')
 
+    job_control_args.add_argument('--campaign',          action='store_true',       help='Submit any number of jobs as a series of clusters of at most %d jobs, '\
+                                                                                         'spaced out by --campaign_spacing and all using the same SAM project. '\
+                                                                                         'With --maxConcurrent the total across all of the clusters is kept under that. '\
+                                                                                         'Progress is saved in <project>.campaign.json in the current directory.' % max_jobs_per_cluster)
+    job_control_args.add_argument('--campaign_spacing',  type=int, default=300,     help='Seconds to wait between clusters in a campaign (default 300)')
+    job_control_args.add_argument('--resume_campaign',   metavar='STATE_FILE',      help='Pick up an interrupted campaign where it left off. '\
+                                                                                         'Use the same arguments as the original submission.')
+    job_control_args.add_argument('--recover_project',   metavar='PROJECT_NAME',                      help='Submit the files of PROJECT_NAME that were skipped or never delivered, '\
+                                                                                                           'using the arguments it was submitted with and enough jobs to keep the same number of files '\
+                                                                                                           'per job. A new SAM definition of those files is made, except with --test. Any other options given replace '\
+                                                                                                           'all of the original values of the same option.')
     job_control_args.add_argument('--continue_project',  metavar='PROJECT_NAME', default="",          help='Do not start a new samweb project, '\
                                                                                                            'instead continue the specified one.')
+    job_control_args.add_argument('--sam_retries',       metavar='N',  type=int,                      help='Number of times each job tries establishProcess and getNextFile (wrapper default 10)')
+    job_control_args.add_argument('--fetch_retries',     metavar='N',  type=int,                      help='Number of times each job tries to fetch an input file before marking it as skipped '\
+                                                                                                           'and going on to the next one (wrapper default 3)')
+    job_control_args.add_argument('--retry_base',        metavar='SEC', type=int,                     help='Before the Nth retry of any of these, jobs wait a random time of up to '\
+                                                                                                           'RETRY_BASE * 2^(N-1) seconds, so that a big cluster does not retry in step (wrapper default 5)')
+    job_control_args.add_argument('--retry_max',         metavar='SEC', type=int,                     help='Longest wait before a retry (wrapper default 300)')
+    job_control_args.add_argument('--alternate_uri',     metavar='PATTERN=REPLACEMENT',               help='On every other retry of a fetch, replace PATTERN in the file URI with REPLACEMENT, '\
+                                                                                                           'eg. to get the file from another door')
     job_control_args.add_argument('--site',                                      action='append',     help='Specify allowed offsite locations.  Omit to allow running at any offsite location')
     job_control_args.add_argument('--exclude_site',      metavar='SITE',         action='append',     help='Specify an offsite location to exclude.')
+    job_control_args.add_argument('--auto_sites',                                action='store_true', help='Pick sites using the stage records of past jobs submitted with --stage_records. The sites that got through '\
+                                                                                                           'files fastest are used and ones where jobs failed, files were skipped, or things were '\
+                                                                                                           'slow are excluded. Sites without enough history are used if they are on the recommended list.')
+    job_control_args.add_argument('--history',           metavar='FILE', default=annie_job_history.default_history,
+                                                                                                      help='Where to keep the history of past jobs (default %s)' % annie_job_history.default_history)
     job_control_args.add_argument('--all_sites',                                 action="store_true", help="Remove all specific site requirements.")
     job_control_args.add_argument('--onsite_only',                               action='store_true', help='Allow to run solely on onsite resources.')
     job_control_args.add_argument('--offsite_only',                              action='store_true', help='Allow to run solely on offsite resources.')
     job_control_args.add_argument('--grid_sl7',                                  action='store_true', help='Run in SL7 on the grid. By default, ANNIE submissions use the local AL9 environment.')
 
-    debug_args = parser.add_argument_group('Debugging options', 'These are optional arguments that are useful for debugging or testing')
+    debug_args = add_argument_group(parser, 'Debugging options', 'These are optional arguments that are useful for debugging or testing')
     debug_args.add_argument('--print_jobsub',    action='store_true', help='Print jobsub command')
     debug_args.add_argument('--test',            action='store_true', help='Do not actually do anything, just run tests and print jobsub cmd')
     debug_args.add_argument('--test_submission', action='store_true', help='Override other arguments given to submit a test to the grid.'\
                                                                            'It will run 1 job with 3 events and write the output to '\
                                                                            '/pnfs/nova/scratch/users/<user>/test_jobs/<date>_<time>')
-    debug_args.add_argument("--kill_after", metavar="SEC", type=int, help='If job is still running after this many seconds, kill in such a way that a log will be returned')
-
-    support_args = parser.add_argument_group("HELP!", "")
+    debug_args.add_argument("--kill_after", metavar="SEC", type=int, help='If job is still running after this many seconds, stop Analyse and do not ask for any more files, '\
+                                                                        'so that the logs and whatever is done are returned. Anything else the job is stuck in, eg. '\
+                                                                        'a fetch or a copy, is killed once it has been running for 10 minutes past that.')
+    debug_args.add_argument('--watchdog_interval', metavar='SEC', type=int, default=0, help='Every this many seconds while Analyse runs, sample the memory, CPU and scratch disk it uses. '\
+                                                                        'The samples for every input file are copied back to DEST as resource_samples.<job>.jsonl. '\
+                                                                        'By default this is off, unless --kill_after or one of the limits below is given, '\
+                                                                        'which sample every 10 seconds.')
+    debug_args.add_argument('--file_memory_limit', metavar='MB', type=int, help='Stop Analyse on a file if it uses more than this much memory, skip the file, and carry on '\
+                                                                        'with the next one. Keep it below --memory so that the job is not held first.')
+    debug_args.add_argument('--file_time_limit', metavar='SEC', type=int, help='Stop Analyse on a file if it is still running after this many seconds, skip the file, and carry on '\
+                                                                        'with the next one')
+
+    support_args = add_argument_group(parser, "HELP!", "")
     support_args.add_argument("-h", "--help", action="help",   help='Show this help message and exit')
     support_args.add_argument('-f', '--file', action='append', help='''Text file containing any arguments to this utility.  Multiple allowed.
                                                                        Arguments should look just like they would on the command line,
                                                                        but the parsing of this file is whitespace insenstive.
                                                                        Comments will be identified with the # character and removed. ''')
+    return parser
+
+def parse_args(argv):
+    '''
+    Parse the command line arguments, without the program name. --defname can be given more than
+    once, so all of them are in args.defnames and args.defname is the first.
+    '''
+    args = build_parser().parse_args(argv)
+    args.defnames = args.defname
+    args.defname = args.defnames[0]
+    return args
+
+def given_args(argv):
+    '''
+    The names of the arguments that are set in argv, rather than left at their defaults
+    '''
+    parser = build_parser()
+    # argparse only fills in the defaults of arguments that aren't in the namespace yet
+    dests = set(dest for dest in parser_dests.values() if dest != argparse.SUPPRESS)
+    args = parser.parse_args(argv, argparse.Namespace(**dict.fromkeys(dests)))
+    return set(dest for dest in dests if getattr(args, dest) is not None)
 
-    args = parser.parse_args()
+def pick_sites(args):
+    '''
+    The sites to use and to stay away from with --auto_sites, from the history of past jobs,
+    as (good sites, bad sites). Both are empty if there isn't enough history.
+    '''
+    key = (args.history, args.config)
+    if key in site_rankings:
+        return site_rankings[key]
+
+    history = annie_job_history.open_history(args.history)
+    nnew = annie_job_history.update_history(history)
+    if nnew:
+        print("Added %d new job records to %s" % (nnew, args.history))
+    stats = annie_job_history.site_stats(history, config=args.config)
+    if not stats:
+        # nothing for this toolchain yet, go by everything else
+        stats = annie_job_history.site_stats(history)
+    good_sites, bad_sites, unsure_sites = annie_job_history.rank_sites(stats)
+
+    if not good_sites:
+        warn("Not enough history to pick sites with --auto_sites, using the recommended sites")
+        bad_sites = []
+    else:
+        print("Site performance from past jobs:")
+        annie_job_history.print_site_stats(stats, good_sites, bad_sites)
+    site_rankings[key] = (good_sites, [site for site, reason in bad_sites])
+    return site_rankings[key]
 
-    #---------------------------------------------------------------------------
-    # Do the work
-    #---------------------------------------------------------------------------
+def prepare_tarball(args):
+    '''
+    Build the tarball if --build_tarball was asked for, and check that there is one
+    '''
+    if args.build_tarball:
+        try:
+            args.tarball, kept_files, left_files = annie_tarball.build_tarball(args.build_tarball, args.config, args.tarball,
+                                                                               args.tarball_include or [], args.tarball_level)
+        except (ValueError, IOError, OSError) as e:
+            fail("Could not build a tarball from %s: %s" % (args.build_tarball, e))
+        annie_tarball.print_tarball_report(args.tarball, kept_files, left_files)
+        for config_file, path in annie_tarball.left_out_references(args.build_tarball, args.config, kept_files):
+            warn("%s refers to %s, which is not in the tarball. Add it with --tarball_include '%s%s'" %
+                 (config_file, path, path, '/*' if os.path.isdir(os.path.join(args.build_tarball, path)) else ''))
+        # it only needs building once, however many submissions use it
+        args.build_tarball = None
+    elif not args.tarball:
+        fail("Either --tarball or --build_tarball is needed")
+
+    if not os.path.isfile(args.tarball):
+        fail("Tarball %s does not exist!" % args.tarball)
+
+def plan_submission(args, argv=None):
+    '''
+    Work out how to submit args.defname with the arguments in args, from parse_args. This asks SAM
+    how many files there are when it needs to, and checks the files that will be sent with the jobs,
+    but doesn't start or submit anything. argv is saved with the project for --recover_project.
+    Returns a SubmissionPlan.
+    '''
+    plan = SubmissionPlan(args, argv if argv is not None else sys.argv[1:])
+    jobsub_opts = plan.jobsub_opts
+    annie_sam_wrap_opts = plan.wrap_opts
+    export_to_annie_sam_wrap = plan.exports
+    usage_models = ['DEDICATED,OPPORTUNISTIC']
+    sites = list(recommended_sites)
+    excluded = list(excluded_sites)
 
     if args.onsite_only and args.offsite_only:
         fail("Cannot specify onsite_only and offsite_only")
 
+    if args.files_per_invocation > 1 and args.input_config_var:
+        fail("Cannot use --files_per_invocation with --input_config_var, the ToolChain can only take one file at a time")
+
     if not args.onsite_only :
         usage_models.append("OFFSITE")
         export_to_annie_sam_wrap.append("IS_OFFSITE=1")
@@ -245,7 +849,7 @@ if __name__=='__main__':
             mode = os.stat(test_dest).st_mode | stat.S_IXGRP | stat.S_IWGRP
             os.chmod(test_dest, mode)
         test_expected_lifetime = "0"
-        test_dynamic_lifetime = "500"
+        test_dynamic_lifetime = 500
         test_files_per_job = 1
 
         print("Running a test submission. Overwriting:")
@@ -258,10 +862,13 @@ if __name__=='__main__':
         args.dest = test_dest
         print("  expected_lifetime", args.expected_lifetime, "-->", test_expected_lifetime)
         args.expected_lifetime = test_expected_lifetime
-        # print("  dynamic_lifetime", args.dynamic_lifetime, "-->", test_dynamic_lifetime)
-        # args.dynamic_lifetime = test_dynamic_lifetime
+        print("  dynamic_lifetime", args.dynamic_lifetime, "-->", test_dynamic_lifetime)
+        args.dynamic_lifetime = test_dynamic_lifetime
         print("  files_per_job", args.files_per_job, "-->", test_files_per_job)
         args.files_per_job = test_files_per_job
+        if args.balance_by:
+            print("  balance_by", args.balance_by, "--> None")
+            args.balance_by = None
 
         
     ##########################
@@ -269,63 +876,103 @@ if __name__=='__main__':
     ##########################
     njobs = args.njobs
     files_per_job = args.files_per_job
-    samweb = samweb_client.SAMWebClient(experiment='annie')
+
+    # each worker is its own consumer, so they split the files in a job
+    if args.workers < 1:
+        fail("--workers must be at least 1")
+    files_per_consumer = -(-files_per_job // args.workers)
         
-    if files_per_job > 0 and njobs > 0:
-        jobsub_opts += ['-N %d' %njobs]
-        annie_sam_wrap_opts += ['--limit %d' %files_per_job]
+    if args.balance_by:
+        if not args.target_runtime or not args.process_rate:
+            fail("--balance_by needs both --target_runtime and --process_rate")
+
+        njobs, cost_budget = plan_balanced_jobs(args)
+        annie_sam_wrap_opts += ['--cost_metric %s' %args.balance_by]
+        annie_sam_wrap_opts += ['--cost_budget %d' %(-(-cost_budget // args.workers))]
+        if files_per_job > 0:
+            annie_sam_wrap_opts += ['--limit %d' %files_per_consumer]
+
+    elif files_per_job > 0 and njobs > 0:
+        annie_sam_wrap_opts += ['--limit %d' %files_per_consumer]
             
     elif files_per_job > 0:
         # Files per job defined, but njobs not. Calculate on the fly
-        num_files = samweb.countFiles(defname=args.defname)
+        num_files = count_files(args, args.defname)
         #njobs=(old_div(num_files, files_per_job)) +1
         njobs=(num_files//files_per_job) +1
         
-        jobsub_opts += ['-N %d' %njobs]
-        annie_sam_wrap_opts += ['--limit %d' %files_per_job]
+        annie_sam_wrap_opts += ['--limit %d' %files_per_consumer]
         
     elif njobs > 0:
         # Njobs given but not files/job, that's fine
-        jobsub_opts += ['-N %d' %njobs]
+        pass
 
     else:
         warn('Neither --njobs or --files_per_job were specified. Are you sure you want that? '\
              'I\'ll sleep for 5 seconds while you think about it')
         sleep(5)
+    plan.njobs = njobs
+
+    if args.resume_campaign:
+        if not os.path.isfile(args.resume_campaign):
+            fail("Campaign state file %s was not found" % args.resume_campaign)
+        with open(args.resume_campaign) as f:
+            plan.campaign_state = json.load(f)
+        if plan.campaign_state['njobs'] != njobs:
+            warn("The campaign was started with %d jobs but now there would be %d. Sticking with %d" %
+                 (plan.campaign_state['njobs'], njobs, plan.campaign_state['njobs']))
+        args.campaign = True
+        args.continue_project = plan.campaign_state['project_name']
 
     # Limit the number of jobs that a user tries to submit
-    if njobs > 5000 and not args.maxConcurrent:
+    if njobs > max_jobs_per_cluster and not args.maxConcurrent and not args.campaign:
         print('''
         Error: cannot submit more than 5000 jobs in one cluster.
-        Please break your submission into multiple batches of 5000 (or less) jobs,
-        and after submitting the first batch, use --continue_project with the project
-        that results from the first submission for the remaining batches.
+        Please use --campaign to submit them in batches automatically, or break your submission
+        into multiple batches of 5000 (or less) jobs, and after submitting the first batch,
+        use --continue_project with the project that results from the first submission for
+        the remaining batches.
 
         Please separate submissions by 5 minutes.
         ''', file=sys.stderr)
         sys.exit(1)
 
-    if args.maxConcurrent:
-        jobsub_opts += ["--maxConcurrent=%d" %args.maxConcurrent]
-        if args.maxConcurrent > 25000:
-            print('''
-            Error: cannot submit more than 25000 jobs to the grid so maxConcurrent shouldn't be higher than that.
-            ''', file=sys.stderr)
-            sys.exit(1)
+    if args.campaign and njobs <= 0:
+        fail("--campaign needs --njobs or --files_per_job")
+
+    if args.maxConcurrent > 25000:
+        print('''
+        Error: cannot submit more than 25000 jobs to the grid so maxConcurrent shouldn't be higher than that.
+        ''', file=sys.stderr)
+        sys.exit(1)
+
+    if args.autotune:
+        planned_files = files_per_consumer
+        if planned_files <= 0 and njobs > 0:
+            planned_files = -(-count_files(args, args.defname) // (njobs * args.workers))
+        autotune_resources(args, given_args(plan.argv), planned_files)
 
     # Jobsub options
     resource_opt="--resource-provides=usage_model=" + ",".join( usage_models )
     jobsub_opts += [resource_opt]
 
+    if args.auto_sites and not args.all_sites and not args.onsite_only:
+        good_sites, bad_sites = pick_sites(args)
+        if good_sites:
+            # trust the history over what we found by hand, but give the recommended sites a chance
+            sites = good_sites + [site for site in sites if site not in good_sites and site not in bad_sites]
+            excluded = [site for site in excluded if site not in good_sites]
+            excluded += [site for site in bad_sites if site not in excluded]
+
     if use_recommended_sites or args.site and not args.all_sites:
         site_opt="--site="
 
         if use_recommended_sites:
-            for isite in recommended_sites:
+            for isite in sites:
                 site_opt += isite + ","
         if args.site:
             for isite in args.site:
-                if isite not in recommended_sites:
+                if isite not in sites:
                     warn("Site "+isite+" is not known to work. Your jobs may fail at that site. Sleeping for 5 seconds")
                     sleep(5)
                 site_opt += isite + ","
@@ -336,9 +983,9 @@ if __name__=='__main__':
 
     if args.exclude_site:
         for isite in args.exclude_site:            
-            excluded_sites += [ isite ]
+            excluded += [ isite ]
             
-    for isite in excluded_sites:
+    for isite in excluded:
         jobsub_opts += [ "--append_condor_requirements='(TARGET.GLIDEIN_Site\\ isnt\\ \\\"%s\\\")'" % isite ]
 
     if args.disk:
@@ -349,6 +996,10 @@ if __name__=='__main__':
         mem_opt="--memory=%sMB" % (args.memory)
         jobsub_opts += [ mem_opt ]
 
+    if args.workers > args.cpu:
+        print("Requesting %d cpus for %d workers" % (args.workers, args.workers))
+        args.cpu = args.workers
+
     if args.cpu:
         cpu_opt="--cpu=%d" % (args.cpu)
         jobsub_opts += [ cpu_opt ]
@@ -365,13 +1016,14 @@ if __name__=='__main__':
     # one of a few strings, this should test for either
     # possibility
     try:
-        dummy=int(args.expected_lifetime)
+        job_lifetime=int(args.expected_lifetime)
         jobsub_opts += ["--expected-lifetime=%ss" % (args.expected_lifetime)]
     except:
         allowed_lifetimes=["short","medium","long"]
         if args.expected_lifetime not in allowed_lifetimes:
             fail("Invalid expected_lifetime %s" % args.expected_lifetime)
         else:
+            job_lifetime=named_lifetimes[args.expected_lifetime]
             jobsub_opts += ["--expected-lifetime=%s" % (args.expected_lifetime)]
 
     jobsub_opts += ["-G annie"]
@@ -380,139 +1032,84 @@ if __name__=='__main__':
         jobsub_opts += ["--no-submit"]
         jobsub_opts += ["--debug"]
 
+    # files to send with the jobs, in the order jobsub gets them
+    dropbox_files = []
     if args.input_file:
-        for input_file in args.input_file:
-            if not os.path.isfile(os.path.expandvars(input_file)):
-                fail("Input file %s does not exist!" % input_file)
-
-            if not os.path.expandvars(input_file).startswith("/pnfs/"):
-                fail("Input file %s must be in dCache /pnfs/annie/" % input_file)
-
-            jobsub_opts += ['-f dropbox://%s' % input_file]
+        dropbox_files += [('Input file', input_file) for input_file in args.input_file]
 
     if args.copy_out_script is not None:
-        if not os.path.isfile(os.path.expandvars(args.copy_out_script)):
-            fail("Copyout script %s does not exist!" %args.copy_out_script)
-
-        if not os.path.expandvars(args.copy_out_script).startswith("/pnfs/"):
-            fail("Copyout script %s must be in /pnfs/annie/" %args.copy_out_script)
-
-        jobsub_opts += ['-f dropbox://%s' % args.copy_out_script]
+        dropbox_files += [('Copyout script', args.copy_out_script)]
 
     if args.export:
         export_to_annie_sam_wrap += args.export
 
-    if args.earlysource:
-        for script in args.earlysource:
-            if ":" in script:
-                script_path = script.split(":")[0]
-            else:
-                script_path = script
-
-            if not os.path.isfile(os.path.expandvars(script)):
-                fail("Input file %s does not exist!" % script)
-
-            if not os.path.expandvars(script).startswith("/pnfs/"):
-                fail("Input file %s must be in dCache /pnfs/annie/" % script)
-
-            jobsub_opts += ['-f dropbox://%s' % script_path]
-            annie_sam_wrap_opts += ['--earlysource %s' % script]
-
-
-    if args.earlyscript:
-        for script in args.earlyscript:
-            if ":" in script:
-                script_path = script.split(":")[0]
-            else:
-                script_path = script
-
-            if not os.path.isfile(os.path.expandvars(script)):
-                fail("Input file %s does not exist!" % script)
-
-            if not os.path.expandvars(script).startswith("/pnfs/"):
-                fail("Input file %s must be in dCache /pnfs/annie/" % script)
-
-            jobsub_opts += ['-f dropbox://%s' % script_path]
-            annie_sam_wrap_opts += ['--earlyscript %s' % script]
-    
-    if args.source:
-        for script in args.source:
-            if ":" in script:
-                script_path = script.split(":")[0]
-            else:
-                script_path = script
-
-            if not os.path.isfile(os.path.expandvars(script)):
-                fail("Input file %s does not exist!" % script)
-
-            if not os.path.expandvars(script).startswith("/pnfs/"):
-                fail("Input file %s must be in dCache /pnfs/annie/" % script)
-
-            jobsub_opts += ['-f dropbox://%s' % script_path]
-            annie_sam_wrap_opts += ['--source %s' % script]
-
-    if args.prescript:
-        for script in args.prescript:
-            if ":" in script:
-                script_path = script.split(":")[0]
-            else:
-                script_path = script
-
-            if not os.path.isfile(os.path.expandvars(script)):
-                fail("Input file %s does not exist!" % script)
-
-            if not os.path.expandvars(script).startswith("/pnfs/"):
-                fail("Input file %s must be in dCache /pnfs/annie/" % script)
-
-            jobsub_opts += ['-f dropbox://%s' % script_path]
-            annie_sam_wrap_opts += ['--prescript %s' % script]
+    # scripts can have colon separated arguments (ie. script:arg:arg...)
+    for opt, scripts in [('earlysource', args.earlysource), ('earlyscript', args.earlyscript), ('source', args.source),
+                         ('prescript', args.prescript), ('postscript', args.postscript)]:
+        for script in scripts or []:
+            dropbox_files += [('Input file', script.split(":")[0])]
+            annie_sam_wrap_opts += ['--%s %s' % (opt, script)]
 
+    if not os.path.expandvars(args.dest).startswith("/pnfs/"):
+        fail("Destination directory %s must be in dCache /pnfs/annie/" % args.dest)
+   
+    export_to_annie_sam_wrap.append("DEST=%s" % args.dest)
 
-    if args.postscript:
-        for script in args.postscript:
-            if ":" in script:
-                script_path = script.split(":")[0]
-            else:
-                script_path = script
+    prepare_tarball(args)
 
-            if not os.path.isfile(os.path.expandvars(script)):
-                fail("Input file %s does not exist!" % script)
+    # the same file only has to be sent once, however many times it's used
+    unique_files = []
+    for label, path in dropbox_files:
+        if path not in [unique_path for unique_label, unique_path in unique_files]:
+            unique_files.append((label, path))
 
-            if not os.path.expandvars(script).startswith("/pnfs/"):
-                fail("Input file %s must be in dCache /pnfs/annie/" % script)
+    checks = [(check_input_file, label, path) for label, path in unique_files]
+    checks += [(annie_tarball.check_tarball, args.tarball, args.config, args.input_file_config, args.input_config_var)]
+    preflight(checks)
 
-            jobsub_opts += ['-f dropbox://%s' % script_path]
-            annie_sam_wrap_opts += ['--postscript %s' %script]
+    jobsub_opts += ['-f dropbox://%s' % path for label, path in unique_files]
 
-    if not os.path.expandvars(args.dest).startswith("/pnfs/"):
-        fail("Destination directory %s must be in dCache /pnfs/annie/" % args.dest)
-   
-    export_to_annie_sam_wrap.append("DEST=%s" % args.dest)
+    if not args.dropbox_tarball:
+        # where it will be, it's only copied there by submit
+        try:
+            plan.tarball_uri, plan.tarball_hash, reused = annie_tarball.stage_tarball(args.tarball, args.tarball_stage_dir,
+                                                                                      args.tarball_index, dry_run=True)
+        except (IOError, OSError) as e:
+            fail("Could not read %s: %s" % (args.tarball, e))
+        if not reused and not annie_tarball.can_stage(args.tarball_stage_dir):
+            warn("Can't write to --tarball_stage_dir %s, so %s will be uploaded with the dropbox instead" %
+                 (args.tarball_stage_dir, args.tarball))
+            plan.tarball_hash = None
+    if args.dropbox_tarball or plan.tarball_hash is None:
+        plan.tarball_uri = 'dropbox://' + args.tarball
 
 
         
     ##########################################################
-    # Start the project and setup additional SAM wrapper stuff
+    # Name the project and setup additional SAM wrapper stuff
     #########################################################
     if not args.continue_project:
-        ##start sam project
         project_name = user + "_" + args.jobname + "_" + timestamp
         if args.test_submission:
             project_name += "_testjobs"
-        start_project = True
+        plan.start_project = True
     else:
         project_name = args.continue_project
-        start_project = False
-
-    sam_station=os.getenv("SAM_STATION")
-    if start_project and not args.test:
-        print('\nstarting %s\n' %project_name)
-        start_proj_retval = samweb.startProject(project_name, defname=args.defname,
-                            group='annie', station=sam_station)        
-
-    os.putenv("SAM_PROJECT_NAME",project_name)
-
-    annie_sam_wrap_opts += ['--tarball %s' %os.path.basename(args.tarball)]
+        plan.start_project = False
+    plan.project_name = project_name
+
+    # jobsub passes it on from our environment otherwise
+    plan.exports[:] = ["SAM_PROJECT_NAME=%s" % project_name if export == 'SAM_PROJECT_NAME' else export
+                       for export in plan.exports]
+
+    # a staged copy of the same tarball can have another name
+    annie_sam_wrap_opts += ['--tarball %s' %os.path.basename(plan.tarball_uri)]
+    if args.worker_tarball_cache:
+        if plan.tarball_hash is None:
+            warn("--worker_tarball_cache needs the tarball to be staged, so it does nothing when it is uploaded with the dropbox")
+        else:
+            annie_sam_wrap_opts += ['--tarball_hash %s' %plan.tarball_hash]
+            annie_sam_wrap_opts += ['--tarball_cache %s' %args.worker_tarball_cache]
     annie_sam_wrap_opts += ['--config %s' %args.config]
     annie_sam_wrap_opts += ['--input_file_config %s' %args.input_file_config]
     annie_sam_wrap_opts += ['--nevents "%s"' %args.nevents]
@@ -526,25 +1123,255 @@ if __name__=='__main__':
         annie_sam_wrap_opts += ['--job_dirs']
     if args.quick_copy:
         annie_sam_wrap_opts += ['--quick_copy']
+    if args.files_per_invocation > 1:
+        annie_sam_wrap_opts += ['--files_per_invocation %d' %args.files_per_invocation]
+    if args.copy_streams > 0:
+        annie_sam_wrap_opts += ['--copy_streams %d' %args.copy_streams]
+        annie_sam_wrap_opts += ['--copy_retries %d' %args.copy_retries]
+    if args.bundle_outputs:
+        annie_sam_wrap_opts += ['--bundle_outputs']
+        if args.bundle_max_mb > 0:
+            annie_sam_wrap_opts += ['--bundle_max_mb %d' %args.bundle_max_mb]
+    elif args.bundle_max_mb > 0:
+        warn("--bundle_max_mb does nothing without --bundle_outputs")
+    if args.persistent_container:
+        annie_sam_wrap_opts += ['--persistent_container']
+    if args.stage_records:
+        annie_sam_wrap_opts += ['--stage_records']
+    if args.workers > 1:
+        annie_sam_wrap_opts += ['--workers %d' %args.workers]
+    if args.prefetch > 0:
+        annie_sam_wrap_opts += ['--prefetch %d' %args.prefetch]
+        annie_sam_wrap_opts += ['--disk_budget %d' %args.disk]
+    if args.dynamic_lifetime is not None:
+        annie_sam_wrap_opts += ['--dynamic_lifetime %d' %args.dynamic_lifetime]
+        if job_lifetime > 0:
+            annie_sam_wrap_opts += ['--job_lifetime %d' %job_lifetime]
+    for retry_opt in ['sam_retries', 'fetch_retries', 'retry_base', 'retry_max']:
+        if getattr(args, retry_opt) is not None:
+            annie_sam_wrap_opts += ['--%s %d' %(retry_opt, getattr(args, retry_opt))]
+    if args.alternate_uri:
+        if '=' not in args.alternate_uri:
+            fail("--alternate_uri should look like PATTERN=REPLACEMENT")
+        annie_sam_wrap_opts += ['--alternate_uri "%s"' %args.alternate_uri]
     if args.kill_after:
         annie_sam_wrap_opts += [ "--self_destruct_timer %d" % args.kill_after ]
+    if args.watchdog_interval > 0:
+        annie_sam_wrap_opts += ['--watchdog_interval %d' %args.watchdog_interval]
+    if args.file_memory_limit:
+        if args.memory and args.file_memory_limit >= args.memory:
+            warn("--file_memory_limit is not below --memory, so jobs may be held before it stops anything")
+        annie_sam_wrap_opts += ['--file_memory_limit %d' %args.file_memory_limit]
+    if args.file_time_limit:
+        annie_sam_wrap_opts += ['--file_time_limit %d' %args.file_time_limit]
+
+    return plan
+
+def jobsub_argv(plan, njobs=None, max_concurrent=None):
+    '''
+    The jobsub_submit command for plan, as a list of arguments. njobs and max_concurrent
+    are for submitting it in parts, they default to what's in the plan.
+    '''
+    njobs = plan.njobs if njobs is None else njobs
+    max_concurrent = plan.max_concurrent if max_concurrent is None else max_concurrent
+
+    jobsub_opts = []
+    if njobs > 0:
+        jobsub_opts += ['-N %d' %njobs]
+    if max_concurrent:
+        jobsub_opts += ['--maxConcurrent=%d' %max_concurrent]
+    jobsub_opts += plan.jobsub_opts
+
+    # Add exported environment variables
+    jobsub_opts += ['-e ' + export for export in plan.exports]
+
+    # Add tarball and SAM wrapper script with its options
+    #jobsub_opts += ['--tar_file_name dropbox://' + args.tarball]
+    jobsub_opts += ['-f ' + plan.tarball_uri]
+    jobsub_opts += ['file://' + annie_sam_wrap_cmd]
+    jobsub_opts += plan.wrap_opts
+
+    # the options are written as they would be on the command line, so split them up the same way
+    return ['jobsub_submit'] + shlex.split(os.path.expandvars(' '.join(jobsub_opts)))
+
+def command_line(argv):
+    return ' '.join(shlex.quote(arg) for arg in argv)
+
+def submit(plan):
+    '''
+    Stage the tarball, start the SAM project and submit the jobs in plan. With --test nothing
+    is started and jobsub only checks the submission. Returns jobsub's exit code.
+    '''
+    args = plan.args
+    if plan.tarball_hash is not None:
+        try:
+            plan.tarball_uri, plan.tarball_hash, reused = annie_tarball.stage_tarball(args.tarball, args.tarball_stage_dir,
+                                                                                      args.tarball_index, dry_run=args.test)
+        except (IOError, OSError) as e:
+            fail("Could not stage %s in %s: %s. Use --dropbox_tarball to upload it with the dropbox instead" %
+                 (args.tarball, args.tarball_stage_dir, e))
+        if reused:
+            print("%s is unchanged, using the copy already at %s" % (args.tarball, plan.tarball_uri))
+        elif args.test:
+            print("%s would be staged at %s" % (args.tarball, plan.tarball_uri))
+        else:
+            print("Staged %s at %s" % (args.tarball, plan.tarball_uri))
+
+    sam_station=os.getenv("SAM_STATION")
+    if not args.test:
+        # so that --auto_sites can find the records of these jobs later
+        annie_job_history.add_dest(annie_job_history.open_history(args.history), args.dest)
+
+    if plan.start_project and not args.test:
+        print('\nstarting %s\n' %plan.project_name)
+        start_proj_retval = sam_client().startProject(plan.project_name, defname=args.defname,
+                            group='annie', station=sam_station)        
+        save_submission(plan.project_name, plan.argv, args.defname, plan.njobs)
 
-    
-    
     ############################
     # Actually launch the jobs #
     ############################
+    res = 0
+    if args.campaign:
+        campaign_state = plan.campaign_state
+        if campaign_state is None:
+            campaign_state = {'project_name' : plan.project_name, 'defname' : args.defname, 'njobs' : plan.njobs,
+                              'max_concurrent' : plan.max_concurrent, 'spacing' : args.campaign_spacing,
+                              'clusters' : []}
+        state_file = args.resume_campaign or "%s.campaign.json" % plan.project_name
+        if not args.test:
+            save_campaign(campaign_state, state_file)
+            print("Saving the campaign's progress to %s" % state_file)
+
+        run_campaign(plan, campaign_state, state_file, dry_run=args.test)
+
+    else:
+        jobsub_cmd = jobsub_argv(plan)
+
+        if args.print_jobsub or args.test:
+            print(command_line(jobsub_cmd))
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+        res = subprocess.call(jobsub_cmd)
 
-    jobsub_cmd = build_jobsub_cmd(jobsub_opts)
+    if not args.test:
+        print("\nFollow the progress with: submit_annie_jobs.py status %s" % plan.project_name)
+    return res
 
-    if args.print_jobsub or args.test:
-        print(jobsub_cmd)
+def run_datasets(args, argv, threads=8):
+    '''
+    Plan and submit the jobs for each of args.defnames as if each one had been submitted on its
+    own, with --jobname <jobname>_<defname> and --dest <dest>/<defname>. The SAM queries for all
+    of them are made at once up front, and the submissions are spaced out by --campaign_spacing.
+    '''
+    if args.continue_project or args.resume_campaign:
+        fail("--continue_project and --resume_campaign only work with one --defname")
+
+    prepare_tarball(args)
+    print("Looking up %d SAM definitions" % len(args.defnames))
+    prefetch_sam(args, args.defnames, threads)
+
+    plans = []
+    for defname in args.defnames:
+        dataset_args = copy.copy(args)
+        dataset_args.defname = defname
+        dataset_args.jobname = "%s_%s" % (args.jobname, defname)
+        dataset_args.dest = os.path.join(args.dest, defname)
+        # what to submit this one again with on its own
+        dataset_argv = drop_args(argv, ['--defname', '--jobname', '--dest'])
+        dataset_argv += ['--defname', defname, '--jobname', dataset_args.jobname, '--dest', dataset_args.dest]
+        print("\nPlanning %s" % defname)
+        plans.append(plan_submission(dataset_args, dataset_argv))
+
+    failed = []
+    last_submit = None
+    for iplan, plan in enumerate(plans):
+        if last_submit is not None and not args.test:
+            wait = last_submit + args.campaign_spacing - time.time()
+            if wait > 0:
+                print("Waiting %d seconds before submitting the next dataset" % wait)
+                sleep(wait)
+        print("\nSubmitting %s, dataset %d of %d" % (plan.args.defname, iplan + 1, len(plans)))
         sys.stdout.flush()
-        sys.stderr.flush()
+        last_submit = time.time()
+        if submit(plan) != 0:
+            failed.append(plan.args.defname)
+
+    if failed:
+        fail("Submitting %d of the %d datasets failed: %s" % (len(failed), len(plans), " ".join(failed)))
+    return 0
+
+    
+#######################################################################################
+if __name__=='__main__':
+    prog=os.path.basename(sys.argv[0])
+
+    if os.getenv('ANNIE_FAKE_GRID'):
+        # the stand-ins from "annie_fake_grid.py setup" have fake jobsub commands as well as a fake SAM
+        os.environ['PATH'] = os.path.join(os.getenv('ANNIE_FAKE_GRID'), 'bin') + os.pathsep + os.environ['PATH']
+
+    # "status PROJECT..." shows how submitted projects are getting on instead of submitting anything
+    if len(sys.argv) > 1 and sys.argv[1] == 'status':
+        sys.exit(annie_sam_status.main(sys.argv[2:]))
+
+    while "-f" in sys.argv or "--file" in sys.argv:
+        ### Allow args to be passed in as a plain text file.
+        ### We make a preliminary parser get these arguments out for two reasons:
+        ###    1)  Maintain standard -h, --help functionality
+        ###    2)  Avoid necessity required arguments in initial parsing,
+        ###        allow them to be missing, but find them in the file.
+        preliminary_parser = argparse.ArgumentParser(prog=prog, description='Submit annie grid job')
+
+        preliminary_parser.add_argument('-f', '--file',
+                        help='''Text file containing any arguments to this utility.  Multiple allowed.
+                        Arguments should look just like they would on the command line,
+                        but the parsing of this file is whitespace insenstive.
+                        Commented lines will be identified with the # character and removed. ''', type=str, action='append')
+        pre_args, unknown = preliminary_parser.parse_known_args()
+
+        # Remove pre_args from sys.argv so they are not processed again
+        sys.argv = [x for x in sys.argv if x not in [ "-f", "--file"]]
+
+        if pre_args.file:
+            for filepath in pre_args.file:
+                index = sys.argv.index(filepath)
+                sys.argv.remove(filepath)
+                if os.path.isfile(filepath):
+                    fullpath = filepath
+                else:
+                    print("%s was not found. Exiting." %filepath)
+                    sys.exit(1)
+                text = open(fullpath, 'r').read()
+                text = remove_comments(text) # Strip out commented lines
+                newargs = []
+                for line in text.splitlines():
+                    # Insert arguments into list in order
+                    # where the -f appeared
+                    newargs += line.split()
+                sys.argv[index:index] = newargs
 
-    os.system(jobsub_cmd)
+    
+    # --recover_project picks up the arguments the project was submitted with
+    recover_project = None
+    for iarg, arg in enumerate(sys.argv[1:]):
+        if arg == '--recover_project' and iarg + 2 < len(sys.argv):
+            recover_project = sys.argv[iarg + 2]
+        elif arg.startswith('--recover_project='):
+            recover_project = arg.split('=', 1)[1]
+    if recover_project:
+        sys.argv = sys.argv[:1] + recovery_argv(recover_project, sys.argv[1:])
+        print("Submitting with: %s" % " ".join(sys.argv[1:]))
+
+    args = parse_args(sys.argv[1:])
+
+    if len(args.defnames) > 1:
+        res = run_datasets(args, sys.argv[1:])
+    else:
+        res = submit(plan_submission(args, argv=sys.argv[1:]))
 
     files=glob.glob("./*.tbz2")
     for file in files:
         print(file)
         os.remove(file)
+    sys.exit(1 if res else 0)